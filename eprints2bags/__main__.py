@@ -31,6 +31,7 @@ import bagit
 from   bun import UI, inform, alert, alert_fatal
 from   collections import defaultdict
 from   commonpy.data_utils import flattened, parsed_datetime, pluralized
+from   datetime import datetime, timedelta, timezone
 import getpass
 from   humanize import intcomma
 import keyring
@@ -43,8 +44,10 @@ import shutil
 from   sidetrack import set_debug, log
 import sys
 import tarfile
+from   threading import Lock
 from   time import sleep
 from   timeit import default_timer as timer
+from   urllib.parse import urlsplit
 
 if sys.platform.startswith('win'):
     import keyring.backends
@@ -56,9 +59,20 @@ from   .constants import ON_WINDOWS, KEYRING_PREFIX
 from   .eprints import *
 from   .exit_codes import ExitCode
 from   .files import create_archive, verify_archive, archive_extension
-from   .files import fs_type, KNOWN_SUBDIR_LIMITS
+from   .files import fs_type, rotational_disk, KNOWN_SUBDIR_LIMITS
 from   .files import readable, writable, make_dir
-from   .network import network_available, download_files, url_host
+from   .network import network_available, download_files, stream_files
+from   .network import url_host, new_session
+from   .bagging import build_bag, collection_digests, bag_digests, BagArchiveWriter
+from   .hashing import new_hasher, Throughput
+from   .bagindex import BagIndex
+from   .blobstore import BlobStore
+from   .cache import RecordCache, ListingCache
+from   .crawler import crawled
+from   .oai import oai_identifiers, oai_changes
+from   .pipeline import Pipeline, Stage
+from   .statedb import RunState
+from   .verifier import Verifier
 
 
 # Constants.
@@ -73,6 +87,24 @@ _RECOGNIZED_ARCHIVE_TYPES = ['compressed-zip', 'uncompressed-zip',
 _BAG_CHECKSUMS = ["sha256", "sha512", "md5"]
 '''List of checksum types written with the BagIt bags.'''
 
+_RECOGNIZED_HASH_ENGINES = ['threads', 'processes']
+'''List of values recognized for the checksum computation engine.'''
+
+_RECOGNIZED_VALIDATIONS = ['fast', 'full', 'deferred']
+'''List of values recognized for the bag and archive validation policy.'''
+
+_PIPELINE_STAGES = ['fetch', 'download', 'bag', 'archive']
+'''Names of the stages that each record goes through, in order.'''
+
+_MAX_FETCH_LIMIT = 64
+'''Largest value allowed for the option -f.  Each record fetch in flight
+takes up a thread while it waits for the server, so the limit keeps the
+number of threads reasonable.'''
+
+_LISTING_MAX_AGE = timedelta(hours = 24)
+'''How long a cached list of the records on the server is used before it is
+obtained from the server again (unless it can be updated using OAI-PMH).'''
+
 _LASTMOD_PRINT_FORMAT = '%b %d %Y %H:%M:%S %Z'
 '''Format in which lastmod date is printed back to the user. The value is used
 with datetime.strftime().'''
@@ -84,31 +116,52 @@ with datetime.strftime().'''
 @plac.annotations(
     api_url    = ('the URL for the REST API of the EPrints server',         'option', 'a'),
     bag_action = ('bag, bag & archive, or none? (default: bag & archive)',  'option', 'b'),
-    processes  = ('num. processes to use when bagging (default: #cores/2)', 'option', 'c'),
+    processes  = ('num. workers computing checksums (default: #cores)',     'option', 'c'),
     diff_with  = ('compare new contents to previous bags in directory "D"', 'option', 'd'),
     end_action = ('final action over whole set of records (default: none)', 'option', 'e'),
+    fetch_limit = ('fetch metadata of up to "F" records at once (max. 64)', 'option', 'f'),
     id_list    = ('list of identifiers of records to get (can be a file)',  'option', 'i'),
+    jobs       = ('use "J" threads for each record stage (default: 1)',    'option', 'j'),
     keep_going = ('do not stop if encounter missing records or errors',     'flag',   'k'),
     lastmod    = ('only get records modified after given date/time',        'option', 'l'),
+    pool_size  = ('max. connections kept open to server (default: 10)',     'option', 'm'),
     name_base  = ('prefix names with "N-" when naming record directories',  'option', 'n'),
     output_dir = ('write output to directory "O"',                          'option', 'o'),
+    oai_url    = ('get list of records from OAI-PMH server at URL "O"',     'option', 'O'),
     quiet      = ('do not print informational messages while working',      'flag',   'q'),
+    rate_limit = ('make at most "R" requests/second to server (default: adapt)', 'option', 'r'),
     status     = ('only get records whose status is in the list "S"',       'option', 's'),
     user       = ('EPrints server user login name "U"',                     'option', 'u'),
+    validation = ('validate bags "full", "fast" or "deferred" (default: full)', 'option', 'v'),
     password   = ('EPrints server user password "P"',                       'option', 'p'),
     arch_type  = ('use archive type "T" (default: "uncompressed-zip")',     'option', 't'),
+    download_workers = ('download "W" files of a record at once (default: 1)', 'option', 'w'),
+    stage_workers = ('worker counts for fetch,download,bag,archive stages', 'option', 'W'),
+    direct     = ('write record bags straight into archive files',         'flag',   'A'),
     no_color   = ('do not color-code terminal output',                      'flag',   'C'),
+    prefilter  = ('apply -l and -s using single-field requests first',      'flag',   'F'),
+    hash_engine = ('compute checksums using "threads" or "processes"',      'option', 'H'),
     no_keyring = ('do not store credentials in a keyring service',          'flag',   'K'),
     reset_keys = ('reset user and password used',                           'flag',   'R'),
     version    = ('print version info and exit',                            'flag',   'V'),
+    cache_dir  = ('cache record metadata in directory "X"',                 'option', 'x'),
+    cache_size = ('max. size of the metadata cache in MB (default: 1024)',  'option', 'X'),
+    state_db   = ('record progress in database file "Y" (for resuming)',   'option', 'y'),
+    store_dir  = ('keep downloaded documents in store directory "Z"',      'option', 'z'),
+    store_size = ('max. size of the document store in MB (default: 10240)', 'option', 'Z'),
     debug      = ('write detailed trace to "OUT" ("-" means console)',      'option', '@'),
 )
 
 def main(api_url = 'A', bag_action = 'B', processes = 'C', diff_with = 'D',
-         end_action = 'E', id_list = 'I', keep_going = False, lastmod = 'L',
-         name_base = 'N', output_dir = 'O', quiet = False, status = 'S',
-         user = 'U', password = 'P', arch_type = 'T', no_color = False,
-         no_keyring = False, reset_keys = False, version = False, debug = 'OUT'):
+         end_action = 'E', fetch_limit = 'F', id_list = 'I', jobs = 'J',
+         keep_going = False, lastmod = 'L', pool_size = 'M', name_base = 'N',
+         output_dir = 'O', oai_url = 'O', quiet = False, rate_limit = 'R',
+         status = 'S', user = 'U', validation = 'V', password = 'P',
+         arch_type = 'T', download_workers = 'W', stage_workers = 'W',
+         direct = False, no_color = False, prefilter = False,
+         hash_engine = 'H', no_keyring = False, reset_keys = False,
+         version = False, cache_dir = 'X', cache_size = 'S', state_db = 'Y',
+         store_dir = 'Z', store_size = 'S', debug = 'OUT'):
     '''eprints2bags bags up EPrints content as BagIt bags.
 
 This program contacts an EPrints REST server whose network API is accessible
@@ -163,19 +216,64 @@ of /path/to/directory/N, /path/to/directory/N.zip, /path/to/directory/N.tar,
 and /path/to/directory/N.tar.gz, or if the -n option is given with a value of
 NAME, for /path/to/directory/NAME-N, /path/to/directory/NAME-N.zip, and so on.
 If no such bag is found, eprints2bags proceeds normally to bag the entire
-contents of the EPrints record; on the other hand, if a previous bag is found
-in the -d directory, eprints2bags will compare its contents to the contents
-retrieved from the EPrints server, and only write the contents that are
-different.  To make it clear that the written bag may not be not complete,
-it will have "-diff" as part of the name.  Option -d is useful when running
-eprints2bags regularly: if you keep the output of a prior run on disk, you
-can re-run eprints2bags with the -d option to make it save only the records
-that have actually changed in content, which may reduce the number of records
-that need to be archived (assume you already archived the prior run).
-
-The lastmod, status, and diff-based filering are done after the -i argument
+contents of the EPrints record.  If a previous bag is found, eprints2bags
+compares it to the record retrieved from the EPrints server: if the record
+has the same identifier, the same XML content or last modification date, and
+the same documents with the same checksums (as listed in the record's XML
+and in the previous bag's manifest), the record is skipped without
+downloading any of its documents.  Otherwise, the record is bagged in full.
+Option -d is useful when running eprints2bags regularly: if you keep the
+output of a prior run on disk, you can re-run eprints2bags with the -d option
+to make it save only the records that have actually changed in content, which
+may reduce the number of records that need to be archived (assume you already
+archived the prior run).
+
+To make comparisons fast, eprints2bags reads the manifests and other tag
+files of all the bags in the -d directory once, at the start of the run,
+directly from the archive files if the bags are archived.  The result is
+saved in a file next to the -d directory, with the same name plus the
+ending ".index.json".  Later runs that compare against the same directory
+reuse the saved index and only read the bags that have changed since it was
+made.
+
+The lastmod, status, and diff-based filtering are done after the -i argument
 is processed.
 
+Without the -i option, eprints2bags gets the list of all records from the
+server, and then has to look at every record to apply the -l filter.  Most
+EPrints servers also provide an OAI-PMH interface, which can list only the
+records changed since a given date.  If the option -O (or /O on Windows) is
+given with the URL of the server's OAI-PMH interface (typically something
+like https://server.institution.edu/cgi/oai2), eprints2bags gets the list of
+records from it instead, asking for only the records changed since the date
+given to -l, if any.  Records that the OAI-PMH server lists as deleted are
+left out.  If -i and -l are both given, only the records that are both in the
+-i list and in the OAI-PMH list of changed records are processed.  The -l
+filter is still applied to each record afterwards, because the OAI-PMH
+interface only selects records by day.
+
+Getting the list of all records from the server can take a long time for a
+large repository.  When the -x option is used, the list is saved in the
+cache directory along with the time it was obtained, and later runs use the
+saved copy for up to 24 hours.  If the -O option is also given, the saved
+list is instead brought up to date on every run by asking the OAI-PMH server
+only for the records added, changed or deleted since the list was saved.
+When the -i option is given, the list of all records is not needed at all,
+and eprints2bags only makes a small request to check that the server can be
+reached with the credentials given.
+
+Normally, the lastmod and status filters are applied to the full record
+obtained from the server, which means the whole record has to be downloaded
+even if it is going to be skipped.  Records with long abstracts or other
+large fields can make this expensive.  If the option -F (or /F on Windows)
+is given, eprints2bags first asks the server for only the values of the
+lastmod and eprint_status fields of each record (using the EPrints REST API's
+access to individual fields, such as /eprint/N/lastmod.txt), and only
+downloads the full record if it passes the filters.  If the server does not
+provide a field value this way, the filter is applied to the full record as
+usual.  This option is worthwhile when many records are expected to be
+filtered out; otherwise, it adds one or two small requests per record.
+
 By default, if an error occurs when requesting a record from the EPrints
 server, it stops execution of eprints2bags.  Common causes of errors include
 missing records implied by the arguments to -i, missing files associated with
@@ -236,6 +334,18 @@ because file corruption is generally more damaging to a compressed archive
 than an uncompressed one.  Since the main use case for eprints2bags is to
 archive contents for long-term storage, avoiding compression seems safer.
 
+Normally, the files of a record are first written to a directory, which is
+then turned into a bag and finally copied into an archive file, after which
+the directory is deleted.  If the option -A (/A on Windows) is given together
+with "bag-and-archive" mode, eprints2bags skips the directory and writes each
+record's bag straight into its archive file: the record XML and documents are
+put into the archive as they are downloaded, and the BagIt tag files are added
+at the end from the checksums computed along the way.  Each byte of a record
+is then written to disk only once, and no more disk space is needed than for
+the archive file itself.  With -A, the documents of a record are downloaded one
+at a time (option -w has no effect), and downloads that are interrupted cannot
+be resumed.  The bag is not validated separately from the archive file.
+
 Finally, the overall collection of EPrints records (whether the records are
 bagged and archived, or just bagged, or left as-is) can optionally be itself
 put into a bag and/or put in a ZIP archive.  This behavior can be changed with
@@ -287,10 +397,139 @@ password again even if an entry already exists in the keyring or keychain.
 Other command-line arguments
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+All network requests to the EPrints server made during a run share a single
+pool of persistent connections, so that successive requests do not have to
+open a new connection (and negotiate a new TLS session) each time.  The
+maximum number of connections kept open to the server can be changed using
+the option -m (or /m on Windows); the default is 10.
+
+eprints2bags adjusts the pace of its requests to the server's responses.
+When the server replies that it is receiving too many requests (HTTP code
+429) or is temporarily unavailable (HTTP code 503), all requests to it are
+held back for the time the server asks for in its Retry-After header (or
+for a few seconds, if it doesn't say), and the number of requests made at
+the same time and per second are halved.  They are then gradually raised
+again for as long as the server keeps up.  All threads share the same limits,
+so they back off together.  The option -r (or /r on Windows) sets a fixed
+maximum number of requests per second; by default, the rate is only limited
+after the server has signaled that it is overloaded.
+
+By default, the documents associated with a given record are downloaded one
+after the other.  Records with many documents can be fetched faster by
+downloading several of their documents at the same time.  The option -w (or
+/w on Windows) sets the number of documents of a record that are downloaded
+concurrently.  Errors are reported the same way as when downloading one file
+at a time: the error reported is the one for the earliest document in the
+record's list of documents.
+
+Each document is downloaded to a temporary file whose name ends in ".part",
+and is given its real name only after the download is complete and its size
+has been checked against what the server reported and against the file size
+listed in the EPrints record.  If a download is interrupted, the next attempt
+(including one made by a later run of eprints2bags writing to the same output
+directory) asks the server for only the remaining part of the file, provided
+the server's copy has not changed in the meantime.
+
+Records are normally processed one at a time, and each record goes through
+four stages in turn: fetching its metadata (and filtering it), downloading its
+documents, bagging, and archiving.  The option -j (or /j on Windows) makes
+eprints2bags run each of those stages on a pool of that many threads, with
+the stages working concurrently on different records.  For example, while
+one record is being bagged, the documents of the next can be downloading.
+The option -W (or /W on Windows) sets the number of threads for each stage
+separately, as four comma-separated numbers for the fetch, download, bag and
+archive stages in that order (e.g., -W 8,4,2,2); it overrides -j.  Records
+waiting between stages are held in queues of limited size, so that a slow
+stage makes the stages before it wait rather than letting unprocessed records
+accumulate in memory or on disk.  The numbers of skipped and missing records,
+and the lists of them printed at the end of the run, are the same as when
+records are processed one at a time, and are reported in the order in which
+the records were requested.  Option -j or -W can be combined with -w, in which
+case many documents may be downloaded at the same time.
+
+Fetching the metadata of a record is mostly a matter of waiting for the
+server to respond, and when the -l or -s filters are used, many records are
+fetched only to be skipped.  The option -f (or /f on Windows) makes
+eprints2bags fetch the XML of upcoming records ahead of time, with up to the
+given number of requests in flight at once.  Each request in flight takes up
+a thread while it waits for the server, so the value can be at most 64; a few
+dozen are usually enough to keep a server busy.  The records are still
+filtered and processed in the order they were requested, and only those that
+pass the filters go on to the document download and bagging stages.
+
+If the option -x (or /x on Windows) is given, eprints2bags keeps a copy of
+the XML of every record it fetches in a cache in the given directory, along
+with the values the server supplied for detecting changes (the HTTP ETag and
+Last-Modified headers).  On later runs using the same cache directory,
+eprints2bags asks the server to send a record only if it has changed since it
+was cached, and otherwise uses the cached copy.  This can greatly reduce the
+time and bandwidth needed for regular incremental runs.  The option -X (or /X
+on Windows) sets the maximum size of the cache in megabytes (default: 1024);
+when the cache grows beyond that size, the least recently used records are
+removed from it.
+
+The same document is sometimes attached to more than one record.  If the
+option -z (or /z on Windows) is given, eprints2bags keeps every document it
+downloads in a store in the given directory, filed under the document's
+SHA-256 checksum.  When a record refers to a document URL that is already in
+the store with the same file size (and MD5 checksum, if any) as listed in
+the record, the stored copy is used instead of downloading it again.
+Documents are placed in the record directories as hard links to the stored
+files, so that a shared document takes up disk space only once; for this to
+work, the store directory must be on the same file system as the output
+directory (but it should not be inside the output directory, or else it will
+be included by the -e option).  Otherwise, the documents are copied.  The
+option -Z (or /Z on Windows) sets the maximum size of the store in megabytes
+(default: 10240).  The limit applies to documents that are only in the
+store; documents that are still hard-linked into record directories or bags
+take up no additional space and are not counted.  When the store grows beyond
+the limit, the least recently used of those documents are removed from it.
+
+If the option -y (or /y on Windows) is given, eprints2bags keeps a record of
+its progress in an SQLite database in the given file: for every record, its
+last modification date, status, list of documents, file checksums, the path
+of the bag or archive written for it, and whether it was written, skipped or
+missing.  If a run is interrupted, running eprints2bags again with the same
+database file resumes the interrupted run: the records it already wrote are
+not processed again.  If the previous run finished normally, the next run
+skips the records whose last modification date is unchanged since they were
+last written, which makes regular incremental harvests faster.  (To process
+all records again, use a new database file.)
+
 Generating checksum values can be a time-consuming operation for large bags.
-By default, during the bagging step, eprints2bags will use a number of
-processes equal to one-half of the available CPUs on the computer.  The number
-of processes can be changed using the option -c (or /c on Windows).
+To avoid reading every file back from disk, eprints2bags computes the
+checksums of each record's XML file and documents while it writes and
+downloads them, and uses those values when it creates the record's bag.
+Checksums that still have to be computed from files on disk (e.g., for the
+overall bag made with -e) are computed by a pool of workers that is started
+once and shared by all bags.  By default, the workers are threads, each of
+which reads a file once and computes all the checksums from the same data.
+The number of threads is the number of CPUs on the computer, or 2 if the
+output directory is on a rotating disk.  Option -H processes (or /H on
+Windows) makes eprints2bags use worker processes instead.  Each file is
+still read once; each large file is a task of its own, small files are
+grouped into tasks of about 16 MB, and the tasks are handed out largest
+first.  The default number of processes is one-half of the number of CPUs.
+The number of workers can be changed using the option -c (or /c on Windows).
+The rate at which checksums were computed (in MB/s) is reported at the end of
+the run.
+
+After a bag is made, and after it is put into an archive file, it is
+checked.  How thoroughly is set by the option -v (or /v on Windows):
+"full" (the default) reads every file of the bag back and compares its
+checksums to those in the manifests, and reads every archive file once from
+start to end, checking the files in it against the same checksums and
+against the CRCs stored in the archive (the speed of this is reported at
+the end of the run); "fast" only checks that all the files listed in the
+bag's manifests are present and that their number and total size match the
+bag's Payload-Oxum value, and that the table of contents of an archive file
+can be read; "deferred" makes the fast checks right away and hands the full
+checks to a background thread, which works through them while the next
+records are processed.  Failures found by deferred checks are reported
+after all records have been processed.  (The checksums in the manifests are
+computed from the data as it is written, so the fast checks catch most
+problems at a fraction of the cost of the full ones, but only the full
+checks detect files that were damaged after they were written.)
 
 eprints2bags will print messages as it works.  To reduce the number of
 messages to warnings and errors, use the option -q (or /q on Windows).  Also,
@@ -394,6 +633,11 @@ Command-line options summary
             alert_fatal(f'Unable to parse lastmod value: {str(ex)}. {hint}')
             exit(int(ExitCode.bad_arg))
 
+    oai_url = None if oai_url == 'O' else oai_url
+    if oai_url and not oai_url.startswith('http'):
+        alert_fatal(f'Argument to {prefix}O must be a full URL.')
+        exit(int(ExitCode.bad_arg))
+
     given_output_dir = not (output_dir == 'O')
     if output_dir == 'O':
         output_dir = os.getcwd()
@@ -425,6 +669,9 @@ Command-line options summary
     if end_action not in _RECOGNIZED_ACTIONS:
         alert_fatal(f'Value of {prefix}b option not recognized. {hint}')
         exit(int(ExitCode.bad_arg))
+    if direct and bag_action in ['none', 'bag']:
+        alert_fatal(f'Option {prefix}A requires {prefix}b bag-and-archive. {hint}')
+        exit(int(ExitCode.bad_arg))
     if end_action != "none" and not given_output_dir:
         alert_fatal(f'Please specify an output directory when using -e "{end_action}"')
         exit(int(ExitCode.bad_arg))
@@ -439,26 +686,120 @@ Command-line options summary
     if status_negation:                 # Remove the '^' if it's there.
         status[0] = status[0][1:]
 
-    procs = int(max(1, cpu_count()/2 if processes == 'C' else int(processes)))
+    validation = 'full' if validation == 'V' else validation.lower()
+    if validation not in _RECOGNIZED_VALIDATIONS:
+        alert_fatal(f'Value of {prefix}v option not recognized. {hint}')
+        exit(int(ExitCode.bad_arg))
+    hash_engine = 'threads' if hash_engine == 'H' else hash_engine.lower()
+    if hash_engine not in _RECOGNIZED_HASH_ENGINES:
+        alert_fatal(f'Value of {prefix}H option not recognized. {hint}')
+        exit(int(ExitCode.bad_arg))
+    if processes != 'C':
+        procs = int(processes)
+    elif hash_engine == 'processes':
+        procs = int(max(1, cpu_count()/2))
+    else:
+        # Many threads reading at once make a rotating disk seek constantly.
+        disk_dir = output_dir if path.exists(output_dir) else path.dirname(output_dir)
+        procs = 2 if rotational_disk(disk_dir) else cpu_count()
+    if procs < 1:
+        alert_fatal(f'Value of {prefix}c option must be a positive integer. {hint}')
+        exit(int(ExitCode.bad_arg))
+    workers = 1 if download_workers == 'W' else int(download_workers)
+    if workers < 1:
+        alert_fatal(f'Value of {prefix}w option must be a positive integer. {hint}')
+        exit(int(ExitCode.bad_arg))
+    jobs = 1 if jobs == 'J' else int(jobs)
+    if jobs < 1:
+        alert_fatal(f'Value of {prefix}j option must be a positive integer. {hint}')
+        exit(int(ExitCode.bad_arg))
+    threaded = jobs > 1 or stage_workers != 'W'
+    stage_workers = parsed_stage_workers(stage_workers, jobs)
+    if not stage_workers:
+        alert_fatal(f'Value of {prefix}W option must be 4 positive integers. {hint}')
+        exit(int(ExitCode.bad_arg))
+    fetch_limit = 1 if fetch_limit == 'F' else int(fetch_limit)
+    if not 1 <= fetch_limit <= _MAX_FETCH_LIMIT:
+        alert_fatal(f'Value of {prefix}f option must be an integer from 1 to'
+                    + f' {_MAX_FETCH_LIMIT}. {hint}')
+        exit(int(ExitCode.bad_arg))
+    connections = fetch_limit + stage_workers[0] + stage_workers[1] * workers
+    pool_size = max(10, connections) if pool_size == 'M' else int(pool_size)
+    if pool_size < 1:
+        alert_fatal(f'Value of {prefix}m option must be a positive integer. {hint}')
+        exit(int(ExitCode.bad_arg))
+    rate_limit = None if rate_limit == 'R' else float(rate_limit)
+    if rate_limit != None and rate_limit <= 0:
+        alert_fatal(f'Value of {prefix}r option must be a positive number. {hint}')
+        exit(int(ExitCode.bad_arg))
+    if cache_dir != 'X':
+        if not path.isabs(cache_dir):
+            cache_dir = path.realpath(path.join(os.getcwd(), cache_dir))
+        if path.exists(cache_dir) and not (path.isdir(cache_dir) and writable(cache_dir)):
+            alert_fatal(f'Value of {prefix}x option is not a writable directory: {cache_dir}')
+            exit(int(ExitCode.file_error))
+        cache_size = 1024 if cache_size == 'S' else float(cache_size)
+        server_dir = path.join(cache_dir, url_host(api_url) or 'server')
+        cache = RecordCache(path.join(server_dir, 'records'), int(cache_size * 1024 * 1024))
+        listing_cache = ListingCache(path.join(server_dir, 'listing.json'))
+    else:
+        cache = None
+        listing_cache = None
+    if store_dir != 'Z':
+        if not path.isabs(store_dir):
+            store_dir = path.realpath(path.join(os.getcwd(), store_dir))
+        if path.exists(store_dir) and not (path.isdir(store_dir) and writable(store_dir)):
+            alert_fatal(f'Value of {prefix}z option is not a writable directory: {store_dir}')
+            exit(int(ExitCode.file_error))
+        store_size = 10240 if store_size == 'S' else float(store_size)
+        store = BlobStore(store_dir, int(store_size * 1024 * 1024))
+    else:
+        store = None
+    if state_db != 'Y':
+        if not path.isabs(state_db):
+            state_db = path.realpath(path.join(os.getcwd(), state_db))
+        if not writable(path.dirname(state_db)):
+            alert_fatal(f'Cannot write database file in {path.dirname(state_db)}')
+            exit(int(ExitCode.file_error))
+    else:
+        state_db = None
     user = None if user == 'U' else user
     password = None if password == 'P' else password
     prefix = '' if name_base == 'N' else name_base + '-'
 
     # Do the real work --------------------------------------------------------
 
+    session = new_session(pool_size, rate_limit)
+    state = RunState(state_db) if state_db else None
+    hasher = new_hasher(hash_engine, procs)
+    verifier = Verifier() if validation == 'deferred' else None
     try:
         if not user or not password:
             user, password = credentials(api_url, user, password, use_keyring, reset_keys)
-        if __debug__: log(f'testing server URL {api_url}')
-        raw_list = eprints_raw_list(api_url, user, password)
-        if raw_list == None:
-            alert_fatal(f'Did not get a server response from {api_url}')
-            exit(int(ExitCode.server_error))
-        if not wanted:
-            inform(f'Fetching full records list from {api_url}')
-            wanted = eprints_records_list(raw_list)
-
-        inform(f'Will process {pluralized("EPrints record", wanted, True)}.')
+        if oai_url and lastmod:
+            inform(f'Fetching list of records changed since {lastmod_str} from {oai_url}')
+            changed = list(oai_identifiers(oai_url, lastmod, session))
+            if wanted:
+                changed = set(changed)
+                wanted = [number for number in wanted if number in changed]
+            else:
+                wanted = changed
+        elif not wanted:
+            wanted = records_list(api_url, user, password, session, oai_url, listing_cache)
+            if wanted == None:
+                alert_fatal(f'Did not get a server response from {api_url}')
+                exit(int(ExitCode.server_error))
+        # Only a list of records from the server is proof that it works.
+        if isinstance(wanted, list) and wanted:
+            if __debug__: log(f'testing server URL {api_url}')
+            if not eprints_server_ok(api_url, user, password, wanted[0], session):
+                alert_fatal(f'Did not get a server response from {api_url}')
+                exit(int(ExitCode.server_error))
+
+        if isinstance(wanted, list):
+            inform(f'Will process {pluralized("EPrints record", wanted, True)}.')
+        else:
+            inform('Will process all records listed by the server.')
         if lastmod:
             inform(f'Will only keep records modified after {lastmod_str}.')
         if status:
@@ -466,56 +807,272 @@ Command-line options summary
                    + fmt_statuses(status, status_negation))
         if previous_dir:
             inform(f'Will only keep records that differ from those in {previous_dir}')
+            previous = BagIndex(previous_dir)
+        else:
+            previous = None
 
         inform(f'Will {"skip" if keep_going else "stop upon encountering"} missing records. {hint}')
         inform(f'Output will be written under directory {output_dir}')
         make_dir(output_dir)
 
         inform('─'*os.get_terminal_size(0)[0])
-        missing = skipped = []
-        for number in wanted:
+        def unwanted_status(value):
+            return ((not status_negation and value not in status)
+                    or (status_negation and value in status))
+
+        def rejected(number, info):
+            # Return the reason to skip record 'number' based on the fields
+            # in 'info' that are known so far, or None if there's none yet.
+            if lastmod and info.lastmod != None and info.lastmod < lastmod:
+                return f"{number} hasn't been modified since {lastmod_str} -- skipping"
+            if status and info.status != None and unwanted_status(info.status):
+                return f'{number} has status "{info.status}" -- skipping'
+            return None
+
+        def filtered_out(job):
+            # Try to make the filter decisions using requests for the single
+            # fields involved, which are much smaller than the full record.
+            # When a field can't be obtained that way, the decision is left
+            # to the checks on the full record in fetch().
+            info = RecordInfo()
+            if lastmod:
+                value = eprints_field(job.number, 'lastmod', api_url, user, password, session)
+                info.lastmod = parsed_datetime(value) if value else None
+                reason = rejected(job.number, info)
+                if reason:
+                    # No need to ask for the status too.
+                    return reason
+            if status:
+                info.status = eprints_field(job.number, 'eprint_status', api_url, user,
+                                            password, session)
+            return rejected(job.number, info)
+
+        def get_xml(job):
+            stop = None
+            if lastmod or status:
+                if prefilter:
+                    job.skip_reason = filtered_out(job)
+                    if job.skip_reason:
+                        return None
+                # Stop downloading the record as soon as the filters reject it.
+                stop = lambda info: rejected(job.number, info)
+            inform(f'[white]Getting record with id {job.number}[/]')
+            return eprints_xml(job.number, api_url, user, password, keep_going,
+                               session, cache, stop)
+
+        def prefetched(jobs_list):
+            # Fetch the XML of upcoming records concurrently, ahead of the
+            # fetch stage, which then only has to apply the filters.
+            for job, record, error in crawled(jobs_list, get_xml, fetch_limit):
+                job.prefetched = (record, error)
+                yield job
+
+        def fetch(job):
             # Start by getting the full record in EP3 XML format.  A failure
             # here will either cause an exit or moving to the next record.
-            inform(f'[white]Getting record with id {number}[/]')
-            xml = eprints_xml(number, api_url, user, password, keep_going)
-            if xml == None:
-                missing.append(number)
-                continue
-            if lastmod and eprints_lastmod(xml) < lastmod:
-                inform(f"{number} hasn't been modified since {lastmod_str} -- skipping")
-                skipped.append(number)
-                continue
-            if status and ((not status_negation and eprints_status(xml) not in status)
-                           or (status_negation and eprints_status(xml) in status)):
-                inform(f'{number} has status "{eprints_status(xml)}" -- skipping')
-                skipped.append(number)
-                continue
-            if diff_with:
-                pass
-
-            # Good so far.  Create the directory and write the XML out.
-            record_dir = path.join(output_dir, prefix + str(number))
-            inform(f'Creating {record_dir}')
-            make_dir(record_dir)
-            write_record(number, xml, prefix, record_dir)
-
+            number = job.number
+            if job.prefetched:
+                record, error = job.prefetched
+                job.prefetched = None
+                if error:
+                    raise error
+            else:
+                record = get_xml(job)
+            if job.skip_reason:
+                inform(job.skip_reason)
+                settle(job, 'skipped')
+                if state:
+                    state.record(number, 'skipped')
+                return False
+            if record == None:
+                settle(job, 'missing')
+                if state:
+                    state.record(number, 'missing')
+                return False
+            try:
+                return write(job, record)
+            finally:
+                record.close()
+
+        def write(job, record):
+            # The record was parsed while it was downloaded, to get the
+            # field values we need.  (If it was rejected by the filters, the
+            # download was stopped early, and the record is incomplete.)
+            number = job.number
+            info = record.info
+            reason = rejected(number, info)
+            if reason:
+                inform(reason)
+                settle(job, 'skipped')
+                if state:
+                    state.record(number, 'skipped', info.lastmod, info.status)
+                return False
+            if state and state.unchanged(number, info.lastmod):
+                inform(f"{number} hasn't changed since it was last written -- skipping")
+                settle(job, 'skipped')
+                return False
+            if previous and previous.unchanged(prefix + str(number), record):
+                inform(f'{number} is unchanged from its copy in {previous_dir} -- skipping')
+                settle(job, 'skipped')
+                return False
+
+            # Good so far.  Create the directory and write the XML out.  The
+            # record file is written from the bytes sent by the server; after
+            # this, later stages only need job.info.
+            job.info = info
+            job.dir = path.join(output_dir, prefix + str(number))
+            if direct:
+                # The directory is never created; its name is used for the
+                # bag inside the archive file.
+                archive_file = job.dir + archive_extension(archive_fmt)
+                inform(f'Writing archive file {archive_file}')
+                job.writer = BagArchiveWriter(archive_file, archive_fmt,
+                                              path.basename(job.dir), _BAG_CHECKSUMS,
+                                              archive_algorithms)
+                name = prefix + str(number) + '.xml'
+                try:
+                    job.digests = {name: job.writer.add(name, record_content(record.content))}
+                except Exception:
+                    job.writer.abort()
+                    raise
+                return True
+            inform(f'Creating {job.dir}')
+            make_dir(job.dir)
+            name, digests = write_record(number, record.content, prefix, job.dir, checksums)
+            job.digests = {name: digests}
+            return True
+
+        def download(job):
             # Download any documents referenced in the XML record.
-            docs = eprints_documents(xml)
-            download_files(docs, user, password, record_dir, keep_going)
-
-            # Bag it and archive it, depending on user choice.
-            bag_and_archive(record_dir, bag_action, archive_fmt, procs, xml, api_url)
+            if direct:
+                try:
+                    job.digests.update(stream_files(job.info.documents, user, password,
+                                                    job.writer, keep_going, session,
+                                                    job.info.sizes, store,
+                                                    job.info.hashes))
+                except Exception:
+                    job.writer.abort()
+                    raise
+                return True
+            job.digests.update(download_files(job.info.documents, user, password, job.dir,
+                                              keep_going, session, workers, checksums,
+                                              job.info.sizes, store,
+                                              job.info.hashes))
+            return finished(job, bag_action == 'none')
+
+        def bag(job):
+            if direct:
+                # The tag files go into the archive too, which completes it,
+                # so there's nothing left for the archive stage to do.
+                digests = finish_archive(job.writer, archive_fmt, job.info, api_url,
+                                         validation, verifier, verified)
+                if digests:
+                    with outcome_lock:
+                        archive_digests[job.writer.archive_file] = digests
+                return finished(job, True)
+            job.bag = make_bag(job.dir, hasher, job.info, api_url, job.digests, validation)
+            if verifier and bag_action == 'bag':
+                verifier.add(job.bag.path, job.bag.validate)
+            return finished(job, bag_action == 'bag')
+
+        def archive(job):
+            digests = make_archive(job.bag, archive_fmt, job.info, api_url, validation,
+                                   verifier, archive_algorithms, verified)
+            if digests:
+                with outcome_lock:
+                    archive_digests[job.bag.path + archive_extension(archive_fmt)] = digests
+            return finished(job, True)
+
+        def finished(job, done):
+            if done:
+                settle(job, 'written')
+                if state:
+                    if bag_action == 'bag-and-archive':
+                        written = job.dir + archive_extension(archive_fmt)
+                    else:
+                        written = job.dir
+                    state.record(job.number, 'written', job.info.lastmod, job.info.status,
+                                 job.info.documents, job.digests, written)
+                job.info = job.bag = job.digests = job.writer = None
+            return not done
+
+        def abandoned(job):
+            # The pipeline dropped the job because an earlier record failed.
+            if job.writer:
+                job.writer.abort()
+
+        def wanted_jobs(numbers):
+            # The numbers may still be arriving from the server, so only the
+            # records that were passed over are remembered for the report.
+            for position, number in enumerate(numbers):
+                job = RecordJob(number, position)
+                if state and state.resuming and state.done(number):
+                    # Written by the interrupted run; no need to redo it.
+                    settle(job, 'written')
+                else:
+                    yield job
+
+        counts = defaultdict(int)
+        archive_digests = {}
+        verified = Throughput()
+        passed_over = defaultdict(list)
+        outcome_lock = Lock()
+        def settle(job, outcome):
+            with outcome_lock:
+                counts[outcome] += 1
+                if outcome != 'written':
+                    passed_over[outcome].append((job.position, job.number))
+
+        # Checksums are computed as files are written, for use in the bags.
+        # The checksums of archive files are only needed for the overall bag
+        # made at the end, if there is one.
+        checksums = _BAG_CHECKSUMS if bag_action != 'none' else None
+        archive_algorithms = _BAG_CHECKSUMS if end_action != 'none' else None
+        stages = [Stage(name, func, count) for name, func, count
+                  in zip(_PIPELINE_STAGES, [fetch, download, bag, archive], stage_workers)]
+        if state and state.resuming:
+            inform('Resuming interrupted run: will skip records it already wrote.')
+        source = prefetched(wanted_jobs(wanted)) if fetch_limit > 1 else wanted_jobs(wanted)
+        Pipeline(stages, threaded = threaded, discard = abandoned).run(source)
+        if verifier:
+            inform('Waiting for the deferred validation of bags and archives to finish.')
+            failures = verifier.finish()
+        missing = [number for _, number in sorted(passed_over['missing'])]
+        skipped = [number for _, number in sorted(passed_over['skipped'])]
 
         inform('─'*os.get_terminal_size(0)[0])
-        count = len(wanted) - len(missing) - len(skipped)
+        if __debug__: log(f'rate limiter state: {session.limiter.status(urlsplit(api_url).netloc)}')
+        count = counts['written']
         inform(f'Wrote {pluralized("EPrints record", count, True)} to {output_dir}')
         if len(skipped) > 0:
             inform('The following records were skipped: '+ ', '.join(skipped) + '.')
         if len(missing) > 0:
             warn('The following records were not found: '+ ', '.join(missing) + '.')
-
-        # Bag the whole result and archive it, depending on user choice.
-        bag_and_archive(output_dir, end_action, archive_fmt, procs, None, api_url)
+        if verifier:
+            for name, error in failures:
+                alert(f'Validation of {name} failed: {str(error)}')
+            if failures:
+                alert_fatal(f'{pluralized("bag or archive", failures, True)} failed validation')
+                exit(int(ExitCode.file_error))
+
+        # Bag the whole result and archive it, depending on user choice.  The
+        # manifests of the overall bag are made from the checksums already
+        # known for the record bags and archives, instead of rehashing them.
+        # (When validation is deferred, the full checks of the records have
+        # been done by now, so a fast check of the overall bag suffices.)
+        if end_action != 'none':
+            known = collection_digests(output_dir, archive_digests)
+            final_validation = 'fast' if validation == 'deferred' else validation
+            bag_and_archive(output_dir, end_action, archive_fmt, hasher, None, api_url,
+                            final_validation, known, verified)
+        if hasher.stats.bytes:
+            inform(f'Computed checksums of {intcomma(hasher.stats.bytes)} bytes at'
+                   + f' {hasher.stats.rate():.1f} MB/s.')
+        if verified.bytes:
+            inform(f'Verified {intcomma(verified.bytes)} bytes of archive files at'
+                   + f' {verified.rate():.1f} MB/s.')
+        if state:
+            state.finish()
 
     except KeyboardInterrupt as ex:
         alert('Quitting')
@@ -533,11 +1090,92 @@ Command-line options summary
         else:
             alert_fatal(f'{str(ex)}')
         exit(int(ExitCode.exception))
+    finally:
+        session.close()
+        hasher.close()
+        if state:
+            state.close()
 
 
 # Helper functions.
 # ......................................................................
 
+class RecordJob(object):
+    '''State of one EPrints record as it moves through the pipeline stages.'''
+
+    __slots__ = ('number', 'position', 'prefetched', 'skip_reason', 'info', 'dir',
+                 'digests', 'bag', 'writer')
+
+    def __init__(self, number, position):
+        self.number      = number
+        self.position    = position
+        self.prefetched  = None
+        self.skip_reason = None
+        self.info        = None
+        self.dir         = None
+        self.digests     = None
+        self.bag         = None
+        self.writer      = None
+
+
+def records_list(api_url, user, password, session, oai_url, listing_cache):
+    '''Return the list of all records on the server, as a list or (when it is
+    being read from the server as it arrives) an iterator of record numbers.
+    Returns None if the server doesn't respond with a list.  If 'listing_cache'
+    is not None, it is used to avoid getting the list again if it is recent
+    enough, or to get only the changes since then if 'oai_url' is not None.'''
+    started = datetime.now(timezone.utc)
+    cached = listing_cache.load() if listing_cache else None
+    if cached and oai_url:
+        timestamp, numbers = cached
+        inform(f'Updating cached list of records with changes from {oai_url}')
+        numbers = set(numbers)
+        for number, deleted in oai_changes(oai_url, timestamp, session):
+            if deleted:
+                numbers.discard(number)
+            else:
+                numbers.add(number)
+        numbers = sorted(numbers, key = int)
+        listing_cache.save(numbers, started)
+        return numbers
+    if cached and started - cached[0] < _LISTING_MAX_AGE:
+        inform('Using cached list of records obtained '
+               + cached[0].astimezone().strftime(_LASTMOD_PRINT_FORMAT))
+        return cached[1]
+    if oai_url:
+        inform(f'Fetching list of records from {oai_url}')
+        numbers = list(oai_identifiers(oai_url, None, session))
+        if listing_cache:
+            listing_cache.save(numbers, started)
+        return numbers
+    inform(f'Fetching full records list from {api_url}')
+    listing = eprints_records_list(api_url, user, password, session)
+    if listing == None or not listing_cache:
+        return listing
+    return _saved_listing(listing, listing_cache, started)
+
+
+def _saved_listing(listing, listing_cache, started):
+    # Pass the numbers along as they arrive, and save the list at the end.
+    numbers = []
+    for number in listing:
+        numbers.append(number)
+        yield number
+    listing_cache.save(numbers, started)
+
+
+def parsed_stage_workers(value, default):
+    '''Parse a comma-separated list of worker counts for the pipeline stages.
+    Returns None if the value can't be parsed.'''
+    if value == 'W':
+        return [default] * len(_PIPELINE_STAGES)
+    counts = value.split(',')
+    if len(counts) != len(_PIPELINE_STAGES) or not all(c.isdigit() for c in counts):
+        return None
+    counts = [int(c) for c in counts]
+    return counts if all(c >= 1 for c in counts) else None
+
+
 def parsed_id_list(id_list):
     # If it's a single digit, asssume it's not a file and return the number.
     if id_list.isdigit():
@@ -603,45 +1241,105 @@ def password(prompt):
         return sys.stdin.readline().rstrip()
 
 
-def bag_and_archive(directory, action, archive_fmt, processes, xml, url):
-    # If xml != None, we're dealing with a record, else the top-level directory.
+def bag_and_archive(directory, action, archive_fmt, hasher, record, url,
+                    validation = 'full', digests = None, stats = None):
+    # If record != None, we're dealing with a record, else the top-level directory.
     if action != 'none':
-        inform(f'Making bag out of {directory}')
-        # Don't use large # of processes b/c creating the process pool is
-        # expensive.  If procs = 32 and most of our records have only 1-2
-        # files, make_bag() will still create a pool of 32 each time.  The
-        # following tries to balance things out for the most common case.
-        # Note: this uses listdir to avoid walking down the directory tree,
-        # but if a given entry is the root of a large subdirectory, then this
-        # may fail to use multiple processes when it would be good to do so.
-        procs = 1 if len(os.listdir(directory)) < processes else processes
-        bag = bagit.make_bag(directory, checksums = _BAG_CHECKSUMS, processes = procs)
-        if xml != None:
-            # The official_url field is not always present in the record.
-            # Try to get it, and default to using the eprints record id.
-            official_url = eprints_official_url(xml)
-            record_id = eprints_record_id(xml)
-            extern_id = official_url if official_url else record_id
-            bag.info['Internal-Sender-Identifier'] = record_id
-            bag.info['External-Identifier'] = extern_id
-            bag.info['External-Description'] = 'Single EPrints record and associated document files'
-        else:
-            # Case: the overall bag for the whole directory
-            bag.info['External-Identifier'] = url
-            bag.info['External-Description'] = 'Collection of EPrints records and their associated document files'
-        bag.save()
+        bag = make_bag(directory, hasher, record, url, digests, validation)
+        if action == 'bag-and-archive':
+            make_archive(bag, archive_fmt, record, url, validation, stats = stats)
+
+
+def make_bag(directory, hasher, record, url, digests = None, validation = 'full'):
+    '''Turn 'directory' into a BagIt bag, validate it, and return the bag.
+    'Record' is the RecordInfo of the EPrints record in 'directory', or None
+    if 'directory' is the top-level output directory.
+    If 'digests' is not None, it must be a dict mapping file paths relative
+    to 'directory' to dicts of checksums (as produced while downloading), and
+    the bag manifests are written from those values instead of rereading the
+    files.  Other checksums are computed using the Hasher 'hasher'.  If
+    'validation' is "full", the bag is validated by recomputing the checksums
+    of all its files; otherwise, only the presence, number and total size of
+    the files are checked.'''
+    inform(f'Making bag out of {directory}')
+    bag = build_bag(directory, _BAG_CHECKSUMS, bag_info(record, url), digests, hasher)
+    if validation == 'full':
         if __debug__: log(f'verifying bag {bag.path}')
         bag.validate()
-
-        if action == 'bag-and-archive':
-            archive_file = directory + archive_extension(archive_fmt)
-            inform(f'Making archive file {archive_file}')
-            comments = file_comments(bag) if xml != None else dir_comments(bag, url)
-            create_archive(archive_file, archive_fmt, directory, comments)
-            if __debug__: log(f'verifying archive file {archive_file}')
-            verify_archive(archive_file, archive_fmt)
-            if __debug__: log(f'deleting directory {directory}')
-            shutil.rmtree(directory)
+    else:
+        # The checksums in the manifests were computed from the data as it
+        # was written, so rereading the files would mostly repeat that work.
+        # Check that the files listed are present and match Payload-Oxum.
+        if __debug__: log(f'checking completeness of bag {bag.path}')
+        bag.validate(completeness_only = True)
+    return bag
+
+
+def make_archive(bag, archive_fmt, record, url, validation = 'full', verifier = None,
+                 algorithms = None, stats = None):
+    '''Put the 'bag' into an archive file, verify it, and delete the bag.
+    If 'validation' is not "full", only the archive's table of contents is
+    checked right away; in addition, if 'verifier' is not None, the full
+    verification of the archive is handed to that Verifier.  The full
+    verification checks the files in the archive against the checksums in
+    the bag's manifests, and adds its throughput to the Throughput object
+    'stats' if it is not None.  If 'algorithms' is a list of checksum
+    algorithm names, returns a dict of the archive file's checksums, computed
+    while it was written; otherwise, returns None.'''
+    directory = bag.path
+    archive_file = directory + archive_extension(archive_fmt)
+    inform(f'Making archive file {archive_file}')
+    comments = file_comments(bag) if record != None else dir_comments(bag, url)
+    digests = create_archive(archive_file, archive_fmt, directory, comments, algorithms)
+    # The names of the files in the archive start with the bag's name.
+    base = path.basename(directory)
+    members = {base + '/' + name: known for name, known in bag_digests(directory).items()}
+    if __debug__: log(f'verifying archive file {archive_file}')
+    verify_archive(archive_file, archive_fmt, validation != 'full', members, stats)
+    if verifier:
+        verifier.add(archive_file, verify_archive, archive_file, archive_fmt, False,
+                     members, stats)
+    if __debug__: log(f'deleting directory {directory}')
+    shutil.rmtree(directory)
+    return digests
+
+
+def finish_archive(writer, archive_fmt, record, url, validation = 'full', verifier = None,
+                   stats = None):
+    '''Complete the bag being written by the BagArchiveWriter 'writer' and
+    verify the archive file, as make_archive() does for archives made from
+    bag directories.  Returns the archive file's checksums, if 'writer' was
+    asked to compute them; otherwise, returns None.'''
+    archive_file = writer.archive_file
+    try:
+        digests = writer.finish(bag_info(record, url), file_comments)
+    except Exception:
+        writer.abort()
+        raise
+    members = writer.member_digests
+    if __debug__: log(f'verifying archive file {archive_file}')
+    verify_archive(archive_file, archive_fmt, validation != 'full', members, stats)
+    if verifier:
+        verifier.add(archive_file, verify_archive, archive_file, archive_fmt, False,
+                     members, stats)
+    return digests
+
+
+def bag_info(record, url):
+    '''Return a dict of the values for bag-info.txt in the bag of the record
+    whose RecordInfo is 'record', or in the overall bag if 'record' is None.'''
+    if record != None:
+        # The official_url field is not always present in the record.
+        # Try to get it, and default to using the eprints record id.
+        record_id = record.id
+        extern_id = record.official_url if record.official_url else record_id
+        return {'Internal-Sender-Identifier': record_id,
+                'External-Identifier': extern_id,
+                'External-Description': 'Single EPrints record and associated document files'}
+    else:
+        # Case: the overall bag for the whole directory
+        return {'External-Identifier': url,
+                'External-Description': 'Collection of EPrints records and their associated document files'}
 
 
 def file_comments(bag):
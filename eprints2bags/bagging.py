@@ -0,0 +1,439 @@
+'''
+bagging.py: create BagIt bags using checksums that are already known.
+
+The bagit.make_bag() function computes the checksums of every payload file
+by reading the files back from disk.  When the checksums were already
+computed while the files were being written (e.g., during downloading), that
+is wasted effort.  The function build_bag() in this module writes the bag
+manifests from the given checksums and only reads the files for which no
+checksums are supplied.
+
+The class BagArchiveWriter goes one step further and writes a bag straight
+into an archive file, entry by entry, so that the bag's directory never
+exists on disk and every payload byte is written only once.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import bagit
+from   datetime import date
+import os
+from   os import path
+import re
+from   sidetrack import log
+import tarfile
+import tempfile
+from   tempfile import SpooledTemporaryFile
+from   time import localtime, time
+from   zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+
+import eprints2bags
+from   .exceptions import *
+from   .hashing import DigestWriter, MultiDigest, file_digests
+
+
+# Constants.
+# .............................................................................
+
+_BAGIT_VERSION = '0.97'
+'''Version of the BagIt specification followed by the bags written.'''
+
+_BAGIT_TXT = f'BagIt-Version: {_BAGIT_VERSION}\nTag-File-Character-Encoding: UTF-8\n'
+'''Contents of the bagit.txt file written in every bag.'''
+
+_PART_SUFFIX = '.part'
+'''Suffix of the file that BagArchiveWriter writes to until it is done.'''
+
+_COPY_SIZE = 1024 * 1024
+'''Number of bytes read at a time when copying spooled data into an archive.'''
+
+_SPOOL_SIZE = 16 * 1024 * 1024
+'''Entries of unknown size destined for a tar file are kept in memory up to
+this many bytes (and in a temporary file beyond that) until their size is
+known, because a tar header has to give the size before the contents.'''
+
+_ZIP64_LIMIT = (1 << 31) - 1
+'''Entries larger than this, or of unknown size, are written with ZIP64
+extensions.'''
+
+
+# Main functions.
+# .............................................................................
+
+def build_bag(directory, algorithms, bag_info, digests = None, hasher = None):
+    '''Turn 'directory' into a BagIt bag and return a bagit.Bag object for it.
+
+    The contents of 'directory' are moved into a "data" subdirectory, and the
+    usual BagIt tag files are written.  'Algorithms' is a list of checksum
+    algorithm names and 'bag_info' is a dict of values for bag-info.txt.
+    'Digests' is a dict mapping file paths relative to 'directory' (using
+    "/" as the separator, as in BagIt manifests) to dicts of hex digests
+    keyed by algorithm name.  Files for which 'digests' does not have all
+    the checksums needed are read from disk to compute them, using the
+    HashingPool 'hasher' if it is not None.
+    '''
+    directory = path.abspath(directory)
+    digests = digests or {}
+    if __debug__: log(f'building bag in {directory} using {len(digests)} known digests')
+    data_dir = _move_into_data_dir(directory)
+
+    files = [(file, path.relpath(file, data_dir).replace(os.sep, '/'))
+             for file in _walk(data_dir)]
+    unknown = [file for file, relative in files
+               if not all(alg in digests.get(relative, {}) for alg in algorithms)]
+    if hasher:
+        computed = hasher.file_digests(unknown, algorithms)
+    else:
+        computed = {file: file_digests(file, algorithms) for file in unknown}
+
+    manifest = {alg: [] for alg in algorithms}
+    total_bytes = total_files = 0
+    for file, relative in files:
+        if file in computed:
+            known, size = computed[file]
+        else:
+            known, size = digests[relative], os.stat(file).st_size
+        for alg in algorithms:
+            manifest[alg].append((known[alg], 'data/' + relative))
+        total_bytes += size
+        total_files += 1
+
+    for alg, entries in manifest.items():
+        with open(path.join(directory, f'manifest-{alg}.txt'), 'w', encoding = 'utf-8') as f:
+            f.write(_manifest_text(entries))
+
+    with open(path.join(directory, 'bagit.txt'), 'w', encoding = 'utf-8') as f:
+        f.write(_BAGIT_TXT)
+
+    info = _bag_info(bag_info, total_bytes, total_files)
+    write_tag_file(path.join(directory, 'bag-info.txt'), info)
+
+    write_tagmanifests(directory, algorithms)
+    return bagit.Bag(directory)
+
+
+def collection_digests(directory, archive_digests = None):
+    '''Return a dict of the checksums that are already known for the files
+    in 'directory', a directory of record bags and/or archive files, in the
+    form expected by the 'digests' argument of build_bag().  The checksums of
+    the files in each record bag are taken from the bag's own manifests and
+    tag manifests.  'Archive_digests', if not None, must be a dict mapping
+    the paths of archive files in 'directory' to dicts of hex digests keyed
+    by algorithm name, as recorded when the archives were written.  Files
+    for which nothing is known are left out.'''
+    digests = {}
+    archive_digests = archive_digests or {}
+    for entry in os.scandir(directory):
+        if entry.is_dir() and path.exists(path.join(entry.path, 'bagit.txt')):
+            for name, known in bag_digests(entry.path).items():
+                digests[entry.name + '/' + name] = known
+        elif entry.path in archive_digests:
+            digests[entry.name] = archive_digests[entry.path]
+    if __debug__: log(f'found known digests for {len(digests)} files in {directory}')
+    return digests
+
+
+def bag_digests(bag_dir):
+    '''Return a dict mapping the paths of the files in the bag 'bag_dir'
+    (relative to the bag's top directory, with "/" as the separator) to dicts
+    of hex digests keyed by algorithm name, as listed in the bag's manifests
+    and tag manifests.'''
+    digests = {}
+    for name in os.listdir(bag_dir):
+        match = re.match(r'(?:tag)?manifest-(\w+)\.txt$', name)
+        if not match:
+            continue
+        alg = match.group(1)
+        with open(path.join(bag_dir, name), 'r', encoding = 'utf-8') as f:
+            for line in f:
+                if line.strip():
+                    digest, file = line.split(None, 1)
+                    file = file.strip().replace('%0A', '\n').replace('%0D', '\r')
+                    digests.setdefault(file, {})[alg] = digest.lower()
+    return digests
+
+
+def write_tag_file(file, values):
+    '''Write a BagIt tag file (e.g., bag-info.txt) from the dict 'values'.'''
+    with open(file, 'w', encoding = 'utf-8') as f:
+        f.write(_tag_file_text(values))
+
+
+def write_tagmanifests(directory, algorithms):
+    '''Write the tagmanifest files for the bag in 'directory'.'''
+    tag_files = sorted(f for f in os.listdir(directory)
+                       if f != 'data' and not f.startswith('tagmanifest-')
+                       and path.isfile(path.join(directory, f)))
+    checksums = [(name, file_digests(path.join(directory, name), algorithms)[0])
+                 for name in tag_files]
+    for alg in algorithms:
+        with open(path.join(directory, f'tagmanifest-{alg}.txt'), 'w', encoding = 'utf-8') as f:
+            for name, digests in checksums:
+                f.write(f'{digests[alg]} {name}\n')
+
+
+class BagArchiveWriter(object):
+    '''Write a BagIt bag named 'bag_name' straight into the archive file
+    'archive_file' of the given 'type' (as for files.create_archive()).
+
+    The payload files are handed to add() one at a time, as iterators over
+    their contents (e.g., the chunks of a download), and are written into
+    the archive as they arrive while their checksums are computed using the
+    algorithms in 'algorithms'.  Calling finish() then writes the tag files
+    from those checksums and closes the archive.  The bag thus never exists
+    as a directory: each payload byte is written to disk once, and only the
+    archive file takes up space.  If 'archive_algorithms' is not None, the
+    checksums of the archive file itself are computed the same way.
+
+    The archive is written to 'archive_file' plus ".part" and only renamed to
+    'archive_file' by finish(), so a file with the final name is complete.
+    The attribute 'member_digests' maps the names of the files written into
+    the archive to dicts of their hex digests, for use in verifying it.
+    '''
+
+    def __init__(self, archive_file, type, bag_name, algorithms,
+                 archive_algorithms = None):
+        self.archive_file = archive_file
+        self.version      = _BAGIT_VERSION
+        self.info         = {}
+        self.member_digests = {}
+        self._bag_name    = bag_name
+        self._algorithms  = algorithms
+        self._manifest    = {alg: [] for alg in algorithms}
+        self._bytes       = 0
+        self._count       = 0
+        self._zip         = None
+        self._tar         = None
+        if __debug__: log(f'writing bag {bag_name} into {archive_file}')
+        self._file = open(archive_file + _PART_SUFFIX, 'wb')
+        if archive_algorithms:
+            self._out = DigestWriter(self._file, archive_algorithms)
+        else:
+            self._out = self._file
+        if type.endswith('zip'):
+            self._format = ZIP_STORED if type.startswith('uncompress') else ZIP_DEFLATED
+            self._zip = ZipFile(self._out, 'w', self._format)
+        else:
+            mode = 'w|' if type.startswith('uncompress') else 'w|gz'
+            self._tar = tarfile.open(fileobj = self._out, mode = mode,
+                                     copybufsize = _COPY_SIZE)
+            # Give the tar file the same directory entries that tarfile.add()
+            # would have written for a bag directory.
+            for name in [bag_name, bag_name + '/data']:
+                entry = self._tar_info(name)
+                entry.type = tarfile.DIRTYPE
+                entry.mode = 0o755
+                self._tar.addfile(entry)
+
+
+    def add(self, name, chunks, size = None):
+        '''Write the bytes produced by the iterator 'chunks' to the payload
+        file 'name' (a path relative to the bag's "data" directory, using "/"
+        as the separator), and return a dict of its hex digests keyed by
+        algorithm name.  'Size' is the number of bytes expected, if known;
+        if the data turns out to be a different size, CorruptedContent is
+        raised and the archive must be abandoned.'''
+        digest = self._write('data/' + name, chunks, size)
+        digests = digest.hexdigests()
+        for alg in self._algorithms:
+            self._manifest[alg].append((digests[alg], 'data/' + name))
+        self._bytes += digest.size
+        self._count += 1
+        return digests
+
+
+    def finish(self, bag_info, comments = None):
+        '''Write the tag files of the bag, using the dict 'bag_info' for the
+        values in bag-info.txt, and close the archive file.  If 'comments' is
+        not None, it must be a function that is given this object (whose
+        'version' and 'info' attributes are like those of a bagit.Bag) and
+        returns the comment to be stored in a ZIP file.  Returns a dict of the
+        archive file's hex digests if 'archive_algorithms' was given when this
+        object was created; otherwise, returns None.'''
+        self.info = _bag_info(bag_info, self._bytes, self._count)
+        tag_files = [(f'manifest-{alg}.txt', _manifest_text(entries))
+                     for alg, entries in self._manifest.items()]
+        tag_files += [('bagit.txt', _BAGIT_TXT),
+                      ('bag-info.txt', _tag_file_text(self.info))]
+        tag_digests = []
+        for name, text in sorted(tag_files):
+            data = text.encode('utf-8')
+            digest = self._write(name, iter([data]), len(data))
+            tag_digests.append((name, digest.hexdigests()))
+        for alg in self._algorithms:
+            text = ''.join(f'{digests[alg]} {name}\n' for name, digests in tag_digests)
+            data = text.encode('utf-8')
+            self._write(f'tagmanifest-{alg}.txt', iter([data]), len(data))
+        if self._zip and comments:
+            self._zip.comment = comments(self).encode()
+        self._close()
+        os.replace(self.archive_file + _PART_SUFFIX, self.archive_file)
+        if __debug__: log(f'finished writing {self.archive_file}')
+        if isinstance(self._out, DigestWriter):
+            return self._out.hexdigests()
+        return None
+
+
+    def abort(self):
+        '''Close and delete the partly written archive file.'''
+        if __debug__: log(f'abandoning {self.archive_file}')
+        try:
+            self._close()
+        except Exception as ex:
+            if __debug__: log(f'error closing {self.archive_file}: {str(ex)}')
+        part_file = self.archive_file + _PART_SUFFIX
+        if path.exists(part_file):
+            os.remove(part_file)
+
+
+    def _write(self, name, chunks, size):
+        arcname = self._bag_name + '/' + name
+        digest = MultiDigest(self._algorithms)
+        if self._zip:
+            entry = ZipInfo(arcname, localtime()[:6])
+            entry.compress_type = self._format
+            entry.external_attr = 0o644 << 16
+            zip64 = size == None or size > _ZIP64_LIMIT
+            with self._zip.open(entry, 'w', force_zip64 = zip64) as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+        else:
+            spool = None
+            if size == None:
+                spool = SpooledTemporaryFile(_SPOOL_SIZE)
+                for chunk in chunks:
+                    spool.write(chunk)
+                size = spool.tell()
+                spool.seek(0)
+                chunks = iter(lambda: spool.read(_COPY_SIZE), b'')
+            try:
+                entry = self._tar_info(arcname)
+                entry.size = size
+                reader = _ChunkReader(chunks, digest)
+                try:
+                    self._tar.addfile(entry, reader)
+                except OSError as ex:
+                    # tarfile raises this if the data ends before 'size'.
+                    raise CorruptedContent(f'Expected {size} bytes but got'
+                                           + f' {digest.size} for {arcname}')
+                if reader.read(1):
+                    raise CorruptedContent(f'Expected {size} bytes but got'
+                                           + f' more for {arcname}')
+            finally:
+                if spool:
+                    spool.close()
+        if size != None and digest.size != size:
+            raise CorruptedContent(f'Expected {size} bytes but got {digest.size} for {arcname}')
+        self.member_digests[arcname] = digest.hexdigests()
+        return digest
+
+
+    def _tar_info(self, name):
+        entry = tarfile.TarInfo(name)
+        entry.mtime = int(time())
+        entry.mode = 0o644
+        return entry
+
+
+    def _close(self):
+        try:
+            if self._zip:
+                self._zip.close()
+            elif self._tar:
+                self._tar.close()
+        finally:
+            self._file.close()
+
+
+# Helper functions.
+# .............................................................................
+
+def _move_into_data_dir(directory):
+    # This follows the approach used by bagit.make_bag(): move everything
+    # into a temporary subdirectory first, then rename it to "data", in case
+    # the directory already contains something named "data".
+    temp_dir = tempfile.mkdtemp(dir = directory)
+    for entry in os.listdir(directory):
+        entry_path = path.join(directory, entry)
+        if entry_path != temp_dir:
+            os.rename(entry_path, path.join(temp_dir, entry))
+    data_dir = path.join(directory, 'data')
+    os.rename(temp_dir, data_dir)
+    os.chmod(data_dir, os.stat(directory).st_mode)
+    return data_dir
+
+
+def _walk(directory):
+    # Sort the entries so that the manifests are written in a stable order.
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            yield path.join(root, file)
+
+
+def _encoded_filename(name):
+    # BagIt manifests can't contain raw line breaks in file names.
+    return name.replace('\r', '%0D').replace('\n', '%0A')
+
+
+def _bag_info(bag_info, total_bytes, total_files):
+    info = {'Bagging-Date': date.strftime(date.today(), '%Y-%m-%d'),
+            'Bag-Software-Agent': f'eprints2bags v{eprints2bags.__version__} <{eprints2bags.__url__}>'}
+    info.update(bag_info)
+    info['Payload-Oxum'] = f'{total_bytes}.{total_files}'
+    return info
+
+
+def _manifest_text(entries):
+    return ''.join(f'{digest}  {_encoded_filename(name)}\n' for digest, name in entries)
+
+
+def _tag_file_text(values):
+    text = ''
+    for name in sorted(values.keys()):
+        items = values[name] if isinstance(values[name], list) else [values[name]]
+        for item in items:
+            # Line breaks would corrupt the tag file, so remove them.
+            text += name + ': ' + re.sub(r'[\r\n]', '', str(item)) + '\n'
+    return text
+
+
+class _ChunkReader(object):
+    # File-like object reading from an iterator over byte strings, for
+    # tarfile.addfile().  The bytes read are fed to the MultiDigest 'digest'.
+
+    def __init__(self, chunks, digest):
+        self._chunks = chunks
+        self._digest = digest
+        self._chunk  = b''
+        self._offset = 0
+
+
+    def read(self, size = -1):
+        pieces = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self._offset >= len(self._chunk):
+                chunk = next(self._chunks, None)
+                if chunk == None:
+                    break
+                self._digest.update(chunk)
+                self._chunk, self._offset = chunk, 0
+            end = len(self._chunk)
+            if size >= 0:
+                end = min(end, self._offset + wanted)
+                wanted -= end - self._offset
+            pieces.append(self._chunk[self._offset:end])
+            self._offset = end
+        return b''.join(pieces)
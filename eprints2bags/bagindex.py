@@ -0,0 +1,244 @@
+'''
+bagindex.py: index of the record bags written by a previous run.
+
+The -d option compares the records obtained from the EPrints server to the
+bags (or archived bags) in the output directory of an earlier run, to skip
+the records that have not changed.  Looking inside every previous bag while
+processing each record would be slow, especially for compressed archives, so
+this module reads the relevant parts of all the previous bags once and keeps
+the results in an index: for each bag, the SHA-256 and MD5 checksums listed
+in its manifests, the values in its bag-info.txt file, and the last
+modification date recorded in its EPrints XML file.  Bags inside ZIP and tar
+archives are read directly from the archive files, without extracting them.
+
+The index is saved to a file next to the previous output directory, so that
+later runs comparing against the same directory can use it right away.  Each
+entry in the saved index records the modification time and size of the bag
+or archive it came from, and only entries whose source has changed (or is
+new) are read again.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import hashlib
+import json
+import os
+from   os import path
+from   sidetrack import log
+import tarfile
+import zipfile
+
+import eprints2bags
+from   .eprints import eprints_record_info, record_content
+from   .exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+_INDEX_SUFFIX = '.index.json'
+'''Suffix added to the name of the previous output directory to make the
+name of the file where the index is saved.'''
+
+_ARCHIVE_EXTENSIONS = ['.zip', '.tar', '.tar.gz']
+'''Extensions of the archive files that may hold previous record bags.'''
+
+_INDEX_VERSION = 1
+'''Version of the format of the saved index file.'''
+
+
+# Main class.
+# .............................................................................
+
+class BagIndex(object):
+    '''Index of the bags found in the directory 'previous_dir'.'''
+
+    def __init__(self, previous_dir):
+        self.previous_dir = previous_dir
+        self.index_file   = path.normpath(previous_dir) + _INDEX_SUFFIX
+        self._entries     = {}
+        self._load()
+        self._update()
+
+
+    def unchanged(self, name, record):
+        '''Return True if the bag named 'name' (e.g., "1234" or "NAME-1234")
+        in the previous output directory holds the same record as 'record',
+        a RecordXML object for the record as obtained from the server.  The
+        record is considered the same if it has the same identifier and either
+        its XML is identical or its last modification date is the same, and
+        if the bag has the same documents with the same MD5 checksums as
+        listed in the record.'''
+        entry = self._entries.get(name)
+        if not entry:
+            return False
+        info = record.info
+        sender_id = entry['info'].get('Internal-Sender-Identifier')
+        if sender_id and sender_id != info.id:
+            return False
+        xml_file = 'data/' + name + '.xml'
+        sha256 = hashlib.sha256()
+        for piece in record_content(record.content):
+            sha256.update(piece)
+        same_xml = entry['sha256'].get(xml_file) == sha256.hexdigest()
+        if not same_xml and entry['lastmod'] != str(info.lastmod):
+            return False
+        # The documents must be the same ones, and have the same content.
+        previous_docs = set(file for file in entry['md5'] if file != xml_file)
+        if previous_docs != set('data/' + path.basename(url) for url in info.documents):
+            return False
+        for url in info.documents:
+            if info.hashes.get(url) != entry['md5'].get('data/' + path.basename(url)):
+                return False
+        return True
+
+
+    def _load(self):
+        if not path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, 'r') as f:
+                saved = json.load(f)
+            if saved.get('version') == _INDEX_VERSION:
+                self._entries = saved['entries']
+                if __debug__: log(f'loaded {len(self._entries)} entries from {self.index_file}')
+        except (OSError, ValueError, KeyError) as ex:
+            if __debug__: log(f'ignoring unreadable index {self.index_file}: {str(ex)}')
+
+
+    def _update(self):
+        found = {}
+        for entry in os.scandir(self.previous_dir):
+            name = _bag_name(entry)
+            if name:
+                found[name] = entry
+        changed = False
+        for name in list(self._entries):
+            if name not in found:
+                del self._entries[name]
+                changed = True
+        for name, entry in found.items():
+            stat = _source_stat(entry)
+            known = self._entries.get(name)
+            if (known and known['source'] == entry.name and known['mtime'] == stat.st_mtime
+                and known['size'] == stat.st_size):
+                continue
+            try:
+                self._entries[name] = _indexed(name, entry.path, stat)
+            except Exception as ex:
+                # Leave it out; the record will simply be treated as changed.
+                if __debug__: log(f'unable to index {entry.path}: {str(ex)}')
+                self._entries.pop(name, None)
+            changed = True
+        if changed:
+            self._save()
+
+
+    def _save(self):
+        try:
+            with open(self.index_file + '.tmp', 'w') as f:
+                json.dump({'version': _INDEX_VERSION, 'entries': self._entries}, f)
+            os.replace(self.index_file + '.tmp', self.index_file)
+            if __debug__: log(f'saved {len(self._entries)} entries to {self.index_file}')
+        except OSError as ex:
+            if __debug__: log(f'unable to save index {self.index_file}: {str(ex)}')
+
+
+# Helper functions.
+# .............................................................................
+
+def _bag_name(entry):
+    if entry.is_dir():
+        return entry.name
+    for ext in _ARCHIVE_EXTENSIONS:
+        if entry.name.endswith(ext):
+            return entry.name[:-len(ext)]
+    return None
+
+
+def _source_stat(entry):
+    # A directory's own modification time doesn't change when the files in
+    # it are rewritten, so use the time of the bag's manifest instead.
+    if entry.is_dir():
+        manifest = path.join(entry.path, 'manifest-md5.txt')
+        if path.exists(manifest):
+            return os.stat(manifest)
+    return entry.stat()
+
+
+def _indexed(name, source, stat):
+    if __debug__: log(f'indexing {source}')
+    wanted = ['manifest-sha256.txt', 'manifest-md5.txt', 'bag-info.txt', f'data/{name}.xml']
+    contents = _bag_files(source, wanted)
+    xml = contents.get(f'data/{name}.xml')
+    return {'source'  : path.basename(source),
+            'mtime'   : stat.st_mtime,
+            'size'    : stat.st_size,
+            'sha256'  : _manifest(contents.get('manifest-sha256.txt')),
+            'md5'     : _manifest(contents.get('manifest-md5.txt')),
+            'info'    : _tag_values(contents.get('bag-info.txt')),
+            'lastmod' : str(eprints_record_info(xml).lastmod) if xml else None}
+
+
+def _bag_files(source, wanted):
+    '''Return a dict mapping the names in 'wanted' (relative to the top of the
+    bag) to the contents of those files in the bag in 'source', which can be
+    a directory or an archive file.'''
+    contents = {}
+    if path.isdir(source):
+        for name in wanted:
+            file = path.join(source, name)
+            if path.exists(file):
+                with open(file, 'rb') as f:
+                    contents[name] = f.read()
+    elif source.endswith('.zip'):
+        with zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                name = _within_bag(info.filename)
+                if name in wanted:
+                    contents[name] = zf.read(info)
+    else:
+        # Read the tar file as a stream; for compressed files, this avoids
+        # decompressing the whole file more than once.
+        with tarfile.open(source, 'r|*') as tf:
+            for member in tf:
+                name = _within_bag(member.name)
+                if name in wanted and member.isfile():
+                    contents[name] = tf.extractfile(member).read()
+    return contents
+
+
+def _within_bag(member_name):
+    # Archive members are stored under the name of the bag directory.
+    parts = member_name.split('/', 1)
+    return parts[1] if len(parts) == 2 else ''
+
+
+def _manifest(content):
+    digests = {}
+    if content:
+        for line in content.decode('utf-8').splitlines():
+            if line.strip():
+                digest, file = line.split(None, 1)
+                digests[file.strip().replace('%0A', '\n').replace('%0D', '\r')] = digest.lower()
+    return digests
+
+
+def _tag_values(content):
+    values = {}
+    if content:
+        for line in content.decode('utf-8').splitlines():
+            if ':' in line:
+                name, value = line.split(':', 1)
+                values[name.strip()] = value.strip()
+    return values
@@ -0,0 +1,283 @@
+'''
+blobstore.py: content-addressed store of downloaded documents.
+
+The same document file is sometimes attached to several EPrints records.
+Rather than downloading it again for every record and keeping a separate copy
+in every record's directory, eprints2bags can keep each downloaded document
+in a store where it is filed under its SHA-256 checksum.  The store also
+remembers which document URL (and file size) each stored file came from.
+When a record refers to a URL that is already in the store with the same
+size (and the same MD5 checksum, if the record lists one), the stored file
+is linked into the record's directory instead of being downloaded again.
+
+Files are linked using hard links when possible, so that a document shared
+by many records takes up disk space only once.  Hard links only work within
+a single file system; otherwise, this tries to make a copy-on-write clone
+(a "reflink", on file systems that support it) and then falls back to making
+an ordinary copy.  The store has a size limit, which applies to the space
+taken up by files that are only in the store: a file that is also linked
+into a record directory or bag takes up no additional space, so it is not
+counted and removing it would not free anything.  When adding a file would
+exceed the limit, the least recently used of the other files are removed
+until the store is comfortably below the limit again.  The time of last use
+is kept in a separate empty file next to each stored file, because changing
+the times of the stored file itself would change those of its links.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import hashlib
+import json
+import os
+from   os import path
+import shutil
+from   sidetrack import log
+from   threading import Lock
+
+import eprints2bags
+from   .exceptions import *
+from   .hashing import file_digests
+
+
+# Constants.
+# .............................................................................
+
+_EVICTION_TARGET = 0.9
+'''When the store exceeds its size limit, files are removed until the total
+size is below this fraction of the limit.'''
+
+_KEY_ALGORITHM = 'sha256'
+'''Checksum algorithm whose digests are used to name the stored files.'''
+
+_RECORD_ALGORITHM = 'md5'
+'''Checksum algorithm used by EPrints records for their documents.  Its
+digests are kept in the store, to compare them to the records' values.'''
+
+_USED_SUFFIX = '.used'
+'''Suffix of the files whose modification times record the last use of the
+stored files.'''
+
+_FICLONE = 0x40049409
+'''Linux ioctl request code for making a copy-on-write clone of a file.'''
+
+
+# Main class.
+# .............................................................................
+
+class BlobStore(object):
+    '''Store of document files under the directory 'store_dir', limited to
+    'max_bytes' bytes of files that are not linked anywhere else.'''
+
+    def __init__(self, store_dir, max_bytes):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self._blobs    = path.join(store_dir, 'blobs')
+        self._urls     = path.join(store_dir, 'urls')
+        self._lock     = Lock()
+        os.makedirs(self._blobs, exist_ok = True)
+        os.makedirs(self._urls, exist_ok = True)
+        # Bytes in files that are only in the store, as of the last time they
+        # were counted, plus the sizes of the files added since then.
+        self._size     = sum(stat.st_size for _, stat in self._blob_stats()
+                             if stat.st_nlink == 1)
+        if __debug__: log(f'document store {store_dir} holds {self._size} bytes')
+
+
+    def algorithms(self, algorithms):
+        '''Return the list of checksum algorithms that must be computed when
+        downloading files to be added to the store, given that the caller
+        wants the ones in 'algorithms' (which may be None).'''
+        algorithms = list(algorithms or [])
+        for alg in [_KEY_ALGORITHM, _RECORD_ALGORITHM]:
+            if alg not in algorithms:
+                algorithms.append(alg)
+        return algorithms
+
+
+    def fetch(self, url, size, destination, md5 = None):
+        '''If the store has a file that was downloaded from 'url' and has
+        'size' bytes, link or copy it to 'destination' and return a dict of
+        its known hex digests keyed by algorithm name.  Otherwise, return
+        None.  If 'size' is None, the store is not used, because without the
+        size there is no cheap way to tell that the server's copy of the file
+        is still the same.  If 'md5' is not None, it is the MD5 checksum the
+        file is expected to have, and a stored file with a different one is
+        not used.'''
+        found = self.lookup(url, size, md5)
+        if not found:
+            return None
+        blob, digests = found
+        try:
+            _link(blob, destination)
+        except FileNotFoundError:
+            # The file has been evicted since it was looked up.
+            return None
+        if __debug__: log(f'linked stored copy of {url} to {destination}')
+        return digests
+
+
+    def lookup(self, url, size, md5 = None):
+        '''Like fetch(), but instead of copying the stored file, return a
+        tuple (path of the stored file, dict of known hex digests), or None.
+        The stored file must not be modified.'''
+        if size == None:
+            return None
+        entry = self._entry(url)
+        if not entry or entry.get('size') != size:
+            return None
+        digests = entry['digests']
+        blob = self._blob_file(digests[_KEY_ALGORITHM])
+        try:
+            if os.stat(blob).st_size != size:
+                return None
+            if md5 != None:
+                if _RECORD_ALGORITHM not in digests:
+                    # Entries made by older versions may lack it.
+                    digests = dict(digests)
+                    digests.update(file_digests(blob, [_RECORD_ALGORITHM])[0])
+                if digests[_RECORD_ALGORITHM] != md5.lower():
+                    if __debug__: log(f'stored copy of {url} has a different MD5')
+                    return None
+            self._touch(blob)
+        except FileNotFoundError:
+            # The file has been evicted since the entry was written.
+            return None
+        return (blob, digests)
+
+
+    def add(self, url, file, digests = None):
+        '''Add 'file', which was downloaded from 'url', to the store.  If the
+        store doesn't already have a file with the same content, 'file' is
+        hard-linked (or copied) into it.  'Digests' is a dict of the file's
+        hex digests keyed by algorithm name, as computed while downloading;
+        they are computed here if the one used to name the file is missing.'''
+        digests = dict(digests or {})
+        if _KEY_ALGORITHM not in digests:
+            digests.update(file_digests(file, [_KEY_ALGORITHM])[0])
+        size = os.stat(file).st_size
+        if size > self.max_bytes:
+            return
+        blob = self._blob_file(digests[_KEY_ALGORITHM])
+        with self._lock:
+            if path.exists(blob):
+                self._touch(blob)
+            else:
+                os.makedirs(path.dirname(blob), exist_ok = True)
+                _link(file, blob + '.tmp')
+                os.replace(blob + '.tmp', blob)
+                self._touch(blob)
+                self._size += size
+            entry_file = self._entry_file(url)
+            with open(entry_file + '.tmp', 'w') as f:
+                json.dump({'url': url, 'size': size, 'digests': digests}, f)
+            os.replace(entry_file + '.tmp', entry_file)
+            if self._size > self.max_bytes:
+                self._evict()
+        if __debug__: log(f'stored {url} as {blob}')
+
+
+    def _entry(self, url):
+        try:
+            with open(self._entry_file(url), 'r') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            if __debug__: log(f'ignoring unreadable store entry for {url}: {str(ex)}')
+            return None
+        # Guard against the (unlikely) case of a hash collision on the URL.
+        return entry if entry.get('url') == url else None
+
+
+    def _entry_file(self, url):
+        return path.join(self._urls, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+
+    def _blob_file(self, digest):
+        # Spread the files over subdirectories to keep directories small.
+        return path.join(self._blobs, digest[:2], digest)
+
+
+    def _blob_stats(self):
+        # Yields tuples (path of stored file, os.stat_result).
+        for entry in os.scandir(self._blobs):
+            if entry.is_dir():
+                for blob in os.scandir(entry.path):
+                    if not blob.name.endswith(('.tmp', _USED_SUFFIX)):
+                        try:
+                            yield (blob.path, os.stat(blob.path))
+                        except FileNotFoundError:
+                            pass
+
+
+    def _touch(self, blob):
+        # Record the time of use ourselves, because many file systems are
+        # mounted with options that stop the OS from updating access times,
+        # and not on the stored file itself, which may be linked elsewhere.
+        with open(blob + _USED_SUFFIX, 'a'):
+            pass
+        os.utime(blob + _USED_SUFFIX)
+
+
+    def _last_use(self, blob, stat):
+        try:
+            return os.stat(blob + _USED_SUFFIX).st_mtime
+        except FileNotFoundError:
+            return stat.st_mtime
+
+
+    def _evict(self):
+        # The running total counts every file added since the last count,
+        # but files still linked elsewhere take up no space of their own, so
+        # count again and remove only files that are in the store alone,
+        # least recently used first.  Entries in the URL index that point to
+        # removed files are ignored when next looked up.
+        unlinked = [(blob, stat) for blob, stat in self._blob_stats()
+                    if stat.st_nlink == 1]
+        self._size = sum(stat.st_size for _, stat in unlinked)
+        target = self.max_bytes * _EVICTION_TARGET
+        if self._size <= target:
+            return
+        if __debug__: log(f'document store is over its limit of {self.max_bytes} bytes')
+        unlinked.sort(key = lambda item: self._last_use(*item))
+        for blob, stat in unlinked:
+            if self._size <= target:
+                break
+            self._size -= stat.st_size
+            os.remove(blob)
+            if path.exists(blob + _USED_SUFFIX):
+                os.remove(blob + _USED_SUFFIX)
+        if __debug__: log(f'document store now holds {self._size} bytes')
+
+
+# Helper functions.
+# .............................................................................
+
+def _link(source, destination):
+    '''Make 'destination' a hard link to 'source' if possible; otherwise, make
+    it a copy-on-write clone or, failing that, an ordinary copy.'''
+    if path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+        return
+    except OSError as ex:
+        if __debug__: log(f'cannot hard-link {source}: {str(ex)}')
+    try:
+        import fcntl
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return
+    except (ImportError, OSError) as ex:
+        if __debug__: log(f'cannot clone {source}: {str(ex)}')
+    shutil.copyfile(source, destination)
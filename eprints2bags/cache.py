@@ -0,0 +1,182 @@
+'''
+cache.py: on-disk cache of EPrints record XML, for use with conditional GETs.
+
+Each cached record is stored as two files: the XML body exactly as received
+from the server, and a small JSON file holding the HTTP validators (the ETag
+and Last-Modified header values) that came with it.  On later runs, the
+validators are sent back to the server in If-None-Match and If-Modified-Since
+headers; if the server replies with 304 (Not Modified), the cached body is
+used instead of downloading the record again.
+
+The cache has a size limit.  When adding a record would exceed it, the least
+recently used records are removed until the cache is comfortably below the
+limit again.
+
+This module also provides a cache for the list of records on the server, so
+that runs that need the full list don't always have to get it again.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   datetime import datetime
+import json
+import os
+from   os import path
+from   sidetrack import log
+from   threading import Lock
+
+import eprints2bags
+from   .exceptions import *
+from   .files import make_dir
+
+
+# Constants.
+# .............................................................................
+
+_EVICTION_TARGET = 0.9
+'''When the cache exceeds its size limit, records are removed until the total
+size is below this fraction of the limit.'''
+
+
+# Main classes.
+# .............................................................................
+
+class RecordCache(object):
+    '''Cache of record XML bodies and their HTTP validators, stored under
+    the directory 'cache_dir' and limited to 'max_bytes' bytes in total.'''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock     = Lock()
+        make_dir(cache_dir)
+        self._size     = sum(entry.stat().st_size for entry in os.scandir(cache_dir)
+                             if entry.is_file())
+        if __debug__: log(f'record cache {cache_dir} holds {self._size} bytes')
+
+
+    def validators(self, number):
+        '''Return a dict of HTTP headers for a conditional GET of record
+        'number', or an empty dict if the record is not in the cache.'''
+        (body_file, meta_file) = self._files(number)
+        if not path.exists(body_file) or not path.exists(meta_file):
+            return {}
+        try:
+            with open(meta_file, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError) as ex:
+            if __debug__: log(f'ignoring unreadable cache entry {meta_file}: {str(ex)}')
+            return {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+
+    def get(self, number):
+        '''Return the cached XML body of record 'number' as bytes, or None.'''
+        (body_file, meta_file) = self._files(number)
+        try:
+            with open(body_file, 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        # Record the access time ourselves, because many file systems are
+        # mounted with options that stop the OS from updating it on reads.
+        os.utime(body_file)
+        return content
+
+
+    def put(self, number, content, etag, last_modified):
+        '''Store the XML body 'content' (bytes) of record 'number' along with
+        its validators.  Nothing is stored if there are no validators, since
+        the entry could never be used.'''
+        if not etag and not last_modified:
+            return
+        if len(content) > self.max_bytes:
+            return
+        (body_file, meta_file) = self._files(number)
+        with self._lock:
+            self._size -= self._stored_size(body_file, meta_file)
+            # Write to temporary files and rename them, so that a concurrent
+            # reader never sees a half-written entry.
+            with open(body_file + '.tmp', 'wb') as f:
+                f.write(content)
+            with open(meta_file + '.tmp', 'w') as f:
+                json.dump({'etag': etag, 'last_modified': last_modified}, f)
+            os.replace(body_file + '.tmp', body_file)
+            os.replace(meta_file + '.tmp', meta_file)
+            self._size += self._stored_size(body_file, meta_file)
+            if self._size > self.max_bytes:
+                self._evict()
+
+
+    def _files(self, number):
+        base = path.join(self.cache_dir, str(number))
+        return (base + '.xml', base + '.json')
+
+
+    def _stored_size(self, *files):
+        return sum(os.stat(file).st_size for file in files if path.exists(file))
+
+
+    def _evict(self):
+        # Remove the least recently used records first.
+        if __debug__: log(f'record cache is over its limit of {self.max_bytes} bytes')
+        entries = sorted((entry for entry in os.scandir(self.cache_dir)
+                          if entry.name.endswith('.xml')),
+                         key = lambda entry: entry.stat().st_mtime)
+        target = self.max_bytes * _EVICTION_TARGET
+        for entry in entries:
+            if self._size <= target:
+                break
+            meta_file = entry.path[:-len('.xml')] + '.json'
+            self._size -= self._stored_size(entry.path, meta_file)
+            for file in [entry.path, meta_file]:
+                if path.exists(file):
+                    os.remove(file)
+        if __debug__: log(f'record cache now holds {self._size} bytes')
+
+
+class ListingCache(object):
+    '''Copy of the list of records on the server, stored in the file
+    'listing_file' together with the time the list was obtained.'''
+
+    def __init__(self, listing_file):
+        self.listing_file = listing_file
+        make_dir(path.dirname(listing_file))
+
+
+    def load(self):
+        '''Return a tuple (timestamp, numbers), where 'timestamp' is a
+        timezone-aware datetime object and 'numbers' is a list of record
+        numbers as strings, or None if there is no usable cached list.'''
+        try:
+            with open(self.listing_file, 'r') as f:
+                saved = json.load(f)
+            return (datetime.fromisoformat(saved['timestamp']), saved['numbers'])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as ex:
+            if __debug__: log(f'ignoring unreadable listing {self.listing_file}: {str(ex)}')
+            return None
+
+
+    def save(self, numbers, timestamp):
+        '''Store the list 'numbers', obtained at the time 'timestamp'.'''
+        with open(self.listing_file + '.tmp', 'w') as f:
+            json.dump({'timestamp': timestamp.isoformat(), 'numbers': numbers}, f)
+        os.replace(self.listing_file + '.tmp', self.listing_file)
+        if __debug__: log(f'saved list of {len(numbers)} records in {self.listing_file}')
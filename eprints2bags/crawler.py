@@ -0,0 +1,150 @@
+'''
+crawler.py: call a function on many items concurrently, with a bounded
+number of calls in flight, and hand back the results in the original order.
+
+This is used to fetch EPrints record metadata ahead of the rest of the
+processing.  Fetching a record's XML is almost entirely a matter of waiting
+for the server, so many such requests can be kept in flight at once.  The
+scheduling is done by an asyncio event loop running in a background thread;
+the blocking network calls themselves are run on a pool of executor threads,
+so that they go through the same code (and the same pooled network session,
+with its rate limiting) as every other request made by eprints2bags.  This
+means that every call in flight takes up an operating system thread while it
+waits: the event loop keeps the calls bounded and the results in order, but
+it does not make a call in flight any cheaper than a thread, the way an
+asynchronous HTTP client would.  The number of calls in flight should
+therefore be kept to what a thread pool can reasonably handle.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import asyncio
+from   concurrent.futures import ThreadPoolExecutor
+from   queue import Queue
+from   sidetrack import log
+from   threading import Event, Thread
+
+import eprints2bags
+
+
+# Constants.
+# .............................................................................
+
+_DONE = object()
+'''Marker put on the output queue after the last result, as the first
+element of a tuple whose second element is the exception (if any) raised by
+the iterator of items.'''
+
+
+# Main functions.
+# .............................................................................
+
+def crawled(items, func, limit):
+    '''Generator that calls func(item) on each item in 'items', with up to
+    'limit' calls in progress at any time, and yields a tuple (item, result,
+    exception) for each item, in the same order as 'items'.  If a call raises
+    an exception, the tuple contains None for the result and the exception
+    object; otherwise the exception element is None.
+
+    Each call in progress runs on a thread of its own, so 'limit' is also the
+    number of threads started for the calls, and should be kept moderate.
+    No more than 'limit' items are fetched ahead of the consumer, so memory
+    use stays bounded even if the consumer is slow.  If the consumer stops
+    iterating early, no new calls are started and the ones in progress are
+    allowed to finish before this generator returns.
+
+    The items are taken from 'items' on a separate thread, so that an
+    iterator that blocks (e.g., on network or database access) does not hold
+    up the calls in progress.  If the iterator raises an exception, the
+    results of the items obtained before it are yielded, and the exception
+    is then raised by this generator.
+    '''
+    output = Queue(maxsize = limit)
+    stop = Event()
+    crawler = Thread(target = asyncio.run, name = 'crawler', daemon = True,
+                     args = (_crawl(items, func, limit, output, stop),))
+    if __debug__: log(f'starting crawler with up to {limit} calls in flight')
+    crawler.start()
+    finished = False
+    error = None
+    try:
+        while not finished:
+            entry = output.get()
+            finished = entry[0] is _DONE
+            if finished:
+                error = entry[1]
+            else:
+                yield entry
+    finally:
+        if not finished:
+            if __debug__: log('stopping crawler')
+            stop.set()
+            while output.get()[0] is not _DONE:
+                pass
+        crawler.join()
+    if error:
+        if __debug__: log(f'list of items ended with an error: {str(error)}')
+        raise error
+
+
+# Helper functions.
+# .............................................................................
+
+async def _crawl(items, func, limit, output, stop):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers = limit, thread_name_prefix = 'crawl')
+    window = asyncio.Semaphore(limit)
+    in_order = asyncio.Queue()
+
+    async def call(item):
+        try:
+            return (item, await loop.run_in_executor(executor, func, item), None)
+        except Exception as ex:
+            return (item, None, ex)
+
+    async def deliver():
+        # Results are handed over in the order the items were started.  The
+        # put() on the output queue blocks when the consumer falls behind,
+        # and the window slot is only released after that, so that at most
+        # 'limit' items are in flight or waiting to be consumed.
+        while True:
+            task = await in_order.get()
+            if task is None:
+                break
+            result = await task
+            await loop.run_in_executor(None, output.put, result)
+            window.release()
+
+    deliverer = asyncio.ensure_future(deliver())
+    iterator = iter(items)
+    error = None
+    try:
+        try:
+            while True:
+                await window.acquire()
+                if stop.is_set():
+                    break
+                # Getting the next item may block, so it's done on another
+                # thread, leaving this one free to schedule the calls.
+                item = await loop.run_in_executor(None, next, iterator, _DONE)
+                if item is _DONE:
+                    break
+                in_order.put_nowait(asyncio.ensure_future(call(item)))
+        except Exception as ex:
+            # Deliver the results of the items before the failure first.
+            error = ex
+        in_order.put_nowait(None)
+        await deliverer
+    finally:
+        executor.shutdown(wait = True)
+        await loop.run_in_executor(None, output.put, (_DONE, error))
@@ -15,7 +15,6 @@ file "LICENSE" for more information.
 '''
 
 from   bun import inform, warn, alert, alert_fatal
-import codecs
 from   collections import defaultdict
 from   commonpy.data_utils import parsed_datetime
 from   lxml import etree
@@ -23,9 +22,11 @@ import os
 from   os import path
 import shutil
 from   sidetrack import log
+from   tempfile import SpooledTemporaryFile
 
 import eprints2bags
 from   .exceptions import *
+from   .hashing import MultiDigest
 from   .network import net
 
 
@@ -35,6 +36,28 @@ from   .network import net
 _EPRINTS_XMLNS = 'http://eprints.org/ep2/data/2.0'
 '''XML namespace used in EPrints XML output.'''
 
+_NS = '{' + _EPRINTS_XMLNS + '}'
+'''Prefix of the names of elements in the EPrints XML namespace.'''
+
+_XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+'''XML declaration written at the top of record files that lack one.'''
+
+_WHITESPACE = b' \t\r\n'
+'''Bytes that are trimmed from the start and end of record files.'''
+
+_RECORD_CHUNK_SIZE = 16 * 1024
+'''Number of bytes read at a time from the XML of a record.'''
+
+_SPOOL_SIZE = 4 * 1024 * 1024
+'''Records larger than this many bytes are kept in a temporary file, instead
+of in memory, between being downloaded and being written out.'''
+
+_RECORD_PARTS = [_NS + 'eprint', _NS + 'documents']
+'''Elements whose children are discarded once they have been parsed.'''
+
+_LISTING_CHUNK_SIZE = 64 * 1024
+'''Number of bytes read at a time from the server's list of records.'''
+
 
 # Main functions.
 # .............................................................................
@@ -53,52 +76,146 @@ def eprints_api(url, op, user, password):
         return url[:start + 2] + url[start + 2:] + op
 
 
-def eprints_raw_list(base_url, user, password):
+def eprints_records_list(base_url, user, password, session = None):
+    '''Start getting the list of records from the server and return a
+    RecordsListing object, which yields the record numbers (as strings) as
+    they arrive.  Returns None if the server does not respond with a records
+    list.  This doubles as a test that the server and credentials work.'''
     url = eprints_api(base_url, '/eprint', user, password)
-    (response, error) = net('get', url)
-    if not error and response and response.text:
-        if response.text.startswith('<?xml'):
-            return response.content
-    return None
-
-
-def eprints_records_list(raw_list):
-    if not raw_list:
-        # This shouldn't happen.
-        raise InternalError('Internal error processing server response')
-    xml = etree.fromstring(raw_list)
-    # The content from this call is in XHTML format.  It looks like this, and
-    # the following loop extracts the numbers from the <li> elements:
-    #
-    #   <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
-    #       "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
-    #   <html xmlns="http://www.w3.org/1999/xhtml">
-    #   <head>
-    #     <title>EPrints REST: Eprints DataSet</title>
-    #     <style type="text/css">
-    #       body { font-family: sans-serif; }
-    #     </style>
-    #   </head>
-    #   <body>
-    #     <h1>EPrints REST: Eprints DataSet</h1>
-    #   <ul>
-    #   <li><a href='4/'>4/</a></li>
-    #   <li><a href='4.xml'>4.xml</a></li>
-    #   <li><a href='5/'>5/</a></li>
-    #   <li><a href='5.xml'>5.xml</a></li>
-    #   ...
-    #
-    numbers = []
-    for node in xml.findall('.//{http://www.w3.org/1999/xhtml}a'):
-        if 'href' in node.attrib and node.attrib['href'].endswith('xml'):
-            numbers.append(node.attrib['href'].split('.')[0])
-    return numbers
-
-
-def eprints_xml(number, base_url, user, password, missing_ok):
+    (response, error) = net('get', url, session, stream = True)
+    if error or not response:
+        return None
+    chunks = response.iter_content(_LISTING_CHUNK_SIZE)
+    first = next(chunks, b'')
+    if not first.lstrip().startswith(b'<?xml'):
+        response.close()
+        return None
+    return RecordsListing(response, first, chunks)
+
+
+def eprints_server_ok(base_url, user, password, number, session = None):
+    '''Return True if the server answers requests and accepts the credentials.
+    This first asks for a small field of record 'number', then (if that is
+    not allowed) for the record itself, which is much faster than getting the
+    list of all records from the server.  If neither exists, the list of
+    records is requested after all, to tell a missing record apart from a
+    wrong server URL, since both get HTTP code 404.'''
+    for op in [f'/eprint/{number}/lastmod.txt', f'/eprint/{number}.xml']:
+        url = eprints_api(base_url, op, user, password)
+        (response, error) = net('get', url, session, polling = True, stream = True)
+        code = response.status_code if response != None else None
+        if response != None:
+            response.close()
+        if code in [404, 410]:
+            # Either the record doesn't exist or the URL is wrong.
+            if __debug__: log(f'probe of {op} got code {code}')
+            continue
+        if not error:
+            return True
+        if isinstance(error, NetworkFailure):
+            return False
+        # Some servers don't allow access to single fields, so an error
+        # for the field is not final; try the record.
+        if __debug__: log(f'probe of {op} failed: {str(error)}')
+    listing = eprints_records_list(base_url, user, password, session)
+    if listing == None:
+        return False
+    listing.close()
+    return True
+
+
+class RecordsListing(object):
+    '''Iterator over the record numbers in the server's list of records.
+
+    The list is parsed incrementally, as the server's response arrives, and
+    the parsed elements are discarded as soon as the numbers have been taken
+    from them, so memory use does not depend on the number of records.  The
+    response is closed when the iteration is finished or close() is called.
+    '''
+
+    def __init__(self, response, first_chunk, chunks):
+        self._response = response
+        self._first    = first_chunk
+        self._chunks   = chunks
+
+
+    def __iter__(self):
+        # The content from this call is in XHTML format.  It looks like this,
+        # and the loop below extracts the numbers from the <li> elements:
+        #
+        #   <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+        #       "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+        #   <html xmlns="http://www.w3.org/1999/xhtml">
+        #   <head>
+        #     <title>EPrints REST: Eprints DataSet</title>
+        #     <style type="text/css">
+        #       body { font-family: sans-serif; }
+        #     </style>
+        #   </head>
+        #   <body>
+        #     <h1>EPrints REST: Eprints DataSet</h1>
+        #   <ul>
+        #   <li><a href='4/'>4/</a></li>
+        #   <li><a href='4.xml'>4.xml</a></li>
+        #   <li><a href='5/'>5/</a></li>
+        #   <li><a href='5.xml'>5.xml</a></li>
+        #   ...
+        #
+        parser = etree.XMLPullParser(events = ('end',), tag = '{http://www.w3.org/1999/xhtml}a',
+                                     load_dtd = False, no_network = True)
+        try:
+            chunk = self._first
+            while chunk:
+                parser.feed(chunk)
+                yield from self._numbers(parser)
+                chunk = next(self._chunks, b'')
+            parser.close()
+            yield from self._numbers(parser)
+        except etree.XMLSyntaxError as ex:
+            raise ServiceFailure(f'Unable to parse the list of records: {str(ex)}')
+        finally:
+            self.close()
+
+
+    def close(self):
+        self._response.close()
+
+
+    def _numbers(self, parser):
+        for _, node in parser.read_events():
+            href = node.attrib.get('href', '')
+            if href.endswith('xml'):
+                yield href.split('.')[0]
+            # Discard the <li> elements already looked at.
+            item = node.getparent()
+            node.clear()
+            if item is not None:
+                while item.getprevious() is not None:
+                    del item.getparent()[0]
+
+
+def eprints_xml(number, base_url, user, password, missing_ok, session = None,
+                cache = None, stop = None):
+    '''Return the EP3 XML of record 'number' as a RecordXML object, or None
+    if the record is missing and 'missing_ok' is True.  The XML is parsed as
+    it arrives, to fill in the RecordXML's 'info', while the bytes sent by the
+    server are kept as they are, to be written out by write_record().
+
+    If 'stop' is not None, it must be a function.  It is called with the
+    RecordInfo object while the record is arriving, as the values of fields
+    become known; if it returns a true value, the rest of the record is not
+    downloaded, and the RecordXML returned is marked as incomplete.
+
+    If 'cache' is not None, it must be a RecordCache object; the request is
+    then made conditional on the record having changed since it was cached,
+    and the cached copy is used if the server says it hasn't.'''
     url = eprints_api(base_url, f'/eprint/{number}.xml', user, password)
-    (response, error) = net('get', url)
+    use_cache = cache != None and str(number).isdigit()
+    headers = cache.validators(number) if use_cache else {}
+    (response, error) = net('get', url, session, headers = headers, stream = True)
     if error:
+        if response != None:
+            response.close()
         if isinstance(error, NoContent):
             if missing_ok:
                 warn(f'Server has no contents for record number {number}')
@@ -116,62 +233,240 @@ def eprints_xml(number, base_url, user, password, missing_ok):
                 raise error
         else:
             raise error
-    return etree.fromstring(response.content)
+    if use_cache and response.status_code == 304:
+        response.close()
+        content = cache.get(number)
+        if content:
+            if __debug__: log(f'record {number} unchanged; using cached copy')
+            return _record_xml(number, [content], stop)
+        # The cached copy vanished (e.g., evicted) after we asked.  Try again
+        # without making the request conditional.
+        return eprints_xml(number, base_url, user, password, missing_ok, session,
+                           stop = stop)
+    try:
+        record = _record_xml(number, response.iter_content(_RECORD_CHUNK_SIZE), stop)
+    finally:
+        response.close()
+    if use_cache and record.complete and record.size <= cache.max_bytes:
+        cache.put(number, record.content.read(), response.headers.get('ETag'),
+                  response.headers.get('Last-Modified'))
+        record.content.seek(0)
+    return record
 
 
-def eprints_lastmod(xml):
-    lastmod_elem = xml.find('.//{' + _EPRINTS_XMLNS + '}lastmod')
-    return parsed_datetime(lastmod_elem.text)
+class RecordXML(object):
+    '''EPrints record XML obtained from the server.
 
+    Attribute 'content' is a file object holding the bytes sent by the server
+    (in memory for most records, in a temporary file for very large ones),
+    'size' is the number of bytes, and 'info' is the RecordInfo object for the
+    record.  If 'complete' is False, the download was stopped early, and both
+    'content' and 'info' are incomplete.  Call close() when done.
+    '''
 
-def eprints_status(xml):
-    status = xml.find('.//{' + _EPRINTS_XMLNS + '}eprint_status')
-    return status.text if status != None else ''
+    __slots__ = ('content', 'size', 'info', 'complete')
 
+    def __init__(self, content, size, info, complete):
+        self.content  = content
+        self.size     = size
+        self.info     = info
+        self.complete = complete
 
-def eprints_documents(xml):
-    files = []
-    # Ignore documents that are derived versions of original docs. These are
-    # thumbnails and the indexcodes.txt file.
-    for document in xml.findall('.//{' + _EPRINTS_XMLNS + '}document'):
-        url = document.find('.//{' + _EPRINTS_XMLNS + '}url')
-        if url == None:
-            if hasattr(document, 'attrib'):
-                if __debug__: log(f"ignoring doc with no file: {document.attrib['id']}")
-            else:
-                if __debug__: log(f'ignoring document {document}')
-            continue
-        if eprints_derived_file(document):
-            if __debug__: log(f'ignoring derived file {url.text}')
-        else:
-            files.append(url.text)
-    return files
+
+    def close(self):
+        self.content.close()
+
+
+def eprints_field(number, field, base_url, user, password, session = None):
+    '''Return the value of the single field 'field' (e.g., "lastmod") of
+    record 'number' as a string, using the EPrints REST API's field access
+    (e.g., /eprint/1234/lastmod.txt), or None if the value could not be
+    obtained that way for any reason.  Fetching a single field is much
+    cheaper than fetching the whole record, but not all servers allow it,
+    so callers must be prepared to fall back to using the full record.'''
+    url = eprints_api(base_url, f'/eprint/{number}/{field}.txt', user, password)
+    (response, error) = net('get', url, session)
+    if error or not response or response.status_code != 200:
+        if __debug__: log(f'could not get field {field} of record {number}')
+        return None
+    value = response.text.strip()
+    # Some servers answer with an HTML page (e.g., a login or error page).
+    if not value or value.startswith('<'):
+        return None
+    return value
+
+
+class RecordInfo(object):
+    '''Values of the fields of an EPrints record that eprints2bags uses.'''
+
+    __slots__ = ('id', 'lastmod', 'status', 'official_url', 'documents', 'sizes', 'hashes')
+
+    def __init__(self):
+        self.id           = None   # Value of the "id" attribute of <eprint>.
+        self.lastmod      = None   # Last modification date as a datetime.
+        self.status       = None   # Value of <eprint_status>.
+        self.official_url = None   # Value of <official_url>.
+        self.documents    = []     # URLs of the documents, minus derived ones.
+        self.sizes        = {}     # Dict mapping file URLs to sizes in bytes.
+        self.hashes       = {}     # Dict mapping file URLs to MD5 checksums.
+
+
+def eprints_record_info(content):
+    '''Return a RecordInfo object with the values of the fields of the
+    record whose XML is 'content' (bytes).'''
+    parser = _RecordParser()
+    parser.feed(content)
+    parser.close()
+    return parser.info
 
 
 def eprints_derived_file(document):
-    for rel in document.findall('.//{' + _EPRINTS_XMLNS + '}relation'):
-        for type in rel.findall('.//{' + _EPRINTS_XMLNS + '}type'):
+    for rel in document.iter(_NS + 'relation'):
+        for type in rel.iter(_NS + 'type'):
             if type.text == 'http://eprints.org/relation/isVolatileVersionOf':
                 return True
     return False
 
 
-def eprints_record_id(xml):
-    node = xml.find('.//{' + _EPRINTS_XMLNS + '}eprint')
-    return node.attrib['id'] if 'id' in node.attrib else ''
+class _RecordParser(object):
+    # Incremental parser that fills in a RecordInfo object as the XML of a
+    # record is fed to it, in a single pass.  The elements of the tree are
+    # discarded as soon as they have been looked at, so that memory use does
+    # not grow with the size of the record.
+
+    def __init__(self):
+        self.info = RecordInfo()
+        # huge_tree lifts libxml2's limits on the sizes of text nodes, which
+        # records with embedded full text can exceed.
+        self._parser = etree.XMLPullParser(events = ('start', 'end'), huge_tree = True)
+
+
+    def feed(self, data):
+        self._parser.feed(data)
+        self._read_events()
 
 
-def eprints_official_url(xml):
-    node = xml.find('.//{' + _EPRINTS_XMLNS + '}official_url')
-    # Do not remove the explicit test for None below.
-    return node.text if node != None else ''
+    def close(self):
+        self._parser.close()
+        self._read_events()
+        info = self.info
+        info.id = info.id or ''
+        info.status = info.status or ''
+        info.official_url = info.official_url or ''
+
+
+    def _read_events(self):
+        info = self.info
+        for event, elem in self._parser.read_events():
+            tag = elem.tag
+            if event == 'start':
+                if tag == _NS + 'eprint' and info.id == None:
+                    info.id = elem.attrib.get('id', '')
+                continue
+            # Use the first occurrence of each field, as a find() would.
+            if tag == _NS + 'document':
+                _add_document(info, elem)
+            elif tag == _NS + 'lastmod' and info.lastmod == None:
+                info.lastmod = parsed_datetime(elem.text)
+            elif tag == _NS + 'eprint_status' and info.status == None:
+                info.status = elem.text or ''
+            elif tag == _NS + 'official_url' and info.official_url == None:
+                info.official_url = elem.text or ''
+            # Discard the fields of the record and the documents that are
+            # finished.  Nested elements go when their ancestor does.
+            parent = elem.getparent()
+            if parent is not None and parent.tag in _RECORD_PARTS:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+
+def _record_xml(number, chunks, stop):
+    # Saves and parses the chunks of the content of record 'number'.
+    parser = _RecordParser()
+    content = SpooledTemporaryFile(max_size = _SPOOL_SIZE)
+    size = 0
+    for chunk in chunks:
+        content.write(chunk)
+        size += len(chunk)
+        parser.feed(chunk)
+        if stop and stop(parser.info):
+            if __debug__: log(f'stopped reading record {number} after {size} bytes')
+            content.seek(0)
+            return RecordXML(content, size, parser.info, False)
+    parser.close()
+    content.seek(0)
+    return RecordXML(content, size, parser.info, True)
+
+
+def _add_document(info, document):
+    # Record the sizes and checksums of all the files of the document.
+    for file in document.iter(_NS + 'file'):
+        url = file.find(_NS + 'url')
+        size = file.find(_NS + 'filesize')
+        hash = file.find(_NS + 'hash')
+        hash_type = file.find(_NS + 'hash_type')
+        # Do not remove the explicit tests for None below.
+        if url == None:
+            continue
+        if size != None and size.text and size.text.isdigit():
+            info.sizes[url.text] = int(size.text)
+        if (hash != None and hash.text and hash_type != None
+            and (hash_type.text or '').upper() == 'MD5'):
+            info.hashes[url.text] = hash.text.strip().lower()
+    # Ignore documents that are derived versions of original docs. These are
+    # thumbnails and the indexcodes.txt file.
+    url = next(document.iter(_NS + 'url'), None)
+    if url == None:
+        if __debug__: log(f"ignoring doc with no file: {document.attrib.get('id')}")
+    elif eprints_derived_file(document):
+        if __debug__: log(f'ignoring derived file {url.text}')
+    else:
+        info.documents.append(url.text)
+
+
+def record_content(content):
+    '''Generator yielding the byte strings that write_record() writes, in
+    order, to a file for the record XML in the file object 'content'.  The
+    server's bytes are used as they are, except that surrounding white space
+    is left out, an XML declaration is added if there is none, and the file
+    ends with a newline.  The content is read in chunks from the beginning.'''
+    content.seek(0)
+    started = False
+    trailing = b''
+    for chunk in iter(lambda: content.read(_RECORD_CHUNK_SIZE), b''):
+        if not started:
+            chunk = chunk.lstrip(_WHITESPACE)
+            if not chunk:
+                continue
+            started = True
+            if not chunk.startswith(b'<?xml'):
+                yield _XML_DECLARATION
+        # Hold back white space at the end, in case it's the end of the file.
+        body = chunk.rstrip(_WHITESPACE)
+        if body:
+            if trailing:
+                yield trailing
+            yield body
+            trailing = chunk[len(body):]
+        else:
+            trailing += chunk
+    yield b'\n'
 
 
-def write_record(number, xml, dir_prefix, dir_path):
+def write_record(number, content, dir_prefix, dir_path, algorithms = None):
+    '''Write the record XML in the file object 'content' (e.g., the content
+    of a RecordXML object) to a file in 'dir_path'.  If 'algorithms' is a list
+    of checksum algorithm names, returns a tuple of (file name, dict of hex
+    digests keyed by algorithm name) for the file written; otherwise, returns
+    a tuple of (file name, None).'''
     xml_file_name = dir_prefix + str(number) + '.xml'
-    encoded = etree.tostring(xml, encoding = 'UTF-8', method = 'xml')
     file_path = path.join(dir_path, xml_file_name)
+    digest = MultiDigest(algorithms) if algorithms else None
     if __debug__: log(f'writing file {file_path}')
-    with codecs.open(file_path, 'w', 'utf-8') as file:
-        file.write("<?xml version='1.0' encoding='utf-8'?>\n")
-        file.write(encoded.decode().rstrip() + '\n')
+    with open(file_path, 'wb') as file:
+        for piece in record_content(content):
+            file.write(piece)
+            if digest:
+                digest.update(piece)
+    return (xml_file_name, digest.hexdigests() if digest else None)
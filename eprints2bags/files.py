@@ -15,19 +15,25 @@ file "LICENSE" for more information.
 '''
 
 import gzip
+import hashlib
+import mmap
 import os
 from   os import path
 from   psutil import disk_partitions
 import shutil
 from   sidetrack import log
+import struct
 import sys
 import tarfile
 import tempfile
+from   timeit import default_timer as timer
 import zipfile
 from   zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+import zlib
 
 import eprints2bags
 from   eprints2bags.exceptions import *
+from   eprints2bags.hashing import DigestWriter
 
 
 # Constants.
@@ -49,6 +55,24 @@ KNOWN_SUBDIR_LIMITS = {
 }
 '''Maximum number of subdirectories for different types of file systems.'''
 
+_VERIFY_SIZE = 1024 * 1024
+'''Number of bytes read at a time from archive files when verifying them.'''
+
+_MEMBER_READ_SIZE = 256 * 1024
+'''Number of bytes of a file inside a tar file read at a time when verifying
+it.  Reading less than tarfile's buffer (_VERIFY_SIZE) at a time lets it hand
+out the data with less copying.'''
+
+_VERIFY_ALGORITHMS = ['md5', 'sha1', 'sha256', 'sha512']
+'''Checksum algorithms that verify_archive() can use to check the files in an
+archive against known checksums, in order of preference.  Only one is used
+per file, since any of them will detect corrupted data.'''
+
+_ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+'''Layout of the fixed part of a ZIP local file header, as far as needed to
+find where a file's data starts: signature, then the lengths of the file name
+and of the extra field.'''
+
 
 # Main functions.
 # .............................................................................
@@ -96,6 +120,24 @@ def fs_type(p):
     return root_type
 
 
+def rotational_disk(p):
+    '''Return True if the path 'p' is on a rotating (non-solid state) disk,
+    False if it is not, and None if that can't be determined.  This is only
+    known on Linux.'''
+    try:
+        dev = os.stat(p).st_dev
+        block = f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}'
+        # For a partition, the information is in the parent device.
+        for queue in [path.join(block, 'queue'), path.join(block, '..', 'queue')]:
+            flag = path.join(queue, 'rotational')
+            if path.exists(flag):
+                with open(flag, 'r') as f:
+                    return f.read().strip() == '1'
+    except (OSError, AttributeError):
+        pass
+    return None
+
+
 def make_dir(dir_path):
     '''Creates directory 'dir_path' (including intermediate directories).'''
     if path.isdir(dir_path):
@@ -116,48 +158,263 @@ def archive_extension(type):
         raise InternalError(f'Unrecognized archive format: {type}')
 
 
-def create_archive(archive_file, type, source_dir, comment = None):
+def create_archive(archive_file, type, source_dir, comment = None, algorithms = None):
+    '''Create an archive file of the given 'type' from the directory
+    'source_dir'.  If 'algorithms' is a list of checksum algorithm names, the
+    checksums of the archive file are computed while it is being written, and
+    returned as a dict of hex digests keyed by algorithm name; otherwise,
+    this returns None.'''
     root_dir = path.dirname(path.normpath(source_dir))
     base_dir = path.basename(source_dir)
-    if type.endswith('zip'):
-        format = ZIP_STORED if type.startswith('uncompress') else ZIP_DEFLATED
-        current_dir = os.getcwd()
-        try:
-            if root_dir != '':
-                os.chdir(root_dir)
-            with zipfile.ZipFile(archive_file, 'w', format) as zf:
-                for root, dirs, files in os.walk(base_dir):
-                    for file in files:
-                        zf.write(os.path.join(root, file))
+    with open(archive_file, 'wb') as file:
+        # To compute checksums while writing, the archive has to be written
+        # sequentially; zipfile then puts the sizes and CRCs of the entries
+        # after their contents instead of going back to fill them in.
+        out = DigestWriter(file, algorithms) if algorithms else file
+        if type.endswith('zip'):
+            format = ZIP_STORED if type.startswith('uncompress') else ZIP_DEFLATED
+            # Note: don't chdir() here, because the current directory is shared
+            # by all threads and other records may be processed concurrently.
+            with zipfile.ZipFile(out, 'w', format) as zf:
+                for root, dirs, files in os.walk(source_dir):
+                    for name in files:
+                        file_path = path.join(root, name)
+                        zf.write(file_path, path.relpath(file_path, root_dir or os.curdir))
                 if comment:
                     zf.comment = comment.encode()
-        finally:
-            os.chdir(current_dir)
-    else:
-        if type.startswith('uncompress'):
-            shutil.make_archive(source_dir, 'tar', root_dir, base_dir)
         else:
-            shutil.make_archive(source_dir, 'gztar', root_dir, base_dir)
+            # Use tarfile directly rather than shutil.make_archive(), because
+            # the latter changes the current directory in some versions of
+            # Python.  The stream modes write the file in a single pass.
+            mode = 'w|' if type.startswith('uncompress') else 'w|gz'
+            with tarfile.open(fileobj = out, mode = mode) as tf:
+                tf.add(source_dir, arcname = base_dir)
+    return out.hexdigests() if algorithms else None
 
 
-def verify_archive(archive_file, type):
-    '''Check the integrity of an archive and raise an exception if needed.'''
-    if type.endswith('zip'):
-        error = ZipFile(archive_file).testzip()
-        if error:
-            raise CorruptedContent(f'Failed to verify file "{archive_file}"')
-    else:
-        # Algorithm originally from https://stackoverflow.com/a/32312857/743730
-        tfile = None
+def verify_archive(archive_file, type, fast = False, digests = None, stats = None):
+    '''Check the integrity of an archive and raise an exception if needed.
+    If 'fast' is True, only check that the archive's table of contents (for
+    ZIP files) or first entry (for tar files) can be read, without reading
+    the contents of all the files in the archive.
+
+    Otherwise, the archive is read once, from start to end, in large blocks,
+    and checked against the CRCs that ZIP and gzip store in it when it is
+    written.  If 'digests' is not None, it must be a dict mapping the names
+    of files in the archive to dicts of hex digests keyed by algorithm name,
+    as recorded when the files were written (e.g., from the bag manifests);
+    those files must be present and are also checked against one of the
+    digests.  Uncompressed archives are read through a memory map if possible.
+    If 'stats' is a Throughput object, the number of bytes checked and the
+    time it took are added to it.'''
+    if fast:
         try:
-            tfile = tarfile.open(archive_file)
-            for member in tfile.getmembers():
-                content = tfile.extractfile(member.name)
-                if content:
-                    for chunk in iter(lambda: content.read(1024), b''):
-                        pass
+            if type.endswith('zip'):
+                with ZipFile(archive_file) as zf:
+                    zf.infolist()
+            else:
+                with tarfile.open(archive_file) as tf:
+                    if tf.next() == None:
+                        raise CorruptedContent('empty archive')
         except Exception as ex:
             raise CorruptedContent(f'Failed to verify file "{archive_file}"')
+        return
+    if stats:
+        stats.start()
+    size = 0
+    try:
+        size = _verify_archive(archive_file, type, digests or {})
+    finally:
+        if stats:
+            stats.end(size)
+
+
+# Helper functions.
+# .............................................................................
+
+def _verify_archive(archive_file, type, digests):
+    # Does the work of verify_archive() when 'fast' is False.
+    # Returns the number of bytes checked.
+    start = timer()
+    try:
+        if type.endswith('zip'):
+            checked = _verify_zip(archive_file, digests)
+        else:
+            checked = _verify_tar(archive_file, type, digests)
+    except CorruptedContent:
+        raise
+    except Exception as ex:
+        if __debug__: log(f'verification of {archive_file} failed: {str(ex)}')
+        raise CorruptedContent(f'Failed to verify file "{archive_file}"')
+    for name in digests:
+        if name not in checked:
+            raise CorruptedContent(f'File "{archive_file}" is missing {name}')
+    size = sum(checked.values())
+    if __debug__: log(f'verified {len(checked)} files ({size} bytes) in {archive_file}'
+                      + f' in {timer() - start:.2f} s')
+    return size
+
+
+def _verify_zip(archive_file, digests):
+    # Returns a dict mapping the names of the files checked to their sizes.
+    # Stored (uncompressed) files are read straight from a memory map, and
+    # their CRCs are computed here; zipfile checks the CRCs of other files
+    # as it reads them.
+    checked = {}
+    with open(archive_file, 'rb') as f, ZipFile(f) as zf:
+        mapped = _mapped(f)
+        try:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                expected = _expected_digest(info.filename, digests)
+                hash = hashlib.new(expected[0]) if expected else None
+                if mapped and info.compress_type == ZIP_STORED:
+                    crc = _mapped_zip_member(mapped, info, hash)
+                    if crc != info.CRC:
+                        raise CorruptedContent(f'Bad CRC for {info.filename}'
+                                               + f' in file "{archive_file}"')
+                else:
+                    with zf.open(info) as content:
+                        for chunk in iter(lambda: content.read(_VERIFY_SIZE), b''):
+                            if hash:
+                                hash.update(chunk)
+                _check_digest(archive_file, info.filename, hash, expected)
+                checked[info.filename] = info.file_size
         finally:
-            if tfile:
-                tfile.close()
+            if mapped:
+                mapped.close()
+    return checked
+
+
+def _mapped_zip_member(mapped, info, hash):
+    # Returns the CRC of the data of the stored file described by 'info'.
+    offset = info.header_offset
+    signature, name_length, extra_length = _ZIP_LOCAL_HEADER.unpack_from(mapped, offset)
+    if signature != b'PK\x03\x04':
+        raise CorruptedContent(f'Bad header for {info.filename}')
+    offset += _ZIP_LOCAL_HEADER.size + name_length + extra_length
+    with memoryview(mapped) as view:
+        with view[offset:offset + info.compress_size] as data:
+            if len(data) != info.compress_size:
+                raise CorruptedContent(f'Truncated data for {info.filename}')
+            crc = zlib.crc32(data)
+            if hash:
+                hash.update(data)
+    return crc
+
+
+def _verify_tar(archive_file, type, digests):
+    # Returns a dict mapping the names of the files checked to their sizes.
+    if type.startswith('uncompress'):
+        with open(archive_file, 'rb') as f:
+            mapped = _mapped(f)
+            if mapped:
+                try:
+                    return _verify_mapped_tar(archive_file, mapped, digests)
+                finally:
+                    mapped.close()
+    checked = {}
+    with open(archive_file, 'rb', buffering = _VERIFY_SIZE) as f:
+        source = f if type.startswith('uncompress') else _GzipReader(f)
+        # Stream mode reads the archive strictly from start to end.
+        with tarfile.open(fileobj = source, mode = 'r|', bufsize = _VERIFY_SIZE) as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                expected = _expected_digest(member.name, digests)
+                hash = hashlib.new(expected[0]) if expected else None
+                content = tf.extractfile(member)
+                for chunk in iter(lambda: content.read(_MEMBER_READ_SIZE), b''):
+                    if hash:
+                        hash.update(chunk)
+                _check_digest(archive_file, member.name, hash, expected)
+                checked[member.name] = member.size
+        # Read whatever follows the end of the archive, so that all of the
+        # compressed data is checked.
+        while source.read(_VERIFY_SIZE):
+            pass
+    return checked
+
+
+def _verify_mapped_tar(archive_file, mapped, digests):
+    # Uncompressed tar files have no checksums of their own, so only files
+    # with known digests need their contents read.  The headers are read
+    # from the memory map too, as a file.  The sizes returned are the
+    # numbers of bytes read.
+    checked = {}
+    with memoryview(mapped) as view, tarfile.open(fileobj = mapped, mode = 'r:') as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            expected = _expected_digest(member.name, digests)
+            end = member.offset_data + member.size
+            if end > len(view):
+                raise CorruptedContent(f'Truncated data for {member.name}')
+            if expected:
+                hash = hashlib.new(expected[0])
+                with view[member.offset_data:end] as data:
+                    hash.update(data)
+                _check_digest(archive_file, member.name, hash, expected)
+            checked[member.name] = member.size if expected else 0
+    return checked
+
+
+class _GzipReader(object):
+    # Read-only file object giving the decompressed contents of the gzip
+    # file 'file'.  Unlike gzip.GzipFile, it decompresses in large blocks.
+    # zlib checks the CRC and length stored at the end of the data.
+
+    def __init__(self, file):
+        self._file  = file
+        self._zlib  = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._input = b''
+
+
+    def read(self, size = -1):
+        while True:
+            if not self._input:
+                self._input = self._file.read(_VERIFY_SIZE)
+                if not self._input:
+                    if not self._zlib.eof:
+                        raise EOFError('Compressed data ended unexpectedly')
+                    return b''
+            if self._zlib.eof:
+                # Another gzip member may follow, possibly after padding.
+                self._input = self._input.lstrip(b'\0')
+                if not self._input:
+                    continue
+                self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = self._zlib.decompress(self._input, max(size, 0))
+            if self._zlib.eof:
+                self._input = self._zlib.unused_data
+            else:
+                self._input = self._zlib.unconsumed_tail
+            if data:
+                return data
+
+
+def _mapped(file):
+    # Returns a read-only memory map of the open 'file', or None if it
+    # can't be mapped (e.g., if it's empty or too big for the address space).
+    try:
+        return mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+    except (OSError, ValueError, OverflowError) as ex:
+        if __debug__: log(f'unable to map {file.name}: {str(ex)}')
+        return None
+
+
+def _expected_digest(name, digests):
+    # Returns a tuple (algorithm, hex digest) for the file 'name', or None.
+    known = digests.get(name)
+    if known:
+        for alg in _VERIFY_ALGORITHMS:
+            if alg in known:
+                return (alg, known[alg].lower())
+    return None
+
+
+def _check_digest(archive_file, name, hash, expected):
+    if expected and hash.hexdigest() != expected[1]:
+        raise CorruptedContent(f'Checksum mismatch for {name} in file "{archive_file}"')
+
@@ -0,0 +1,303 @@
+'''
+hashing.py: utilities for computing file checksums.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import mmap
+import multiprocessing
+import os
+from   sidetrack import log
+from   threading import Lock, local
+from   timeit import default_timer as timer
+
+import eprints2bags
+
+
+# Constants.
+# .............................................................................
+
+_READ_SIZE = 1024 * 1024
+'''Number of bytes read from a file at a time when computing checksums.'''
+
+_BUFFER_SIZE = 8 * 1024 * 1024
+'''Size of the buffer into which ThreadedHasher reads files.'''
+
+_BATCH_SIZE = 16 * 1024 * 1024
+'''Files smaller than this many bytes are grouped into tasks of about this
+many bytes in total, so that many small files do not cost one round trip to a
+worker each.  Larger files get a task of their own.'''
+
+
+# Main classes and functions.
+# .............................................................................
+
+class MultiDigest(object):
+    '''Compute several checksums over the same stream of bytes at once.
+    Bytes are handed to update() as they become available, e.g., while they
+    are being downloaded or written, so that the data only needs to pass
+    through memory once no matter how many checksum algorithms are needed.'''
+
+    __slots__ = ('size', '_hashes')
+
+    def __init__(self, algorithms):
+        self.size    = 0
+        self._hashes = {alg: hashlib.new(alg) for alg in algorithms}
+
+
+    def update(self, data):
+        for hash in self._hashes.values():
+            hash.update(data)
+        self.size += len(data)
+
+
+    def hexdigests(self):
+        '''Return a dict mapping algorithm names to hex digest strings.'''
+        return {alg: hash.hexdigest() for alg, hash in self._hashes.items()}
+
+
+class DigestWriter(object):
+    '''Write-only file object that passes the data written to it on to the
+    file object 'file' and computes the checksums named in 'algorithms' over
+    it at the same time.  It cannot seek, so libraries that write archives
+    (zipfile, tarfile) write to it sequentially, in a single pass.'''
+
+    def __init__(self, file, algorithms):
+        self._file   = file
+        self._digest = MultiDigest(algorithms)
+
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._file.write(data)
+
+
+    def flush(self):
+        self._file.flush()
+
+
+    def hexdigests(self):
+        '''Return a dict mapping algorithm names to hex digest strings.'''
+        return self._digest.hexdigests()
+
+
+def file_digests(file, algorithms):
+    '''Read 'file' once and return a tuple (digests, size), where 'digests'
+    is a dict mapping each algorithm in 'algorithms' to a hex digest string
+    and 'size' is the number of bytes in the file.'''
+    if __debug__: log(f'computing checksums of {file}')
+    digest = MultiDigest(algorithms)
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(_READ_SIZE), b''):
+            digest.update(chunk)
+    return (digest.hexdigests(), digest.size)
+
+
+class Throughput(object):
+    '''Running total of a number of bytes processed and the time it took.
+    Each piece of work is bracketed by calls to start() and end(), which may
+    come from several threads at once.  The time counted is the time during
+    which at least one piece of work was in progress, i.e., from the first
+    start() to the last end() of every run of overlapping pieces of work, so
+    that work done concurrently is not counted more than once.'''
+
+    def __init__(self):
+        self.bytes   = 0
+        self.seconds = 0
+        self._active = 0
+        self._since  = None
+        self._lock   = Lock()
+
+
+    def start(self):
+        with self._lock:
+            if self._active == 0:
+                self._since = timer()
+            self._active += 1
+
+
+    def end(self, size):
+        with self._lock:
+            self.bytes += size
+            self._active -= 1
+            if self._active == 0:
+                self.seconds += timer() - self._since
+
+
+    def rate(self):
+        '''Return the throughput so far, in MB per second.'''
+        with self._lock:
+            seconds = self.seconds
+            if self._active > 0:
+                seconds += timer() - self._since
+            return self.bytes / 1000000 / seconds if seconds > 0 else 0
+
+
+class Hasher(object):
+    '''Base class for the engines that compute the checksums of files using
+    'workers' workers.  Subclasses implement _file_digests().  The engines
+    keep track of the number of bytes hashed and the time spent doing it in
+    the Throughput object 'stats', so that the throughput can be reported.'''
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.stats   = Throughput()
+
+
+    def file_digests(self, files, algorithms):
+        '''Return a dict mapping each file in 'files' to a tuple (digests,
+        size) as returned by the function file_digests().'''
+        if not files:
+            return {}
+        self.stats.start()
+        size = 0
+        try:
+            results = self._file_digests(files, algorithms)
+            size = sum(size for _, size in results.values())
+        finally:
+            self.stats.end(size)
+        if __debug__: log(f'hashed {len(files)} files ({size} bytes)')
+        return results
+
+
+    def close(self):
+        pass
+
+
+class HashingPool(Hasher):
+    '''Hasher using a pool of 'workers' worker processes.
+
+    The pool is meant to be created once and used for all the files hashed
+    during a run, so that the cost of starting the processes is only paid
+    once.  The work is divided according to the sizes of the files, not their
+    number: each large file is a task of its own, and small files are grouped
+    into tasks of similar total size.  Every file is read only once, with all
+    the checksum algorithms fed from the same blocks.  (The algorithms are
+    sequential, so the hashing of a single file can't be split among workers
+    without reading the file once per algorithm, which costs more on disk
+    than it saves in computation.)  The tasks are handed out largest first,
+    so that a large file does not hold up the end.
+    '''
+
+    def __init__(self, workers):
+        super().__init__(workers)
+        self._executor = None
+        if workers > 1:
+            # Forking a process that runs threads is unsafe, so the workers
+            # are started fresh instead.
+            context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(workers, mp_context = context)
+            if __debug__: log(f'started hashing pool with {workers} processes')
+
+
+    def _file_digests(self, files, algorithms):
+        sizes = {file: os.stat(file).st_size for file in files}
+        tasks = _hashing_tasks(sizes)
+        if self._executor and len(tasks) > 1:
+            results = self._executor.map(_run_task, tasks, [algorithms] * len(tasks))
+        else:
+            results = map(_run_task, tasks, [algorithms] * len(tasks))
+        return {file: (digests, sizes[file])
+                for task_results in results for file, digests in task_results}
+
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class ThreadedHasher(Hasher):
+    '''Hasher using a pool of 'workers' threads.
+
+    Each file is read only once, into a large page-aligned buffer, and every
+    block read is fed to all the checksum algorithms.  The hashlib functions
+    release the GIL while they work on large blocks, so the threads compute
+    checksums in parallel without the cost of handing data to processes.
+    '''
+
+    def __init__(self, workers):
+        super().__init__(workers)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix = 'hasher')
+        self._buffers  = local()
+        if __debug__: log(f'started hashing thread pool with {workers} threads')
+
+
+    def _file_digests(self, files, algorithms):
+        # Start with the largest files, so that a large file doesn't hold up
+        # the end while the other threads have nothing to do.
+        ordered = sorted(files, key = lambda file: os.stat(file).st_size, reverse = True)
+        results = self._executor.map(lambda file: self._read_digests(file, algorithms), ordered)
+        return dict(zip(ordered, results))
+
+
+    def _read_digests(self, file, algorithms):
+        # An anonymous mmap is page-aligned, which suits large reads.  Each
+        # thread reuses its own buffer.
+        buffer = getattr(self._buffers, 'buffer', None)
+        if buffer == None:
+            buffer = self._buffers.buffer = mmap.mmap(-1, _BUFFER_SIZE)
+        view = memoryview(buffer)
+        digest = MultiDigest(algorithms)
+        try:
+            with open(file, 'rb', buffering = 0) as f:
+                while True:
+                    count = f.readinto(buffer)
+                    if not count:
+                        break
+                    digest.update(view[:count])
+        finally:
+            view.release()
+        return (digest.hexdigests(), digest.size)
+
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def new_hasher(engine, workers):
+    '''Return a Hasher of the kind named by 'engine' ("threads" or
+    "processes") with 'workers' workers.'''
+    if engine == 'processes':
+        return HashingPool(workers)
+    return ThreadedHasher(workers)
+
+
+# Helper functions.
+# .............................................................................
+
+def _hashing_tasks(sizes):
+    # Each task is a list of files.
+    tasks = []
+    batch = []
+    batch_bytes = 0
+    for file, size in sorted(sizes.items(), key = lambda item: item[1], reverse = True):
+        if size >= _BATCH_SIZE:
+            tasks.append([file])
+            continue
+        batch.append(file)
+        batch_bytes += size
+        if batch_bytes >= _BATCH_SIZE:
+            tasks.append(batch)
+            batch = []
+            batch_bytes = 0
+    if batch:
+        tasks.append(batch)
+    return tasks
+
+
+def _run_task(task, algorithms):
+    return [(file, file_digests(file, algorithms)[0]) for file in task]
+
@@ -15,8 +15,11 @@ file "LICENSE" for more information.
 '''
 
 from   bun import inform, warn, alert, alert_fatal
+from   concurrent.futures import ThreadPoolExecutor
 import http.client
 from   http.client import responses as http_responses
+import json
+import os
 from   os import path, stat
 import requests
 from   requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -33,6 +36,8 @@ import warnings
 
 import eprints2bags
 from   .exceptions import *
+from   .hashing import MultiDigest, file_digests
+from   .ratelimit import RateLimiter
 
 
 # Constants.
@@ -49,6 +54,19 @@ _MAX_RETRIES = 5
 '''Maximum number of times we back off and try again.  This also affects the
 maximum wait time that will be reached after repeated retries.'''
 
+_CHUNK_SIZE = 256 * 1024
+'''Number of bytes read at a time from the network when downloading files.'''
+
+_PART_SUFFIX = '.part'
+'''Suffix of the staging file that a download is written to until it is done.'''
+
+_JOURNAL_SUFFIX = '.json'
+'''Suffix (added to the staging file name) of the file that records what
+is needed to resume an interrupted download.'''
+
+_POOL_SIZE = 10
+'''Default number of persistent connections kept open to a given host.'''
+
 
 # Main functions.
 # .............................................................................
@@ -86,6 +104,55 @@ def host_from_netloc(nl):
     return nl[:nl.find(':')] if ':' in nl else nl
 
 
+class LimitedSession(requests.Session):
+    '''A requests.Session whose requests are paced by a RateLimiter.  Every
+    request waits for permission from the limiter before it is sent, and the
+    response's status code is reported back to the limiter, so that all the
+    threads sharing the session slow down together when the server signals
+    that it is overloaded.'''
+
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+
+
+    def request(self, method, url, *args, **kwargs):
+        host = urlsplit(url).netloc
+        self.limiter.acquire(host)
+        code = retry_after = None
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            code = response.status_code
+            retry_after = response.headers.get('Retry-After')
+            return response
+        finally:
+            self.limiter.release(host, code, retry_after)
+
+
+def new_session(pool_size = _POOL_SIZE, max_rate = None):
+    '''Return a requests.Session object whose connection pool keeps up to
+    'pool_size' connections open to each host.  Connections are kept alive
+    between requests, so that repeated calls to the same server reuse an
+    existing TCP connection (and its negotiated TLS session) instead of doing
+    a new handshake each time.  The caller should call close() on the session
+    when it is done with it.
+
+    Requests made through the session are paced by a RateLimiter (available
+    as the session's 'limiter' attribute), which adapts to the server's
+    responses.  If 'max_rate' is not None, it also caps the number of
+    requests per second made to any one host.
+    '''
+    if __debug__: log(f'creating network session with pool size {pool_size}')
+    session = LimitedSession(RateLimiter(max_rate))
+    # Retries are handled by timed_request(), so turn them off in urllib3.
+    adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size,
+                                            pool_maxsize = pool_size,
+                                            max_retries = 0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 def timed_request(get_or_post, url, session = None, timeout = 20, **kwargs):
     '''Perform a network "get" or "post", handling timeouts and retries.
     If "session" is not None, it is used as a requests.Session object.
@@ -126,49 +193,219 @@ def timed_request(get_or_post, url, session = None, timeout = 20, **kwargs):
                 retries += 1
                 failures = 0
                 if __debug__: log('pausing because of consecutive failures')
-                sleep(10 * retries * retries)
+                _back_off(session, url, 10 * retries * retries)
             else:
                 # We've already paused & restarted once.
                 raise error
 
 
-def download_files(downloads_list, user, pswd, output_dir, missing_ok):
-    for item in downloads_list:
-        file = path.realpath(path.join(output_dir, path.basename(item)))
-        inform(f'Downloading {item}')
-        failures = 0
-        retry = True
-        while retry and failures < _MAX_FAILURES:
-            # Don't retry unless the problem may be transient.
-            retry = False
-            error = None
-            try:
-                download(item, user, pswd, file)
-            except (NoContent, ServiceFailure, AuthenticationFailure) as ex:
-                if missing_ok:
-                    alert(str(ex))
-                    failures = 0
-                else:
-                    error = ex
-            except Exception as ex:
-                # Something unexpected.  Don't retry this entry, but count
-                # this failure in case we're up against a roadblock.
-                if __debug__: log(f'download exception: {str(ex)}')
+def download_files(downloads_list, user, pswd, output_dir, missing_ok,
+                   session = None, workers = 1, algorithms = None, sizes = None,
+                   store = None, hashes = None):
+    '''Download the files in 'downloads_list' into the directory 'output_dir'.
+    If 'workers' is greater than 1, up to that many files are downloaded
+    concurrently using a pool of threads.  Either way, if errors occur, the
+    one raised is the error for the earliest item in 'downloads_list'.
+
+    If 'algorithms' is a list of checksum algorithm names, the checksums of
+    each file are computed as the file is downloaded.  The return value is a
+    dict mapping the names of the files written to dicts of hex digests keyed
+    by algorithm name (or to None, if 'algorithms' is None).
+
+    If 'sizes' is not None, it must be a dict mapping URLs to the number of
+    bytes expected for them; downloads of a different size are rejected.
+
+    If 'store' is not None, it must be a BlobStore object.  Files already in
+    the store are linked from it instead of being downloaded, and files that
+    are downloaded are added to it.  If 'hashes' is not None, it must be a
+    dict mapping URLs to the MD5 checksums expected for them; stored files
+    with a different checksum are not used.
+    '''
+    sizes = sizes or {}
+    hashes = hashes or {}
+    results = {}
+    if workers <= 1 or len(downloads_list) <= 1:
+        for item in downloads_list:
+            (file, digests, error) = download_item(item, user, pswd, output_dir,
+                                                   missing_ok, session, algorithms,
+                                                   sizes.get(item), store,
+                                                   hashes.get(item))
+            if error:
+                raise error
+            if file:
+                results[file] = digests
+        return results
+
+    if __debug__: log(f'downloading {len(downloads_list)} files using {workers} threads')
+    with ThreadPoolExecutor(max_workers = min(workers, len(downloads_list))) as executor:
+        futures = [executor.submit(download_item, item, user, pswd, output_dir,
+                                   missing_ok, session, algorithms, sizes.get(item),
+                                   store, hashes.get(item))
+                   for item in downloads_list]
+        # Wait for results in list order.  When an item fails, don't start any
+        # items after it, but let the ones before it finish, so that the error
+        # we report is the same one a sequential download would have raised.
+        for index, future in enumerate(futures):
+            (file, digests, error) = future.result()
+            if error:
+                for pending in futures[index + 1:]:
+                    pending.cancel()
+                raise error
+            if file:
+                results[file] = digests
+    return results
+
+
+def download_item(item, user, pswd, output_dir, missing_ok, session = None,
+                  algorithms = None, expected_size = None, store = None,
+                  expected_md5 = None):
+    '''Download one file, retrying if the problem may be transient.  Returns
+    a tuple (file name, digests, error).  If successful, the error is None;
+    if the file is missing and 'missing_ok' is True, all elements are None;
+    otherwise, the error is an exception object describing the problem.'''
+    name = path.basename(item)
+    file = path.realpath(path.join(output_dir, name))
+    if store:
+        digests = store.fetch(item, expected_size, file, expected_md5)
+        if digests != None:
+            inform(f'Using stored copy of {item}')
+            if not algorithms:
+                digests = None
+            elif not all(alg in digests for alg in algorithms):
+                digests, _ = file_digests(file, algorithms)
+            return (name, digests, None)
+        # The store needs its own checksum of everything added to it.
+        wanted = algorithms
+        algorithms = store.algorithms(algorithms)
+    inform(f'Downloading {item}')
+    failures = 0
+    retry = True
+    error = None
+    while retry and failures < _MAX_FAILURES:
+        # Don't retry unless the problem may be transient.
+        retry = False
+        error = None
+        try:
+            digests = download(item, user, pswd, file, session = session,
+                               algorithms = algorithms, expected_size = expected_size)
+            if store:
+                store.add(item, file, digests)
+                digests = digests if wanted else None
+            return (name, digests, None)
+        except (NoContent, ServiceFailure, AuthenticationFailure) as ex:
+            if missing_ok:
+                alert(str(ex))
+                failures = 0
+            else:
                 error = ex
-                failures += 1
-                retry = True
+        except Exception as ex:
+            # Something unexpected.  Don't retry this entry, but count
+            # this failure in case we're up against a roadblock.
+            if __debug__: log(f'download exception: {str(ex)}')
+            error = ex
+            failures += 1
+            retry = True
+    return (None, None, error)
+
+
+def stream_files(downloads_list, user, pswd, writer, missing_ok,
+                 session = None, sizes = None, store = None, hashes = None):
+    '''Download the files in 'downloads_list' and hand their contents to
+    'writer' as they arrive, instead of writing them to files.  'Writer'
+    must have a method add(name, chunks, size) that consumes the iterator
+    'chunks' over the bytes of the file 'name' ('size' is the number of bytes
+    expected, or None if unknown) and returns a dict of hex digests keyed by
+    algorithm name; BagArchiveWriter is such an object.  The files are
+    downloaded one at a time, in list order, because the writer can only
+    take one file at a time.  The return value and the arguments 'sizes',
+    'store' and 'hashes' are as for download_files(), except that files
+    downloaded here are not added to the store, since they are not written
+    to files.
+    '''
+    sizes = sizes or {}
+    hashes = hashes or {}
+    results = {}
+    for item in downloads_list:
+        (name, digests, error) = stream_item(item, user, pswd, writer, missing_ok,
+                                             session, sizes.get(item), store,
+                                             hashes.get(item))
         if error:
             raise error
-        continue
+        if name:
+            results[name] = digests
+    return results
+
+
+def stream_item(item, user, pswd, writer, missing_ok, session = None,
+                expected_size = None, store = None, expected_md5 = None):
+    '''Download one file and hand it to 'writer', as for stream_files().
+    Returns a tuple (file name, digests, error) like download_item().  The
+    request is retried if the problem may be transient, but a download that
+    fails after 'writer' has started taking the data cannot be retried.'''
+    name = path.basename(item)
+    if store:
+        found = store.lookup(item, expected_size, expected_md5)
+        if found:
+            inform(f'Using stored copy of {item}')
+            with open(found[0], 'rb') as f:
+                chunks = iter(lambda: f.read(_CHUNK_SIZE), b'')
+                return (name, writer.add(name, chunks, expected_size), None)
+    inform(f'Downloading {item}')
+    failures = 0
+    retry = True
+    error = None
+    req = None
+    while retry and failures < _MAX_FAILURES:
+        # Don't retry unless the problem may be transient.
+        retry = False
+        error = None
+        (req, error) = net('get', item, session, stream = True, auth = (user, pswd))
+        if not error:
+            break
+        if req != None:
+            req.close()
+            req = None
+        if isinstance(error, (NoContent, ServiceFailure, AuthenticationFailure)):
+            if missing_ok:
+                alert(str(error))
+                error = None
+        else:
+            if __debug__: log(f'download exception: {str(error)}')
+            failures += 1
+            retry = True
+    if req == None:
+        return (None, None, error)
+    try:
+        return (name, _stream_response(req, item, name, writer, expected_size), None)
+    finally:
+        req.close()
 
 
-def download(url, user, password, local_destination, recursing = 0):
-    '''Download the 'url' to the file 'local_destination'.'''
+def download(url, user, password, local_destination, recursing = 0,
+             session = None, algorithms = None, expected_size = None):
+    '''Download the 'url' to the file 'local_destination'.  If 'session' is
+    not None, it is used as a requests.Session object.  If 'algorithms' is a
+    list of checksum algorithm names, the checksums of the data are computed
+    as it arrives and returned as a dict of hex digests keyed by algorithm
+    name; otherwise, this returns None.
+
+    The data is first written to a staging file named 'local_destination'
+    plus ".part", which is renamed to 'local_destination' only once the
+    download is complete and its size has been checked against the size
+    reported by the server and (if not None) 'expected_size'.  If a staging
+    file from an earlier, interrupted attempt exists (even one from a
+    previous run of the program), this asks the server for only the rest of
+    the data, provided the server's copy has not changed in the meantime.
+    '''
     def addurl(text):
         return f'{text} for {url}'
 
+    part_file = local_destination + _PART_SUFFIX
+    journal_file = part_file + _JOURNAL_SUFFIX
+    (start, headers) = _resume_point(url, part_file, journal_file)
     try:
-        req = timed_request('get', url, stream = True, auth = (user, password))
+        req = timed_request('get', url, session, stream = True,
+                            auth = (user, password), headers = headers)
     except requests.exceptions.ConnectionError as ex:
         if recursing >= _MAX_RECURSIVE_CALLS:
             raise NetworkFailure(addurl('Too many connection errors'))
@@ -187,7 +424,8 @@ def download(url, user, password, local_destination, recursing = 0):
             if __debug__: log('download() got ConnectionResetError; will recurse')
             sleep(1)                    # Sleep a short time and try again.
             recursing += 1
-            download(url, user, password, local_destination, recursing)
+            return download(url, user, password, local_destination, recursing,
+                            session, algorithms, expected_size)
         else:
             raise NetworkFailure(str(ex))
     except requests.exceptions.ReadTimeout as ex:
@@ -200,24 +438,48 @@ def download(url, user, password, local_destination, recursing = 0):
     except Exception as ex:
         raise
 
-    # Interpret the response.
+    # Interpret the response.  Streamed responses must be closed explicitly,
+    # or else their connections are not returned to the session's pool.
     code = req.status_code
+    if not (200 <= code < 400) or code == 202:
+        req.close()
     if code == 202:
         # Code 202 = Accepted, "received but not yet acted upon."
         sleep(1)                        # Sleep a short time and try again.
         recursing += 1
         if __debug__: log('calling download() recursively for http code 202')
-        download(url, user, password, local_destination, recursing)
-    elif 200 <= code < 400:
-        # This started as code in https://stackoverflow.com/a/13137873/743730
-        # Note: I couldn't get the shutil.copyfileobj approach to work; the
-        # file always ended up zero-length.  I couldn't figure out why.
-        with open(local_destination, 'wb') as f:
-            for chunk in req.iter_content(1024):
-                f.write(chunk)
+        return download(url, user, password, local_destination, recursing,
+                        session, algorithms, expected_size)
+    elif code == 416 and start > 0:
+        # The range we asked for is not satisfiable.  Either the staging file
+        # is already complete, or it doesn't match the server's copy anymore.
+        if expected_size != None and start == expected_size:
+            if __debug__: log(f'{part_file} is already complete')
+            return _finish_download(url, part_file, journal_file, local_destination,
+                                    None, algorithms, start, expected_size,
+                                    expected_size)
+        if __debug__: log(f'discarding {part_file} and starting over')
+        _discard_part(part_file, journal_file)
+        return download(url, user, password, local_destination, recursing,
+                        session, algorithms, expected_size)
+    elif code == 206 and _range_start(req) != start:
+        # This is not the part of the file we asked for (or we didn't ask
+        # for a part at all), so it can't be added to the staging file.
         req.close()
-        if __debug__: size = stat(local_destination).st_size
-        if __debug__: log(f'wrote {size} bytes to file {local_destination}')
+        if recursing >= _MAX_RECURSIVE_CALLS:
+            raise ServiceFailure(addurl('Server keeps sending the wrong range of data'))
+        if __debug__: log(f'got range starting at {_range_start(req)} instead of {start};'
+                          + f' discarding {part_file} and starting over')
+        _discard_part(part_file, journal_file)
+        return download(url, user, password, local_destination, recursing + 1,
+                        session, algorithms, expected_size)
+    elif 200 <= code < 400:
+        try:
+            return _write_response(req, url, part_file, journal_file,
+                                   local_destination, start, algorithms,
+                                   expected_size)
+        finally:
+            req.close()
     elif code in [401, 402, 403, 407, 451, 511]:
         raise AuthenticationFailure(addurl('Access is forbidden'))
     elif code in [404, 410]:
@@ -236,6 +498,149 @@ def download(url, user, password, local_destination, recursing = 0):
         raise NetworkFailure(f'Unable to resolve {url}')
 
 
+def _resume_point(url, part_file, journal_file):
+    '''Return a tuple (start, headers), where 'start' is the byte offset at
+    which to resume downloading 'url' into 'part_file' and 'headers' are the
+    HTTP headers to send with the request to do so.'''
+    if not path.exists(part_file):
+        return (0, {})
+    journal = {}
+    if path.exists(journal_file):
+        try:
+            with open(journal_file, 'r') as f:
+                journal = json.load(f)
+        except (OSError, ValueError) as ex:
+            if __debug__: log(f'unable to read {journal_file}: {str(ex)}')
+    # Only resume if we can be sure the server's copy hasn't changed since
+    # the staging file was started, i.e., if we have a validator for If-Range.
+    validator = journal.get('etag') or journal.get('last_modified')
+    start = stat(part_file).st_size
+    if journal.get('url') != url or not validator or start == 0:
+        _discard_part(part_file, journal_file)
+        return (0, {})
+    if __debug__: log(f'resuming download of {url} at byte {start}')
+    return (start, {'Range': f'bytes={start}-', 'If-Range': validator})
+
+
+def _write_response(req, url, part_file, journal_file, local_destination,
+                    start, algorithms, expected_size):
+    digest = MultiDigest(algorithms) if algorithms else None
+    if req.status_code == 206 and start > 0:
+        # The server is sending the rest of the file.  (download() has
+        # checked that it starts where the staging file ends.)  Pick up the checksum
+        # computations where they left off by reading what we already have.
+        if digest:
+            with open(part_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        mode = 'ab'
+        total = _range_total(req)
+    else:
+        # The server is sending the whole file, either because we didn't ask
+        # for a range or because its copy changed since we started.
+        start = 0
+        mode = 'wb'
+        if req.status_code == 206:
+            # A range starting at 0; it may not be the whole file.
+            total = _range_total(req)
+        else:
+            total = _int_or_none(req.headers.get('Content-Length'))
+        if req.headers.get('Content-Encoding'):
+            # Content-Length is the compressed size, not the size we write.
+            total = None
+        with open(journal_file, 'w') as f:
+            json.dump({'url'           : url,
+                       'etag'          : req.headers.get('ETag'),
+                       'last_modified' : req.headers.get('Last-Modified')}, f)
+
+    # This started as code in https://stackoverflow.com/a/13137873/743730
+    # Note: I couldn't get the shutil.copyfileobj approach to work; the
+    # file always ended up zero-length.  I couldn't figure out why.
+    written = start
+    try:
+        with open(part_file, mode) as f:
+            for chunk in req.iter_content(_CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+                if digest:
+                    digest.update(chunk)
+    except Exception as ex:
+        # Keep the staging file so that the next attempt can resume from here.
+        if __debug__: log(f'download of {url} interrupted after {written} bytes: {str(ex)}')
+        raise NetworkFailure(f'Download interrupted after {written} bytes for {url}')
+    return _finish_download(url, part_file, journal_file, local_destination,
+                            digest, algorithms, written, total, expected_size)
+
+
+def _finish_download(url, part_file, journal_file, local_destination, digest,
+                     algorithms, written, total, expected_size):
+    if total != None and written < total:
+        # Keep the staging file so that the next attempt can resume from here.
+        raise NetworkFailure(f'Received only {written} of {total} bytes for {url}')
+    if (total != None and written != total) or (expected_size != None
+                                                 and written != expected_size):
+        _discard_part(part_file, journal_file)
+        expected = expected_size if expected_size != None else total
+        raise CorruptedContent(f'Expected {expected} bytes but got {written} for {url}')
+    digests = digest.hexdigests() if digest else None
+    if algorithms and (not digest or digest.size != written):
+        # Some of the data was not seen by 'digest', so read the whole file.
+        digests, _ = file_digests(part_file, algorithms)
+    os.replace(part_file, local_destination)
+    if path.exists(journal_file):
+        os.remove(journal_file)
+    if __debug__: log(f'wrote {written} bytes to file {local_destination}')
+    return digests
+
+
+def _stream_response(req, url, name, writer, expected_size):
+    total = _int_or_none(req.headers.get('Content-Length'))
+    if req.headers.get('Content-Encoding'):
+        # Content-Length is the compressed size, not the size we get.
+        total = None
+    if total != None and expected_size != None and total != expected_size:
+        raise CorruptedContent(f'Expected {expected_size} bytes but server'
+                               + f' reports {total} for {url}')
+    size = expected_size if expected_size != None else total
+
+    def chunks():
+        try:
+            yield from req.iter_content(_CHUNK_SIZE)
+        except Exception as ex:
+            if __debug__: log(f'download of {url} interrupted: {str(ex)}')
+            raise NetworkFailure(f'Download interrupted for {url}')
+
+    digests = writer.add(name, chunks(), size)
+    if __debug__: log(f'streamed {url} to {name}')
+    return digests
+
+
+def _discard_part(part_file, journal_file):
+    for file in [part_file, journal_file]:
+        if path.exists(file):
+            os.remove(file)
+
+
+def _range_start(req):
+    # Content-Range has the form "bytes START-END/TOTAL".
+    content_range = req.headers.get('Content-Range', '')
+    if not content_range.startswith('bytes '):
+        return None
+    return _int_or_none(content_range[6:].split('-')[0])
+
+
+def _range_total(req):
+    content_range = req.headers.get('Content-Range', '')
+    return _int_or_none(content_range.split('/')[-1]) if '/' in content_range else None
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
 def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwargs):
     '''Gets or posts the 'url' with optional keyword arguments provided.
     Returns a tuple of (response, exception), where the first element is
@@ -315,9 +720,12 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
         error = ServiceFailure(addurl('Server rejected the request'))
     elif code == 429:
         if recursing < _MAX_RECURSIVE_CALLS:
-            pause = 5 * (recursing + 1)   # +1 b/c we start with recursing = 0.
-            if __debug__: log(f'rate limit hit -- sleeping {pause}')
-            sleep(pause)                  # 5 s, then 10 s, then 15 s, etc.
+            if not isinstance(session, LimitedSession):
+                pause = 5 * (recursing + 1)   # +1 b/c we start with recursing = 0.
+                if __debug__: log(f'rate limit hit -- sleeping {pause}')
+                sleep(pause)                  # 5 s, then 10 s, then 15 s, etc.
+            # Otherwise, the session's rate limiter has already registered
+            # the 429 and will hold back the next request as long as needed.
             if __debug__: log(f'doing recursive call #{recursing + 1}')
             return net(get_or_post, url, session, polling, recursing + 1, **kwargs)
         error = RateLimitExceeded('Server blocking further requests due to rate limits')
@@ -332,6 +740,15 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
     return (req, error)
 
 
+def _back_off(session, url, seconds):
+    # With a rate-limited session, make every thread using it wait, not only
+    # the one that saw the failures.
+    if isinstance(session, LimitedSession):
+        session.limiter.pause(urlsplit(url).netloc, seconds)
+    else:
+        sleep(seconds)
+
+
 def unwrapped_urllib3_exception(ex):
     if hasattr(ex, 'args') and isinstance(ex.args, tuple):
         return unwrapped_urllib3_exception(ex.args[0])
@@ -0,0 +1,111 @@
+'''
+oai.py: get lists of record identifiers from an OAI-PMH server.
+
+EPrints servers normally provide an OAI-PMH interface (typically at a URL
+such as https://server.institution.edu/cgi/oai2) in addition to the REST
+API.  Unlike the REST API, OAI-PMH supports selective harvesting by date:
+the ListIdentifiers request can be given a "from" date, and the server then
+only lists the records that have changed since that date.  Finding the few
+records that changed since the last run thus takes a few requests instead of
+one request per record in the repository.
+
+Long lists are returned in pages; each page ends with a resumptionToken that
+is used to request the next page.  The pages are parsed incrementally as
+they arrive, and the identifiers are handed back one at a time.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   datetime import timezone
+from   lxml import etree
+from   sidetrack import log
+
+import eprints2bags
+from   .exceptions import *
+from   .network import net
+
+
+# Constants.
+# .............................................................................
+
+_OAI_XMLNS = 'http://www.openarchives.org/OAI/2.0/'
+'''XML namespace used in OAI-PMH responses.'''
+
+_METADATA_PREFIX = 'oai_dc'
+'''OAI-PMH metadata format named in requests.  Every OAI-PMH server must
+support this one.  Only the record headers are used, so the choice of format
+doesn't matter otherwise.'''
+
+
+# Main functions.
+# .............................................................................
+
+def oai_identifiers(oai_url, since = None, session = None):
+    '''Generator that yields the EPrints record numbers (as strings) listed
+    by the OAI-PMH server at 'oai_url'.  If 'since' is not None, it must be a
+    datetime object, and only the records changed on or after that day are
+    listed.  Records marked as deleted are left out.'''
+    for number, deleted in oai_changes(oai_url, since, session):
+        if not deleted:
+            yield number
+
+
+def oai_changes(oai_url, since = None, session = None):
+    '''Like oai_identifiers(), but yields a tuple (number, deleted) for every
+    record listed, where 'deleted' is True if the server marks the record as
+    deleted.'''
+    params = {'verb': 'ListIdentifiers', 'metadataPrefix': _METADATA_PREFIX}
+    if since:
+        if since.tzinfo:
+            since = since.astimezone(timezone.utc)
+        # Day granularity is the one that all OAI-PMH servers must support.
+        params['from'] = since.strftime('%Y-%m-%d')
+    while params:
+        if __debug__: log(f'getting OAI-PMH identifiers from {oai_url} with {params}')
+        (response, error) = net('get', oai_url, session, params = params, stream = True)
+        if error:
+            raise error
+        try:
+            token = yield from _page_identifiers(response)
+        finally:
+            response.close()
+        params = {'verb': 'ListIdentifiers', 'resumptionToken': token} if token else None
+
+
+# Helper functions.
+# .............................................................................
+
+def _page_identifiers(response):
+    # Yields the (number, deleted) tuples on one page of results and returns
+    # the resumption token (or None).  Elements are discarded as soon as they
+    # have been looked at, so that memory use doesn't grow with page size.
+    token = None
+    response.raw.decode_content = True
+    tags = ['{' + _OAI_XMLNS + '}' + name for name in ['header', 'resumptionToken', 'error']]
+    for _, elem in etree.iterparse(response.raw, events = ('end',), tag = tags):
+        name = etree.QName(elem).localname
+        if name == 'header':
+            identifier = elem.findtext('{' + _OAI_XMLNS + '}identifier')
+            if identifier:
+                # EPrints identifiers have the form "oai:host:number".
+                yield (identifier.rsplit(':', 1)[-1], elem.get('status') == 'deleted')
+        elif name == 'resumptionToken':
+            token = (elem.text or '').strip() or None
+        elif name == 'error':
+            code = elem.get('code')
+            if code != 'noRecordsMatch':
+                raise ServiceFailure(f'OAI-PMH server error {code}: {elem.text}')
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    return token
@@ -0,0 +1,191 @@
+'''
+pipeline.py: run items through a sequence of stages using pools of threads.
+
+A pipeline is a list of stages.  Each stage has a function and a number of
+worker threads.  Items are handed to the first stage, and every item that a
+stage's function accepts (by returning True) is passed on to the next stage.
+Stages are connected by bounded queues, so that a slow stage makes the stages
+before it wait instead of letting work pile up in memory or on disk.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   queue import Queue
+from   sidetrack import log
+from   threading import Lock, Thread
+
+import eprints2bags
+from   .exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+_QUEUE_FACTOR = 2
+'''The queue in front of a stage holds at most this many items per worker of
+that stage.'''
+
+_DONE = object()
+'''Marker put on a queue to tell a worker thread to exit.'''
+
+
+# Main class.
+# .............................................................................
+
+class Stage(object):
+    '''A stage in a pipeline.  Function 'func' is called with one item at a
+    time and must return True if the item is to be passed to the next stage,
+    or False if processing of the item stops at this stage.'''
+
+    __slots__ = ('name', 'func', 'workers')
+
+    def __init__(self, name, func, workers = 1):
+        if workers < 1:
+            raise InternalError(f'Stage "{name}" needs at least one worker')
+        self.name    = name
+        self.func    = func
+        self.workers = workers
+
+
+class Pipeline(object):
+    '''Run items through a list of Stage objects.
+
+    If 'threaded' is False, each item is run through all stages in the
+    calling thread before the next item is started.  Otherwise, each stage
+    gets its own pool of worker threads and the stages work concurrently on
+    different items.
+
+    In either case, if a stage function raises an exception, no further items
+    are started, items that came before the failing item in the input are
+    allowed to finish, and run() raises the exception of the earliest failing
+    item.  This makes the reported error the same as it would be if the items
+    were processed one at a time.  An exception raised by the iterator of
+    items is treated the same way, as the failure of the item it would have
+    produced.  If 'discard' is not None, it is called with each item that is
+    dropped partway through the stages because an earlier item failed, so
+    that the caller can clean up after it.
+    '''
+
+    def __init__(self, stages, threaded = True, discard = None):
+        self._stages   = stages
+        self._threaded = threaded
+        self._discard  = discard
+        self._lock     = Lock()
+        self._errors   = {}
+
+
+    def run(self, items):
+        '''Run the 'items' through the stages of this pipeline.'''
+        self._errors = {}
+        if self._threaded:
+            self._run_threaded(items)
+        else:
+            for index, item in self._numbered(items):
+                self._process(index, item, self._stages)
+                if self._errors:
+                    break
+        if self._errors:
+            raise self._errors[min(self._errors)]
+
+
+    def _run_threaded(self, items):
+        if __debug__: log('starting pipeline: ' + ', '.join(
+                f'{stage.name} ({stage.workers})' for stage in self._stages))
+        queues = [Queue(maxsize = _QUEUE_FACTOR * stage.workers)
+                  for stage in self._stages]
+        threads = []
+        for position, stage in enumerate(self._stages):
+            inbox = queues[position]
+            outbox = queues[position + 1] if position + 1 < len(queues) else None
+            threads.append([Thread(target = self._work, args = (stage, inbox, outbox),
+                                   name = f'{stage.name}-{n}', daemon = True)
+                            for n in range(stage.workers)])
+        for thread in (t for group in threads for t in group):
+            thread.start()
+
+        # The queue put() calls block when a queue is full, which is what
+        # keeps the stages from running too far ahead of each other.
+        for index, item in self._numbered(items):
+            if self._stopped_before(index):
+                break
+            queues[0].put((index, item))
+
+        # Shut down the stages in order, so that each stage has finished
+        # handing its items to the next one before that one is told to exit.
+        for position, stage in enumerate(self._stages):
+            for _ in range(stage.workers):
+                queues[position].put(_DONE)
+            for thread in threads[position]:
+                thread.join()
+        if __debug__: log('pipeline finished')
+
+
+    def _work(self, stage, inbox, outbox):
+        while True:
+            entry = inbox.get()
+            if entry is _DONE:
+                return
+            index, item = entry
+            if self._stopped_before(index):
+                if self._discard:
+                    self._call_discard(index, item)
+                continue
+            if self._call(stage, index, item) and outbox:
+                outbox.put(entry)
+
+
+    def _numbered(self, items):
+        # Like enumerate(items), except that an exception from 'items' is
+        # recorded as the failure of the next item, and ends the iteration.
+        index = 0
+        iterator = iter(items)
+        while True:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            except Exception as ex:
+                if __debug__: log(f'list of items failed after item #{index - 1}: {str(ex)}')
+                with self._lock:
+                    self._errors[index] = ex
+                return
+            yield (index, item)
+            index += 1
+
+
+    def _process(self, index, item, stages):
+        for stage in stages:
+            if not self._call(stage, index, item):
+                return
+
+
+    def _call(self, stage, index, item):
+        try:
+            return stage.func(item)
+        except BaseException as ex:
+            if __debug__: log(f'stage {stage.name} failed on item #{index}: {str(ex)}')
+            with self._lock:
+                self._errors[index] = ex
+            return False
+
+
+    def _call_discard(self, index, item):
+        try:
+            self._discard(item)
+        except Exception as ex:
+            if __debug__: log(f'discarding item #{index} failed: {str(ex)}')
+
+
+    def _stopped_before(self, index):
+        with self._lock:
+            return bool(self._errors) and min(self._errors) < index
@@ -0,0 +1,279 @@
+'''
+ratelimit.py: adaptive control of the rate and concurrency of server requests.
+
+All network requests made by eprints2bags go through a single RateLimiter
+object, which keeps separate state for every server host.  For each host,
+it combines two mechanisms:
+
+* A token bucket that limits the number of requests started per second.  The
+  maximum rate can be set by the user; if it is not set, the bucket is not
+  used until the server first signals that it is overloaded.
+
+* A concurrency window that limits how many requests may be in progress at
+  the same time.  It follows the additive-increase, multiplicative-decrease
+  (AIMD) scheme used by TCP: the window shrinks by half whenever the server
+  responds with HTTP code 429 (Too Many Requests) or 503 (Service
+  Unavailable), and grows by one request after every interval of time during
+  which no such response was seen.  The token rate is adjusted the same way.
+
+When the server includes a Retry-After header in a 429 or 503 response, all
+requests to that host are held back until the time it indicates.  Because
+the state is shared, every worker thread backs off together, instead of each
+one discovering the problem separately and retrying on its own schedule.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import deque
+from   email.utils import parsedate_to_datetime
+from   sidetrack import log
+from   threading import Condition, Lock
+from   time import monotonic, time
+
+import eprints2bags
+
+
+# Constants.
+# .............................................................................
+
+_INCREASE_INTERVAL = 2
+'''Seconds without overload signals after which the window and rate grow.'''
+
+_MIN_RATE = 0.2
+'''Lowest rate (in requests/second) that the token bucket is reduced to.'''
+
+_RATE_STEP = 0.5
+'''Number of requests/second added to the rate after each interval of time
+without overload signals.'''
+
+_DEFAULT_PAUSE = 5
+'''Seconds to hold back requests after an overload signal that came without
+a Retry-After header.  This is multiplied by the number of overload signals
+received in a row, up to _MAX_PAUSE.'''
+
+_MAX_PAUSE = 300
+'''Maximum number of seconds to hold back requests after an overload signal.'''
+
+_MEASUREMENT_WINDOW = 10
+'''Number of seconds over which the current request rate is measured.'''
+
+_OVERLOAD_CODES = [429, 503]
+'''HTTP status codes that mean the server wants us to slow down.'''
+
+
+# Main classes.
+# .............................................................................
+
+class RateLimiter(object):
+    '''Shared rate and concurrency controller for requests to all hosts.'''
+
+    def __init__(self, max_rate = None):
+        self._max_rate = max_rate
+        self._lock     = Lock()
+        self._hosts    = {}
+
+
+    def set_max_rate(self, max_rate):
+        '''Set the maximum rate of requests per second to each host.  A value
+        of None means the rate is only limited after overload signals.'''
+        with self._lock:
+            self._max_rate = max_rate
+            for host in self._hosts.values():
+                host.set_max_rate(max_rate)
+
+
+    def acquire(self, host):
+        '''Wait until a request may be made to 'host', and claim a slot in its
+        concurrency window.  Every call must be followed by a call to release().'''
+        self._host(host).acquire()
+
+
+    def release(self, host, code = None, retry_after = None):
+        '''Release the slot claimed by acquire() for a request to 'host'.
+        'Code' is the HTTP status code of the response (or None if the request
+        failed without one) and 'retry_after' is the value of the response's
+        Retry-After header, if any.'''
+        self._host(host).release(code, retry_after)
+
+
+    def pause(self, host, seconds):
+        '''Hold back all requests to 'host' for the given number of seconds.'''
+        self._host(host).pause(seconds)
+
+
+    def status(self, host):
+        '''Return a dict describing the current state of the controls for
+        'host', for monitoring.  The keys are 'rate' (the number of requests
+        per second actually being made, measured over the last few seconds),
+        'rate_limit' (the current token rate, or None if unlimited), 'window'
+        (the current concurrency limit, or None if unlimited), and 'in_flight'
+        (the number of requests in progress).'''
+        return self._host(host).status()
+
+
+    def _host(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostLimiter(host, self._max_rate)
+            return self._hosts[host]
+
+
+class HostLimiter(object):
+    '''Token bucket and AIMD concurrency window for a single host.'''
+
+    def __init__(self, host, max_rate = None):
+        self.host        = host
+        self._max_rate   = max_rate
+        self._rate       = max_rate  # None = no limit on the rate (yet).
+        self._tokens     = 1.0
+        self._refilled   = monotonic()
+        self._window     = None      # None = no limit on concurrency (yet).
+        self._in_flight  = 0
+        self._resume_at  = 0
+        self._overloads  = 0         # Number of overload signals in a row.
+        self._last_event = monotonic()
+        self._started    = deque()
+        self._created    = monotonic()
+        self._condition  = Condition()
+
+
+    def set_max_rate(self, max_rate):
+        with self._condition:
+            self._max_rate = max_rate
+            if max_rate != None and (self._rate == None or self._rate > max_rate):
+                self._rate = max_rate
+            self._condition.notify_all()
+
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                now = monotonic()
+                self._grow(now)
+                self._refill(now)
+                wait = self._wait_time(now)
+                if wait <= 0:
+                    break
+                self._condition.wait(timeout = wait)
+            self._in_flight += 1
+            if self._rate != None:
+                self._tokens -= 1
+            # Only the starts within the measurement window are kept, so
+            # that the memory used doesn't grow with the length of the run.
+            self._prune(now)
+            self._started.append(now)
+
+
+    def release(self, code = None, retry_after = None):
+        with self._condition:
+            self._in_flight -= 1
+            now = monotonic()
+            if code in _OVERLOAD_CODES:
+                self._overloaded(now, retry_after)
+            elif code != None and code < 500:
+                self._overloads = 0
+            self._condition.notify_all()
+
+
+    def pause(self, seconds):
+        with self._condition:
+            self._resume_at = max(self._resume_at, monotonic() + seconds)
+            self._condition.notify_all()
+
+
+    def status(self):
+        with self._condition:
+            return {'rate'       : self._measured_rate(monotonic()),
+                    'rate_limit' : self._rate,
+                    'window'     : self._window,
+                    'in_flight'  : self._in_flight}
+
+
+    def _wait_time(self, now):
+        if now < self._resume_at:
+            return self._resume_at - now
+        if self._window != None and self._in_flight >= int(self._window):
+            # Released slots notify the condition, so this is only a ceiling.
+            return _INCREASE_INTERVAL
+        if self._rate != None and self._tokens < 1:
+            return (1 - self._tokens) / self._rate
+        return 0
+
+
+    def _refill(self, now):
+        if self._rate != None:
+            burst = max(1.0, self._rate)
+            self._tokens = min(burst, self._tokens + (now - self._refilled) * self._rate)
+        self._refilled = now
+
+
+    def _grow(self, now):
+        # Additive increase: after each quiet interval, allow one more
+        # concurrent request and a slightly higher rate.
+        intervals = int((now - self._last_event) / _INCREASE_INTERVAL)
+        if intervals < 1:
+            return
+        self._last_event += intervals * _INCREASE_INTERVAL
+        if self._window != None:
+            self._window += intervals
+        if self._rate != None:
+            self._rate += intervals * _RATE_STEP
+            if self._max_rate != None:
+                self._rate = min(self._rate, self._max_rate)
+
+
+    def _overloaded(self, now, retry_after):
+        # Multiplicative decrease of both the window and the rate.
+        self._overloads += 1
+        current = max(self._in_flight + 1, int(self._window or 0))
+        self._window = max(1, current / 2)
+        measured = self._measured_rate(now)
+        rate = self._rate if self._rate != None else (measured or 1.0)
+        self._rate = max(_MIN_RATE, min(rate, measured or rate) / 2)
+        self._tokens = min(self._tokens, 0)
+        self._last_event = now
+        pause = _pause_seconds(retry_after)
+        if pause == None:
+            pause = min(_MAX_PAUSE, _DEFAULT_PAUSE * self._overloads)
+        self._resume_at = max(self._resume_at, now + pause)
+        if __debug__: log(f'{self.host} is overloaded: pausing {pause:.1f} s; window now '
+                          + f'{self._window:.1f}, rate now {self._rate:.2f}/s')
+
+
+    def _measured_rate(self, now):
+        self._prune(now)
+        # Early in a run, measure over the time elapsed so far instead.
+        span = min(_MEASUREMENT_WINDOW, max(1, now - self._created))
+        return len(self._started) / span
+
+
+    def _prune(self, now):
+        while self._started and self._started[0] < now - _MEASUREMENT_WINDOW:
+            self._started.popleft()
+
+
+# Helper functions.
+# .............................................................................
+
+def _pause_seconds(retry_after):
+    '''Interpret the value of a Retry-After header, which can be either a
+    number of seconds or an HTTP date.  Returns None if it can't be parsed.'''
+    if not retry_after:
+        return None
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return min(_MAX_PAUSE, int(retry_after))
+    try:
+        return min(_MAX_PAUSE, max(0, parsedate_to_datetime(retry_after).timestamp() - time()))
+    except (TypeError, ValueError, IndexError):
+        return None
@@ -0,0 +1,160 @@
+'''
+statedb.py: persistent record of what eprints2bags has done, kept in SQLite.
+
+The database stores one row per EPrints record, holding the record's last
+modification date, status, list of documents, checksums of its files, the
+path of the bag or archive written for it, and the outcome of processing it
+("written", "skipped" or "missing").  It also stores one row per run of the
+program, so that a run that was interrupted can be recognized when the
+program is started again.
+
+This information is used in two ways.  When a run is interrupted (e.g., by
+a crash or a lost network connection), the next run using the same database
+resumes it, skipping the records that the interrupted run already wrote,
+without contacting the server about them.  When the previous run finished
+normally, the next run is an incremental one: it still fetches the metadata
+of every record, but skips records whose last modification date is the same
+as when they were last written.
+
+Writes are collected and committed in batches, because committing every
+change separately would make the database the slowest part of a large run.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import json
+from   sidetrack import log
+import sqlite3
+from   threading import Lock
+from   time import monotonic, time
+
+import eprints2bags
+from   .exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+_BATCH_SIZE = 1000
+'''Maximum number of changes held in memory before they are committed.'''
+
+_BATCH_SECONDS = 10
+'''Maximum number of seconds that changes are held before being committed.'''
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    started   REAL NOT NULL,
+    finished  REAL
+);
+CREATE TABLE IF NOT EXISTS records (
+    id        TEXT PRIMARY KEY,
+    run       INTEGER NOT NULL,
+    lastmod   TEXT,
+    status    TEXT,
+    documents TEXT,
+    digests   TEXT,
+    path      TEXT,
+    outcome   TEXT NOT NULL,
+    updated   REAL NOT NULL
+);
+'''
+'''SQL statements that create the database tables.'''
+
+
+# Main class.
+# .............................................................................
+
+class RunState(object):
+    '''Database of record outcomes stored in the SQLite file 'db_file'.'''
+
+    def __init__(self, db_file):
+        self.db_file  = db_file
+        self._lock    = Lock()
+        self._pending = []
+        self._flushed = monotonic()
+        self._db      = sqlite3.connect(db_file, check_same_thread = False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.executescript(_SCHEMA)
+
+        last = self._db.execute('SELECT id, finished FROM runs ORDER BY id DESC LIMIT 1').fetchone()
+        self.resuming = bool(last and last[1] == None)
+        if self.resuming:
+            self.run = last[0]
+            rows = self._db.execute("SELECT id FROM records WHERE run = ? AND outcome = 'written'",
+                                    (self.run,))
+            self._done = set(row[0] for row in rows)
+            if __debug__: log(f'resuming run {self.run}; {len(self._done)} records already done')
+        else:
+            self.run = self._db.execute('INSERT INTO runs (started) VALUES (?)',
+                                        (time(),)).lastrowid
+            self._done = set()
+            if __debug__: log(f'starting run {self.run} using {db_file}')
+        self._db.commit()
+
+
+    def done(self, number):
+        '''Return True if record 'number' was written by the interrupted run
+        that this run is resuming.'''
+        return str(number) in self._done
+
+
+    def unchanged(self, number, lastmod):
+        '''Return True if record 'number' was written by an earlier run and
+        its last modification date was 'lastmod' at that time.'''
+        with self._lock:
+            row = self._db.execute('SELECT lastmod, outcome FROM records WHERE id = ?',
+                                   (str(number),)).fetchone()
+        return bool(row and row[1] == 'written' and row[0] == str(lastmod))
+
+
+    def record(self, number, outcome, lastmod = None, status = None,
+               documents = None, digests = None, path = None):
+        '''Record the outcome of processing record 'number', along with what
+        is known about it.  The change is committed with the next batch.'''
+        row = (str(number), self.run, None if lastmod == None else str(lastmod), status,
+               None if documents == None else json.dumps(documents),
+               None if digests == None else json.dumps(digests),
+               path, outcome, time())
+        with self._lock:
+            self._pending.append(row)
+            if (len(self._pending) >= _BATCH_SIZE
+                or monotonic() - self._flushed >= _BATCH_SECONDS):
+                self._flush()
+
+
+    def finish(self):
+        '''Mark the current run as having finished normally.'''
+        with self._lock:
+            self._flush()
+            self._db.execute('UPDATE runs SET finished = ? WHERE id = ?', (time(), self.run))
+            self._db.commit()
+        if __debug__: log(f'run {self.run} finished')
+
+
+    def close(self):
+        '''Commit any pending changes and close the database.'''
+        with self._lock:
+            self._flush()
+            self._db.close()
+
+
+    def _flush(self):
+        if self._pending:
+            if __debug__: log(f'committing {len(self._pending)} changes to {self.db_file}')
+            self._db.executemany('INSERT OR REPLACE INTO records VALUES (?,?,?,?,?,?,?,?,?)',
+                                 self._pending)
+            self._db.commit()
+            self._pending = []
+        self._flushed = monotonic()
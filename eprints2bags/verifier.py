@@ -0,0 +1,84 @@
+'''
+verifier.py: check bags and archive files in a background thread.
+
+Fully validating a bag means reading back every file in it and computing its
+checksums, and fully verifying an archive file means reading and
+decompressing all of it.  With deferred validation (option -v deferred),
+eprints2bags only does quick checks while it processes a record and hands
+the full checks to a Verifier, which works through them in a background
+thread while the program goes on with the next records.  Failures are
+collected and reported when the Verifier is finished.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019 by the California Institute of Technology.  This code is
+open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   queue import Queue
+from   sidetrack import log
+from   threading import Lock, Thread
+
+import eprints2bags
+from   .exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+_DONE = object()
+'''Marker put on the queue to tell the verifier thread to exit.'''
+
+
+# Main class.
+# .............................................................................
+
+class Verifier(object):
+    '''Run verification functions in a background thread.'''
+
+    def __init__(self):
+        self._queue    = Queue()
+        self._lock     = Lock()
+        self._failures = []
+        self._count    = 0
+        self._thread   = Thread(target = self._work, name = 'verifier', daemon = True)
+        self._thread.start()
+
+
+    def add(self, name, func, *args):
+        '''Queue a call to func(*args), which must raise an exception if the
+        thing named 'name' (e.g., a file path) fails verification.'''
+        if __debug__: log(f'queueing verification of {name}')
+        self._queue.put((name, func, args))
+
+
+    def finish(self):
+        '''Wait for all queued verifications to finish, and return a list of
+        tuples (name, exception) for the ones that failed.'''
+        self._queue.put(_DONE)
+        self._thread.join()
+        if __debug__: log(f'verified {self._count} items; {len(self._failures)} failed')
+        return self._failures
+
+
+    def _work(self):
+        while True:
+            entry = self._queue.get()
+            if entry is _DONE:
+                return
+            name, func, args = entry
+            if __debug__: log(f'verifying {name}')
+            try:
+                func(*args)
+            except Exception as ex:
+                if __debug__: log(f'verification of {name} failed: {str(ex)}')
+                with self._lock:
+                    self._failures.append((name, ex))
+            self._count += 1
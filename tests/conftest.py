@@ -0,0 +1,52 @@
+'''
+conftest.py: shared fixtures for the tests.
+'''
+
+from   http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from   threading import Thread
+from   urllib.parse import urlsplit, parse_qsl
+
+
+class LocalServer(object):
+    '''HTTP server on the local host.  Every GET request is recorded in
+    'requests' as a tuple (path, dict of query parameters, dict of headers),
+    and answered by calling 'respond' with the same values; it must return
+    a tuple (status code, dict of headers, body as bytes).'''
+
+    def __init__(self):
+        self.requests = []
+        self.respond  = lambda path, params, headers: (404, {}, b'not found')
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                request = (parts.path, dict(parse_qsl(parts.query)), dict(self.headers))
+                server.requests.append(request)
+                code, headers, body = server.respond(*request)
+                self.send_response(code)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self._httpd.server_port}'
+        Thread(target = self._httpd.serve_forever, daemon = True).start()
+
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    local = LocalServer()
+    yield local
+    local.close()
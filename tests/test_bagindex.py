@@ -0,0 +1,138 @@
+'''
+test_bagindex.py: tests for eprints2bags.bagindex.
+'''
+
+import bagit
+import hashlib
+import io
+import os
+import pytest
+import shutil
+
+import eprints2bags.bagindex as bagindex
+from   eprints2bags.bagindex import BagIndex
+from   eprints2bags.eprints import RecordXML, eprints_record_info
+from   eprints2bags.files import create_archive
+
+
+_NAME = '1234'
+_DOC_URL = 'https://example.org/1234/1/paper.pdf'
+_DOC = b'%PDF-1.4 document contents' * 100
+
+
+def record(id = 'https://example.org/id/eprint/1234', lastmod = '2019-01-01 10:00:00',
+           docs = {_DOC_URL: _DOC}, title = 'Title'):
+    '''Returns a RecordXML object for a record with the given values.'''
+    documents = ''
+    for url, data in docs.items():
+        documents += f'''
+      <document>
+        <files>
+          <file>
+            <url>{url}</url>
+            <hash>{hashlib.md5(data).hexdigest()}</hash>
+            <hash_type>MD5</hash_type>
+          </file>
+        </files>
+      </document>'''
+    xml = f'''<?xml version='1.0' encoding='utf-8'?>
+<eprints xmlns='http://eprints.org/ep2/data/2.0'>
+  <eprint id='{id}'>
+    <eprintid>1234</eprintid>
+    <documents>{documents}
+    </documents>
+    <title>{title}</title>
+    <lastmod>{lastmod}</lastmod>
+  </eprint>
+</eprints>
+'''.encode()
+    return RecordXML(io.BytesIO(xml), len(xml), eprints_record_info(xml), True)
+
+
+def make_bag(previous_dir, kind):
+    '''Writes a bag for the record returned by record() in 'previous_dir',
+    either as a directory or as an archive file of the 'kind' given.'''
+    bag_dir = os.path.join(previous_dir, _NAME)
+    os.makedirs(bag_dir)
+    with open(os.path.join(bag_dir, _NAME + '.xml'), 'wb') as f:
+        f.write(record().content.read())
+    with open(os.path.join(bag_dir, 'paper.pdf'), 'wb') as f:
+        f.write(_DOC)
+    bagit.make_bag(bag_dir, {'Internal-Sender-Identifier': record().info.id},
+                   checksums = ['sha256', 'md5'])
+    if kind != 'dir':
+        type = {'zip': 'compressed-zip', 'tar': 'uncompressed-tar',
+                'tar.gz': 'compressed-tar'}[kind]
+        create_archive(bag_dir + '.' + kind, type, bag_dir)
+        shutil.rmtree(bag_dir)
+
+
+@pytest.fixture
+def previous(tmp_path):
+    previous_dir = str(tmp_path / 'previous')
+    make_bag(previous_dir, 'dir')
+    return previous_dir
+
+
+@pytest.mark.parametrize('kind', ['dir', 'zip', 'tar', 'tar.gz'])
+def test_reads_bags(tmp_path, kind):
+    previous_dir = str(tmp_path / 'previous')
+    make_bag(previous_dir, kind)
+    index = BagIndex(previous_dir)
+    assert index.unchanged(_NAME, record())
+    assert not index.unchanged('5678', record())
+    assert os.path.exists(previous_dir + '.index.json')
+
+
+def test_different_sender_id(previous):
+    assert not BagIndex(previous).unchanged(_NAME, record(id = 'https://example.org/id/eprint/1'))
+
+
+def test_different_xml_and_lastmod(previous):
+    assert not BagIndex(previous).unchanged(_NAME, record(lastmod = '2019-02-01 10:00:00'))
+
+
+def test_different_xml_same_lastmod(previous):
+    assert BagIndex(previous).unchanged(_NAME, record(title = 'New title'))
+
+
+def test_same_xml_different_lastmod(previous):
+    # Only if the XML differs does the last modification date matter.
+    index = BagIndex(previous)
+    index._entries[_NAME]['lastmod'] = '2000-01-01 00:00:00'
+    assert index.unchanged(_NAME, record())
+
+
+def test_different_documents(previous):
+    docs = {_DOC_URL: _DOC, 'https://example.org/1234/2/other.pdf': b'other'}
+    assert not BagIndex(previous).unchanged(_NAME, record(title = 'New', docs = docs))
+    assert not BagIndex(previous).unchanged(_NAME, record(title = 'New', docs = {}))
+
+
+def test_different_md5(previous):
+    docs = {_DOC_URL: b'changed'}
+    assert not BagIndex(previous).unchanged(_NAME, record(title = 'New', docs = docs))
+
+
+def test_saved_index_is_reused(previous, monkeypatch):
+    BagIndex(previous)
+    def fail(*args):
+        raise AssertionError('bag read again')
+    monkeypatch.setattr(bagindex, '_indexed', fail)
+    assert BagIndex(previous).unchanged(_NAME, record())
+
+
+def test_changed_bag_is_read_again(previous):
+    BagIndex(previous)
+    # Rewrite the bag with a different document.
+    with open(os.path.join(previous, _NAME, 'data', 'paper.pdf'), 'wb') as f:
+        f.write(b'changed')
+    bag = bagit.Bag(os.path.join(previous, _NAME))
+    bag.save(manifests = True)
+    assert not BagIndex(previous).unchanged(_NAME, record())
+
+
+def test_removed_bag_is_forgotten(previous):
+    BagIndex(previous)
+    shutil.rmtree(os.path.join(previous, _NAME))
+    assert not BagIndex(previous).unchanged(_NAME, record())
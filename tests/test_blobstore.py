@@ -0,0 +1,77 @@
+'''
+test_blobstore.py: tests for eprints2bags.blobstore.
+'''
+
+import hashlib
+import os
+from   time import sleep
+
+from   eprints2bags.blobstore import BlobStore
+
+
+def make_file(directory, name, data):
+    file = str(directory / name)
+    with open(file, 'wb') as f:
+        f.write(data)
+    return file
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def test_hit_and_miss(tmp_path):
+    store = BlobStore(str(tmp_path / 'store'), 10000)
+    data = b'a' * 1000
+    store.add('http://x/a.pdf', make_file(tmp_path, 'a.pdf', data))
+
+    copy = str(tmp_path / 'copy.pdf')
+    digests = store.fetch('http://x/a.pdf', 1000, copy, md5(data))
+    assert digests['md5'] == md5(data)
+    with open(copy, 'rb') as f:
+        assert f.read() == data
+
+    assert store.fetch('http://x/other.pdf', 1000, copy) == None
+    assert store.fetch('http://x/a.pdf', 999, copy) == None
+    assert store.fetch('http://x/a.pdf', None, copy) == None
+    assert store.fetch('http://x/a.pdf', 1000, copy, md5(b'b' * 1000)) == None
+
+
+def test_lookup_leaves_linked_files_alone(tmp_path):
+    store = BlobStore(str(tmp_path / 'store'), 10000)
+    file = make_file(tmp_path, 'a.pdf', b'a' * 1000)
+    store.add('http://x/a.pdf', file)
+    before = os.stat(file).st_mtime_ns
+    sleep(0.05)
+    assert store.lookup('http://x/a.pdf', 1000)
+    assert os.stat(file).st_mtime_ns == before
+
+
+def test_eviction_removes_least_recently_used(tmp_path):
+    store = BlobStore(str(tmp_path / 'store'), 3000)
+    urls = []
+    for name in 'abc':
+        url = f'http://x/{name}.pdf'
+        file = make_file(tmp_path, name + '.pdf', name.encode() * 1000)
+        store.add(url, file)
+        # Once the downloaded copy is gone, the store holds the only copy.
+        os.remove(file)
+        urls.append(url)
+        sleep(0.05)
+    store.lookup(urls[0], 1000)
+
+    # This goes over the limit; 'b' was used least recently.
+    store.add('http://x/d.pdf', make_file(tmp_path, 'd.pdf', b'd' * 1000))
+    assert store.lookup(urls[0], 1000)
+    assert not store.lookup(urls[1], 1000)
+    assert store.lookup(urls[2], 1000)
+
+
+def test_linked_files_are_not_counted(tmp_path):
+    store = BlobStore(str(tmp_path / 'store'), 3000)
+    for name in 'abcd':
+        store.add(f'http://x/{name}.pdf', make_file(tmp_path, name + '.pdf', name.encode() * 1000))
+    # All the files are still linked from tmp_path, so none are removed.
+    for name in 'abcd':
+        assert store.lookup(f'http://x/{name}.pdf', 1000)
+    assert BlobStore(str(tmp_path / 'store'), 3000)._size == 0
@@ -0,0 +1,92 @@
+'''
+test_cache.py: tests for eprints2bags.cache and its use by eprints_xml().
+'''
+
+import os
+
+from   eprints2bags.cache import RecordCache
+from   eprints2bags.eprints import eprints_xml
+
+
+_XML = b'''<?xml version='1.0' encoding='utf-8'?>
+<eprints xmlns='http://eprints.org/ep2/data/2.0'>
+  <eprint id='https://example.org/id/eprint/7'>
+    <eprintid>7</eprintid>
+    <lastmod>2019-01-01 10:00:00</lastmod>
+  </eprint>
+</eprints>
+'''
+
+_ETAG = '"v1"'
+
+
+def conditional(path, params, headers):
+    # Answers like a server that supports ETags.
+    if headers.get('If-None-Match') == _ETAG:
+        return (304, {'ETag': _ETAG}, b'')
+    return (200, {'ETag': _ETAG}, _XML)
+
+
+def test_put_and_get(tmp_path):
+    cache = RecordCache(str(tmp_path), 10000)
+    assert cache.validators(7) == {}
+    assert cache.get(7) == None
+    cache.put(7, _XML, _ETAG, 'Tue, 01 Jan 2019 10:00:00 GMT')
+    assert cache.get(7) == _XML
+    assert cache.validators(7) == {'If-None-Match': _ETAG,
+                                   'If-Modified-Since': 'Tue, 01 Jan 2019 10:00:00 GMT'}
+
+
+def test_nothing_stored_without_validators(tmp_path):
+    cache = RecordCache(str(tmp_path), 10000)
+    cache.put(7, _XML, None, None)
+    assert cache.get(7) == None
+
+
+def test_eviction(tmp_path):
+    cache = RecordCache(str(tmp_path), 3 * len(_XML))
+    for number in range(1, 5):
+        cache.put(number, _XML, _ETAG, None)
+    assert cache.get(1) == None
+    assert cache.get(4) == _XML
+    # A new cache object finds the same contents.
+    assert RecordCache(str(tmp_path), 3 * len(_XML)).get(4) == _XML
+
+
+def test_unchanged_record_comes_from_cache(server, tmp_path):
+    server.respond = conditional
+    cache = RecordCache(str(tmp_path), 10000)
+    first = eprints_xml(7, server.url + '/rest', None, None, False, cache = cache)
+    assert first.content.read() == _XML
+    second = eprints_xml(7, server.url + '/rest', None, None, False, cache = cache)
+    assert second.content.read() == _XML
+    assert second.info.lastmod == first.info.lastmod != None
+    assert 'If-None-Match' not in server.requests[0][2]
+    assert server.requests[1][2]['If-None-Match'] == _ETAG
+
+
+def test_changed_record_replaces_cached_copy(server, tmp_path):
+    cache = RecordCache(str(tmp_path), 10000)
+    cache.put(7, b'<old/>', '"v0"', None)
+    server.respond = conditional
+    record = eprints_xml(7, server.url + '/rest', None, None, False, cache = cache)
+    assert record.content.read() == _XML
+    assert cache.get(7) == _XML
+    assert cache.validators(7)['If-None-Match'] == _ETAG
+
+
+def test_vanished_cached_copy_is_fetched_again(server, tmp_path):
+    cache = RecordCache(str(tmp_path), 10000)
+    cache.put(7, _XML, _ETAG, None)
+    server.respond = conditional
+    # Remove the body after the validators are read, as eviction might.
+    validators = cache.validators
+    def evicting(number):
+        headers = validators(number)
+        os.remove(os.path.join(str(tmp_path), '7.xml'))
+        return headers
+    cache.validators = evicting
+    record = eprints_xml(7, server.url + '/rest', None, None, False, cache = cache)
+    assert record.content.read() == _XML
+    assert len(server.requests) == 2
+    assert 'If-None-Match' not in server.requests[1][2]
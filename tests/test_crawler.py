@@ -0,0 +1,71 @@
+'''
+test_crawler.py: tests for eprints2bags.crawler.
+'''
+
+import pytest
+from   threading import Lock
+from   time import sleep
+
+from   eprints2bags.crawler import crawled
+
+
+class Counter(object):
+    '''Function for crawled() that keeps track of the calls in progress.'''
+
+    def __init__(self, delay = 0.01):
+        self.delay   = delay
+        self.calls   = 0
+        self.active  = 0
+        self.most    = 0
+        self._lock   = Lock()
+
+    def __call__(self, item):
+        with self._lock:
+            self.calls += 1
+            self.active += 1
+            self.most = max(self.most, self.active)
+        # Later items finish sooner, to check that the order is kept.
+        sleep(self.delay / (1 + item % 5))
+        with self._lock:
+            self.active -= 1
+        if item == 7:
+            raise ValueError('bad item')
+        return item * 2
+
+
+def test_results_are_in_order_and_bounded():
+    func = Counter()
+    results = list(crawled(range(30), func, 4))
+    assert [item for item, _, _ in results] == list(range(30))
+    assert all(result == item * 2 for item, result, error in results if item != 7)
+    assert func.most <= 4
+
+
+def test_call_errors_are_returned():
+    results = {item: (result, error) for item, result, error in crawled(range(10), Counter(), 3)}
+    result, error = results[7]
+    assert result == None
+    assert isinstance(error, ValueError)
+    assert results[6] == (12, None)
+
+
+def test_iterator_error_is_raised_after_earlier_results():
+    def items():
+        yield from range(5)
+        raise OSError('list unavailable')
+
+    received = []
+    with pytest.raises(OSError, match = 'list unavailable'):
+        for item, result, error in crawled(items(), Counter(), 3):
+            received.append(item)
+    assert received == list(range(5))
+
+
+def test_stopping_early_starts_no_more_calls():
+    func = Counter()
+    results = crawled(range(1000), func, 4)
+    for _ in range(3):
+        next(results)
+    results.close()
+    assert func.active == 0
+    assert func.calls < 20
@@ -0,0 +1,222 @@
+'''
+test_eprints.py: tests for eprints2bags.eprints.
+'''
+
+from   commonpy.data_utils import parsed_datetime
+from   lxml import etree
+from   os import path
+import pytest
+
+from   eprints2bags.cache import RecordCache
+from   eprints2bags.eprints import eprints_records_list, eprints_record_info, eprints_xml
+from   eprints2bags.eprints import _record_xml
+from   eprints2bags.exceptions import ServiceFailure
+
+
+_NS = '{http://eprints.org/ep2/data/2.0}'
+
+_SAMPLE = path.join(path.dirname(__file__), 'test-xml.xml')
+
+
+def sample_records():
+    '''Returns a list of the records in the sample file, each as the bytes of
+    an XML document holding only that record.'''
+    records = []
+    for eprint in etree.parse(_SAMPLE).getroot():
+        root = etree.Element(_NS + 'eprints', nsmap = {None: _NS[1:-1]})
+        root.append(eprint)
+        records.append(etree.tostring(root, xml_declaration = True, encoding = 'utf-8'))
+    return records
+
+
+def expected_info(content):
+    '''Returns a dict of the values that RecordInfo should have for the
+    record in 'content', found using the whole XML tree.'''
+    eprint = etree.fromstring(content)[0]
+    documents = []
+    sizes = {}
+    for document in eprint.iter(_NS + 'document'):
+        for file in document.iter(_NS + 'file'):
+            sizes[file.findtext(_NS + 'url')] = int(file.findtext(_NS + 'filesize'))
+        types = [type.text for type in document.iter(_NS + 'type')]
+        if 'http://eprints.org/relation/isVolatileVersionOf' not in types:
+            documents.append(document.find(f'.//{_NS}url').text)
+    return {'id'           : eprint.get('id'),
+            'lastmod'      : parsed_datetime(eprint.findtext(_NS + 'lastmod')),
+            'status'       : eprint.findtext(_NS + 'eprint_status'),
+            'official_url' : eprint.findtext(_NS + 'official_url'),
+            'documents'    : documents,
+            'sizes'        : sizes}
+
+
+def info_values(info):
+    return {name: getattr(info, name) for name in
+            ['id', 'lastmod', 'status', 'official_url', 'documents', 'sizes']}
+
+
+def listing(numbers):
+    items = ''.join(f"<li><a href='{n}/'>{n}/</a></li>\n<li><a href='{n}.xml'>{n}.xml</a></li>\n"
+                    for n in numbers)
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+  <title>EPrints REST: Eprints DataSet</title>
+</head>
+<body>
+  <h1>EPrints REST: Eprints DataSet</h1>
+<ul>
+{items}</ul>
+</body>
+</html>
+'''.encode()
+
+
+def serving(body):
+    return lambda path, params, headers: (200, {'Content-Type': 'application/xhtml+xml'}, body)
+
+
+def test_records_list(server):
+    server.respond = serving(listing([4, 5, 10]))
+    assert list(eprints_records_list(server.url + '/rest', None, None)) == ['4', '5', '10']
+    assert server.requests[0][0] == '/rest/eprint'
+
+
+def test_long_records_list(server):
+    # Long enough to arrive in many chunks.
+    numbers = range(1, 30001)
+    server.respond = serving(listing(numbers))
+    assert list(eprints_records_list(server.url + '/rest', None, None)) == [str(n) for n in numbers]
+
+
+def test_records_list_stopped_early(server):
+    server.respond = serving(listing(range(1, 30001)))
+    records = eprints_records_list(server.url + '/rest', None, None)
+    numbers = iter(records)
+    assert [next(numbers) for _ in range(3)] == ['1', '2', '3']
+    numbers.close()
+
+
+def test_not_a_records_list(server):
+    server.respond = lambda path, params, headers: (200, {}, b'<html><body>Log in</body></html>')
+    assert eprints_records_list(server.url + '/rest', None, None) == None
+
+
+def test_malformed_records_list(server):
+    server.respond = serving(listing([4, 5])[:-200])
+    with pytest.raises(ServiceFailure):
+        list(eprints_records_list(server.url + '/rest', None, None))
+
+
+def test_record_info_of_sample_records():
+    records = sample_records()
+    assert len(records) == 4
+    for content in records:
+        assert info_values(eprints_record_info(content)) == expected_info(content)
+
+
+def test_record_info_from_small_chunks():
+    for content in sample_records():
+        chunks = [content[i:i + 50] for i in range(0, len(content), 50)]
+        record = _record_xml('1', chunks, None)
+        assert record.complete
+        assert record.size == len(content)
+        assert record.content.read() == content
+        assert info_values(record.info) == expected_info(content)
+
+
+def test_record_info_hashes_and_derived_files():
+    content = b'''<?xml version='1.0' encoding='utf-8'?>
+<eprints xmlns='http://eprints.org/ep2/data/2.0'>
+  <eprint id='https://example.org/id/eprint/3'>
+    <documents>
+      <document>
+        <files>
+          <file>
+            <url>https://example.org/3/1/paper.pdf</url>
+            <filesize>100</filesize>
+            <hash>0123456789ABCDEF0123456789ABCDEF</hash>
+            <hash_type>MD5</hash_type>
+          </file>
+        </files>
+      </document>
+      <document>
+        <files>
+          <file>
+            <url>https://example.org/3/2/data.zip</url>
+            <hash>abcd</hash>
+            <hash_type>SHA1</hash_type>
+          </file>
+        </files>
+      </document>
+      <document>
+        <files>
+          <file>
+            <url>https://example.org/3/9/indexcodes.txt</url>
+          </file>
+        </files>
+        <relation>
+          <item>
+            <type>http://eprints.org/relation/isVolatileVersionOf</type>
+          </item>
+        </relation>
+      </document>
+    </documents>
+  </eprint>
+</eprints>
+'''
+    info = eprints_record_info(content)
+    assert info.id == 'https://example.org/id/eprint/3'
+    assert info.documents == ['https://example.org/3/1/paper.pdf',
+                              'https://example.org/3/2/data.zip']
+    assert info.sizes == {'https://example.org/3/1/paper.pdf': 100}
+    assert info.hashes == {'https://example.org/3/1/paper.pdf':
+                           '0123456789abcdef0123456789abcdef'}
+    # Fields that are missing get empty values.
+    assert info.lastmod == None
+    assert info.status == ''
+    assert info.official_url == ''
+
+
+def long_record():
+    # The fields that decide whether a record is wanted come before a long
+    # abstract, as they do in the records of real servers.
+    return (b'''<?xml version='1.0' encoding='utf-8'?>
+<eprints xmlns='http://eprints.org/ep2/data/2.0'>
+  <eprint id='https://example.org/id/eprint/8'>
+    <eprint_status>archive</eprint_status>
+    <lastmod>2019-01-01 10:00:00</lastmod>
+    <abstract>''' + b'Lorem ipsum. ' * 200000 + b'''</abstract>
+  </eprint>
+</eprints>
+''')
+
+
+def test_record_download_stopped_early(server, tmp_path):
+    content = long_record()
+    server.respond = lambda path, params, headers: (200, {'ETag': '"v1"'}, content)
+    cache = RecordCache(str(tmp_path), len(content) * 2)
+    seen = []
+    def stop(info):
+        seen.append(info.lastmod)
+        return info.lastmod != None
+    record = eprints_xml(8, server.url + '/rest', None, None, False, cache = cache, stop = stop)
+    assert not record.complete
+    assert record.size < len(content) / 10
+    assert record.info.status == 'archive'
+    assert record.info.lastmod == parsed_datetime('2019-01-01 10:00:00')
+    assert seen[-1] != None and all(value == None for value in seen[:-1])
+    # Incomplete records are not cached.
+    assert cache.get(8) == None
+
+
+def test_record_download_not_stopped(server, tmp_path):
+    content = long_record()
+    server.respond = lambda path, params, headers: (200, {'ETag': '"v1"'}, content)
+    cache = RecordCache(str(tmp_path), len(content) * 2)
+    record = eprints_xml(8, server.url + '/rest', None, None, False, cache = cache,
+                         stop = lambda info: False)
+    assert record.complete
+    assert record.size == len(content)
+    assert record.content.read() == content
+    assert cache.get(8) == content
@@ -0,0 +1,121 @@
+'''
+test_files.py: tests of archive verification in eprints2bags.files.
+'''
+
+import hashlib
+import os
+import pytest
+import random
+
+from   eprints2bags.exceptions import CorruptedContent
+from   eprints2bags.files import create_archive, verify_archive, archive_extension
+from   eprints2bags.hashing import Throughput
+
+
+_TYPES = ['compressed-zip', 'uncompressed-zip', 'compressed-tar', 'uncompressed-tar']
+
+_CONTENT = random.Random(1).randbytes(300000)
+_NAME = 'bag/data/document.pdf'
+
+
+@pytest.fixture(params = _TYPES)
+def archive(request, tmp_path):
+    '''Returns a tuple (archive file, archive type).'''
+    os.makedirs(tmp_path / 'bag' / 'data')
+    with open(tmp_path / _NAME, 'wb') as f:
+        f.write(_CONTENT)
+    with open(tmp_path / 'bag' / 'bagit.txt', 'w') as f:
+        f.write('BagIt-Version: 0.97\n')
+    type = request.param
+    file = str(tmp_path / ('bag' + archive_extension(type)))
+    create_archive(file, type, str(tmp_path / 'bag'))
+    return (file, type)
+
+
+def digests(md5):
+    return {_NAME: {'md5': md5}}
+
+
+def corrupt(file, type):
+    with open(file, 'r+b') as f:
+        data = f.read()
+        if type.startswith('uncompressed'):
+            # Change a byte of the document itself.
+            offset = data.index(_CONTENT[:64]) + len(_CONTENT) // 2
+        else:
+            offset = len(data) // 2
+        f.seek(offset)
+        f.write(bytes([data[offset] ^ 0xff]))
+
+
+def truncate(file):
+    with open(file, 'r+b') as f:
+        f.truncate(os.path.getsize(file) // 2)
+
+
+def test_clean_archive(archive):
+    file, type = archive
+    stats = Throughput()
+    verify_archive(file, type, digests = digests(hashlib.md5(_CONTENT).hexdigest()),
+                   stats = stats)
+    verify_archive(file, type)
+    verify_archive(file, type, fast = True)
+    assert stats.bytes >= len(_CONTENT)
+
+
+def test_corrupted_member(archive):
+    file, type = archive
+    corrupt(file, type)
+    with pytest.raises(CorruptedContent):
+        verify_archive(file, type, digests = digests(hashlib.md5(_CONTENT).hexdigest()))
+
+
+def test_corrupted_member_without_digests(archive):
+    file, type = archive
+    corrupt(file, type)
+    if type == 'uncompressed-tar':
+        # Tar files have no checksums of their own for the data.
+        verify_archive(file, type)
+    else:
+        # ZIP stores a CRC for each file, and gzip one for all the data.
+        with pytest.raises(CorruptedContent):
+            verify_archive(file, type)
+
+
+def test_digest_mismatch(archive):
+    file, type = archive
+    with pytest.raises(CorruptedContent, match = 'Checksum mismatch'):
+        verify_archive(file, type, digests = digests(hashlib.md5(b'other').hexdigest()))
+
+
+def test_missing_member(archive):
+    file, type = archive
+    known = digests(hashlib.md5(_CONTENT).hexdigest())
+    known['bag/data/other.pdf'] = {'md5': hashlib.md5(b'other').hexdigest()}
+    with pytest.raises(CorruptedContent, match = 'missing'):
+        verify_archive(file, type, digests = known)
+
+
+def test_truncated_archive(archive):
+    file, type = archive
+    truncate(file)
+    with pytest.raises(CorruptedContent):
+        verify_archive(file, type, digests = digests(hashlib.md5(_CONTENT).hexdigest()))
+    if type.endswith('zip'):
+        # The table of contents is at the end, so it's gone too.
+        with pytest.raises(CorruptedContent):
+            verify_archive(file, type, fast = True)
+
+
+def test_fast_checks_structure_only(archive):
+    file, type = archive
+    corrupt(file, type)
+    verify_archive(file, type, fast = True)
+
+
+def test_fast_detects_unreadable_archive(archive):
+    file, type = archive
+    with open(file, 'wb') as f:
+        f.write(b'not an archive' * 100)
+    with pytest.raises(CorruptedContent):
+        verify_archive(file, type, fast = True)
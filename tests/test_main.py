@@ -0,0 +1,131 @@
+'''
+test_main.py: tests of running eprints2bags against a local EPrints server.
+'''
+
+import hashlib
+from   http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import plac
+import pytest
+import re
+from   threading import Lock, Thread
+from   time import sleep
+
+import eprints2bags.__main__ as program
+
+
+_RECORDS = 6
+_DELAY = 0.2
+
+
+def document(number, index):
+    return f'record {number} document {index} '.encode() * 500
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Minimal EPrints REST server.  Documents are sent slowly, and the
+    largest number of documents being sent at once is kept in 'most'.'''
+
+    base = None
+    lock = Lock()
+    active = 0
+    most = 0
+
+    def do_GET(self):
+        found = re.match(r'/rest/eprint/(\d+)\.xml$', self.path)
+        if found:
+            return self.send(200, self.record(int(found.group(1))))
+        found = re.match(r'/files/(\d+)/doc(\d+).pdf$', self.path)
+        if found:
+            with Handler.lock:
+                Handler.active += 1
+                Handler.most = max(Handler.most, Handler.active)
+            sleep(_DELAY)
+            with Handler.lock:
+                Handler.active -= 1
+            return self.send(200, document(int(found.group(1)), int(found.group(2))))
+        self.send(404, b'not found')
+
+    def send(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def record(self, number):
+        files = ''
+        for index in range(2):
+            data = document(number, index)
+            files += f'''
+      <document>
+        <files>
+          <file>
+            <filename>doc{index}.pdf</filename>
+            <filesize>{len(data)}</filesize>
+            <hash>{hashlib.md5(data).hexdigest()}</hash>
+            <hash_type>MD5</hash_type>
+            <url>{self.base}/files/{number}/doc{index}.pdf</url>
+          </file>
+        </files>
+      </document>'''
+        return f'''<?xml version='1.0' encoding='utf-8'?>
+<eprints xmlns='http://eprints.org/ep2/data/2.0'>
+  <eprint>
+    <eprintid>{number}</eprintid>
+    <documents>{files}
+    </documents>
+    <eprint_status>archive</eprint_status>
+    <lastmod>2019-01-01 10:00:00</lastmod>
+  </eprint>
+</eprints>
+'''.encode()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    Handler.active = Handler.most = 0
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    Handler.base = f'http://127.0.0.1:{httpd.server_port}'
+    thread = Thread(target = httpd.serve_forever, daemon = True)
+    thread.start()
+    monkeypatch.setattr(program, 'network_available', lambda *args, **kwargs: True)
+    # The user interface asks for the terminal size, which pytest doesn't have.
+    monkeypatch.setattr(os, 'get_terminal_size', lambda *args: os.terminal_size((80, 24)))
+    yield Handler.base + '/rest'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def run(api_url, output_dir, *args):
+    id_file = output_dir + '.txt'
+    with open(id_file, 'w') as f:
+        f.write('\n'.join(str(number) for number in range(1, _RECORDS + 1)))
+    plac.call(program.main, ['-a', api_url, '-o', output_dir, '-u', 'user', '-p', 'pswd',
+                             '-K', '-q', '-b', 'bag', '-i', id_file, *args])
+
+
+def bag_contents(output_dir):
+    contents = {}
+    for dirpath, _, files in os.walk(output_dir):
+        for name in files:
+            if name.endswith('.pdf'):
+                with open(os.path.join(dirpath, name), 'rb') as f:
+                    contents[os.path.relpath(os.path.join(dirpath, name), output_dir)] = f.read()
+    return contents
+
+
+def test_records_processed_concurrently(server, tmp_path):
+    serial = str(tmp_path / 'serial')
+    run(server, serial)
+    assert Handler.most == 1
+
+    Handler.most = 0
+    concurrent = str(tmp_path / 'concurrent')
+    run(server, concurrent, '-j', '3')
+    assert Handler.most > 1
+    assert Handler.most <= 3
+    assert bag_contents(concurrent) == bag_contents(serial)
+    assert len(bag_contents(serial)) == _RECORDS * 2
@@ -0,0 +1,131 @@
+'''
+test_network.py: tests of download() in eprints2bags.network, using a
+local HTTP server.
+'''
+
+import hashlib
+from   http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import pytest
+from   threading import Thread
+
+from   eprints2bags.exceptions import CorruptedContent
+from   eprints2bags.network import download
+
+
+_DATA = bytes(range(256)) * 400
+_ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Serves _DATA, honoring Range requests according to 'mode':
+    "normal" sends the requested range, "416" rejects every Range request,
+    and "wrong" answers Range requests with a range starting at 0.'''
+
+    mode = 'normal'
+    ranges = []
+
+    def do_GET(self):
+        wanted = self.headers.get('Range')
+        Handler.ranges.append(wanted)
+        if wanted and self.mode == '416':
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(_DATA)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if wanted and self.headers.get('If-Range') == _ETAG:
+            start = 0 if self.mode == 'wrong' else int(wanted[6:].split('-')[0])
+            body = _DATA[start:]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(_DATA) - 1}/{len(_DATA)}')
+        else:
+            body = _DATA
+            self.send_response(200)
+        self.send_header('ETag', _ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url():
+    Handler.mode = 'normal'
+    Handler.ranges = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/file.pdf'
+    server.shutdown()
+    server.server_close()
+
+
+def staged(url, destination, data):
+    # Leave behind the staging files of an interrupted download.
+    with open(destination + '.part', 'wb') as f:
+        f.write(data)
+    with open(destination + '.part.json', 'w') as f:
+        json.dump({'url': url, 'etag': _ETAG, 'last_modified': None}, f)
+
+
+def contents(file):
+    with open(file, 'rb') as f:
+        return f.read()
+
+
+def test_download(url, tmp_path):
+    destination = str(tmp_path / 'file.pdf')
+    digests = download(url, 'user', 'pswd', destination, algorithms = ['md5'])
+    assert contents(destination) == _DATA
+    assert digests == {'md5': hashlib.md5(_DATA).hexdigest()}
+    assert not os.path.exists(destination + '.part')
+
+
+def test_download_resumes(url, tmp_path):
+    destination = str(tmp_path / 'file.pdf')
+    staged(url, destination, _DATA[:1000])
+    digests = download(url, 'user', 'pswd', destination, algorithms = ['md5'],
+                       expected_size = len(_DATA))
+    assert Handler.ranges == ['bytes=1000-']
+    assert contents(destination) == _DATA
+    assert digests == {'md5': hashlib.md5(_DATA).hexdigest()}
+    assert not os.path.exists(destination + '.part.json')
+
+
+def test_download_416_with_complete_part(url, tmp_path):
+    Handler.mode = '416'
+    destination = str(tmp_path / 'file.pdf')
+    staged(url, destination, _DATA)
+    download(url, 'user', 'pswd', destination, expected_size = len(_DATA))
+    assert Handler.ranges == [f'bytes={len(_DATA)}-']
+    assert contents(destination) == _DATA
+
+
+def test_download_416_with_stale_part(url, tmp_path):
+    Handler.mode = '416'
+    destination = str(tmp_path / 'file.pdf')
+    staged(url, destination, b'x' * 1000)
+    download(url, 'user', 'pswd', destination, expected_size = len(_DATA))
+    assert Handler.ranges == ['bytes=1000-', None]
+    assert contents(destination) == _DATA
+
+
+def test_download_wrong_range_starts_over(url, tmp_path):
+    Handler.mode = 'wrong'
+    destination = str(tmp_path / 'file.pdf')
+    staged(url, destination, _DATA[:1000])
+    download(url, 'user', 'pswd', destination)
+    assert Handler.ranges == ['bytes=1000-', None]
+    assert contents(destination) == _DATA
+
+
+def test_download_size_mismatch(url, tmp_path):
+    destination = str(tmp_path / 'file.pdf')
+    with pytest.raises(CorruptedContent):
+        download(url, 'user', 'pswd', destination, expected_size = len(_DATA) + 1)
+    assert not os.path.exists(destination)
+    assert not os.path.exists(destination + '.part')
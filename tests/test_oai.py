@@ -0,0 +1,90 @@
+'''
+test_oai.py: tests for eprints2bags.oai.
+'''
+
+from   datetime import datetime, timedelta, timezone
+import pytest
+
+from   eprints2bags.exceptions import ServiceFailure
+from   eprints2bags.oai import oai_identifiers, oai_changes
+
+
+_PAGES = {None: ([1, 2, 3], 'page2'), 'page2': ([4, 5, 6], 'page3'), 'page3': ([7], None)}
+'''Pages of identifiers served, keyed by the resumption token that gets them,
+with the token for the next page.'''
+
+_DELETED = {5}
+
+
+def page(numbers, token, deleted = _DELETED):
+    headers = ''.join(f'''
+    <header{' status="deleted"' if number in deleted else ''}>
+      <identifier>oai:example.org:{number}</identifier>
+      <datestamp>2019-01-01T10:00:00Z</datestamp>
+    </header>''' for number in numbers)
+    # The last page has an empty resumptionToken element.
+    token = f'<resumptionToken cursor="0">{token}</resumptionToken>' if token else '<resumptionToken/>'
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+  <responseDate>2019-02-01T00:00:00Z</responseDate>
+  <request verb="ListIdentifiers">https://example.org/cgi/oai2</request>
+  <ListIdentifiers>{headers}
+    {token}
+  </ListIdentifiers>
+</OAI-PMH>
+'''.encode()
+
+
+def paged(path, params, headers):
+    numbers, token = _PAGES[params.get('resumptionToken')]
+    return (200, {'Content-Type': 'text/xml'}, page(numbers, token))
+
+
+def error(code):
+    def respond(path, params, headers):
+        return (200, {}, f'''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+  <responseDate>2019-02-01T00:00:00Z</responseDate>
+  <request>https://example.org/cgi/oai2</request>
+  <error code="{code}">Problem</error>
+</OAI-PMH>
+'''.encode())
+    return respond
+
+
+def test_pages_are_followed(server):
+    server.respond = paged
+    numbers = list(oai_identifiers(server.url + '/cgi/oai2'))
+    assert numbers == ['1', '2', '3', '4', '6', '7']
+    assert [params for _, params, _ in server.requests] == [
+        {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'},
+        {'verb': 'ListIdentifiers', 'resumptionToken': 'page2'},
+        {'verb': 'ListIdentifiers', 'resumptionToken': 'page3'}]
+
+
+def test_deleted_records_are_reported(server):
+    server.respond = paged
+    changes = list(oai_changes(server.url + '/cgi/oai2'))
+    assert ('5', True) in changes
+    assert ('4', False) in changes
+    assert len(changes) == 7
+
+
+def test_from_date(server):
+    server.respond = paged
+    # 01:00 on Jan. 2 in UTC+2 is 23:00 on Jan. 1 in UTC.
+    since = datetime(2019, 1, 2, 1, 0, tzinfo = timezone(timedelta(hours = 2)))
+    list(oai_identifiers(server.url + '/cgi/oai2', since))
+    assert server.requests[0][1]['from'] == '2019-01-01'
+    assert 'from' not in server.requests[1][1]
+
+
+def test_no_records_match(server):
+    server.respond = error('noRecordsMatch')
+    assert list(oai_identifiers(server.url + '/cgi/oai2')) == []
+
+
+def test_server_error(server):
+    server.respond = error('badArgument')
+    with pytest.raises(ServiceFailure, match = 'badArgument'):
+        list(oai_identifiers(server.url + '/cgi/oai2'))
@@ -0,0 +1,79 @@
+'''
+test_pipeline.py: tests for eprints2bags.pipeline.
+'''
+
+import pytest
+from   threading import Lock
+from   time import sleep
+
+from   eprints2bags.pipeline import Pipeline, Stage
+
+
+def recorder():
+    seen = []
+    lock = Lock()
+    def record(item):
+        with lock:
+            seen.append(item)
+        return True
+    return (seen, record)
+
+
+def failing_on(bad, delays = {}):
+    def func(item):
+        sleep(delays.get(item, 0))
+        if item in bad:
+            raise ValueError(f'item {item}')
+        return True
+    return func
+
+
+@pytest.mark.parametrize('threaded', [True, False])
+def test_all_items_pass_through_all_stages(threaded):
+    seen, record = recorder()
+    stages = [Stage('one', lambda item: True, workers = 3), Stage('two', record)]
+    Pipeline(stages, threaded = threaded).run(range(20))
+    assert sorted(seen) == list(range(20))
+
+
+@pytest.mark.parametrize('threaded', [True, False])
+def test_stage_error_is_raised_after_earlier_items_finish(threaded):
+    seen, record = recorder()
+    stages = [Stage('fail', failing_on({3}), workers = 2), Stage('record', record)]
+    with pytest.raises(ValueError, match = 'item 3'):
+        Pipeline(stages, threaded = threaded).run(range(10))
+    assert {0, 1, 2} <= set(seen)
+    assert 3 not in seen
+
+
+def test_earliest_error_is_reported():
+    # Item 5 fails first in time, but item 2 comes first in the input.
+    func = failing_on({2, 5}, delays = {2: 0.2})
+    with pytest.raises(ValueError, match = 'item 2'):
+        Pipeline([Stage('fail', func, workers = 4)]).run(range(10))
+
+
+@pytest.mark.parametrize('threaded', [True, False])
+def test_iterator_error_is_raised(threaded):
+    def items():
+        yield from range(3)
+        raise OSError('list unavailable')
+
+    seen, record = recorder()
+    with pytest.raises(OSError, match = 'list unavailable'):
+        Pipeline([Stage('record', record)], threaded = threaded).run(items())
+    assert sorted(seen) == [0, 1, 2]
+
+
+def test_dropped_items_are_discarded():
+    passed, record = recorder()
+    discarded, discard = recorder()
+    stages = [Stage('first', record), Stage('second', failing_on({1}, delays = {1: 0.2}))]
+    with pytest.raises(ValueError, match = 'item 1'):
+        Pipeline(stages, discard = discard).run(range(50))
+    # Items still waiting for either stage are discarded, once each.
+    dropped = [item for item in passed if item > 1]
+    assert dropped
+    assert set(dropped) <= set(discarded)
+    assert len(set(discarded)) == len(discarded)
+    assert min(discarded) > 1
@@ -0,0 +1,82 @@
+'''
+test_ratelimit.py: tests for eprints2bags.ratelimit.
+'''
+
+from   email.utils import formatdate
+from   threading import Thread
+from   time import monotonic, sleep, time
+
+import eprints2bags.ratelimit as ratelimit
+from   eprints2bags.ratelimit import HostLimiter, RateLimiter, _pause_seconds
+
+
+def test_max_rate_is_enforced():
+    limiter = RateLimiter(max_rate = 20)
+    start = monotonic()
+    for _ in range(11):
+        limiter.acquire('example.org')
+        limiter.release('example.org', 200)
+    # The first request goes at once; the other 10 are 1/20 s apart.
+    assert monotonic() - start >= 0.45
+
+
+def test_no_limit_until_overloaded():
+    limiter = HostLimiter('example.org')
+    start = monotonic()
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(200)
+    assert monotonic() - start < 0.5
+    status = limiter.status()
+    assert status['window'] == None
+    assert status['rate_limit'] == None
+
+
+def test_overload_halves_the_window():
+    limiter = HostLimiter('example.org')
+    for _ in range(4):
+        limiter.acquire()
+    limiter.release(503, retry_after = '0')
+    status = limiter.status()
+    assert status['window'] == 2
+    assert status['in_flight'] == 3
+    assert status['rate_limit'] != None
+
+    # With 3 requests in flight and a window of 2, the next one has to wait.
+    waiter = Thread(target = limiter.acquire, daemon = True)
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()
+    limiter.release(200)
+    limiter.release(200)
+    waiter.join(5)
+    assert not waiter.is_alive()
+
+
+def test_retry_after_pauses_requests():
+    limiter = HostLimiter('example.org')
+    limiter.acquire()
+    limiter.release(429, retry_after = '1')
+    start = monotonic()
+    limiter.acquire()
+    assert monotonic() - start >= 0.9
+
+
+def test_measurement_window_is_bounded(monkeypatch):
+    monkeypatch.setattr(ratelimit, '_MEASUREMENT_WINDOW', 0.1)
+    limiter = HostLimiter('example.org')
+    for _ in range(50):
+        limiter.acquire()
+        limiter.release(200)
+    sleep(0.2)
+    limiter.acquire()
+    assert len(limiter._started) == 1
+
+
+def test_pause_seconds():
+    assert _pause_seconds(None) == None
+    assert _pause_seconds('7') == 7
+    assert _pause_seconds('100000') == ratelimit._MAX_PAUSE
+    assert _pause_seconds('soon') == None
+    later = _pause_seconds(formatdate(time() + 30, usegmt = True))
+    assert 25 < later <= 30
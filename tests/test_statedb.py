@@ -0,0 +1,47 @@
+'''
+test_statedb.py: tests for eprints2bags.statedb.
+'''
+
+from   eprints2bags.statedb import RunState
+
+
+def test_new_database_is_not_resuming(tmp_path):
+    state = RunState(str(tmp_path / 'state.db'))
+    assert not state.resuming
+    assert not state.done(1)
+    state.close()
+
+
+def test_interrupted_run_is_resumed(tmp_path):
+    db_file = str(tmp_path / 'state.db')
+    state = RunState(db_file)
+    state.record(1, 'written', lastmod = '2019-01-01 10:00:00')
+    state.record(2, 'failed')
+    state.record(3, 'skipped')
+    state.close()                       # Interrupted: finish() not called.
+
+    state = RunState(db_file)
+    assert state.resuming
+    assert state.done(1)
+    assert state.done('1')
+    assert not state.done(2)
+    assert not state.done(3)
+    state.close()
+
+
+def test_finished_run_is_not_resumed(tmp_path):
+    db_file = str(tmp_path / 'state.db')
+    state = RunState(db_file)
+    first = state.run
+    state.record(1, 'written', lastmod = '2019-01-01 10:00:00')
+    state.finish()
+    state.close()
+
+    state = RunState(db_file)
+    assert not state.resuming
+    assert state.run != first
+    assert not state.done(1)
+    assert state.unchanged(1, '2019-01-01 10:00:00')
+    assert not state.unchanged(1, '2019-02-01 10:00:00')
+    assert not state.unchanged(2, '2019-01-01 10:00:00')
+    state.close()